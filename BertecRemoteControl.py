@@ -1,5 +1,17 @@
-from threading import Timer
+from threading import Thread, Event, Lock, RLock
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+from collections import deque
+import asyncio
+import json
+import socket
+import logging
+import time
 import zmq
+from force_buffer import ForceRingBuffer
+from force_decoder import make_decoder
+from status_cache import StatusCache, StatusRefresher
+
+logger = logging.getLogger(__name__)
 
 class RemoteControl:
     SUCCESS = 1,
@@ -13,78 +25,119 @@ class RemoteControl:
     MOTION_BASE_RPC_ERROR = -1
 
     DEFAULT_TIMEOUT = 5000
-    HEARTBEAT_MAX_ATTEMPTS = 10
+    STREAM_POLL_TIMEOUT = 100  # ms, how often the ingestion thread checks for shutdown
+    STREAM_BUFFER_SIZE = 16384  # ~16 s of samples at 1 kHz
+    # Buffered force columns. 'timestamp' is the Bertec-side time of the
+    # sample when the payload carries one (NaN otherwise), 't' our receive time
+    FORCE_FIELDS = ('t', 'fz', 'copx', 'copy', 'timestamp')
+    STATUS_TTL = 0.5  # s a status reply is reused for, see status_cache
+    FORCE_DECODER = None  # force_decoder backend ('projecting', 'orjson', 'json'), None for the fastest
 
     VERSION = "v1"
 
-    def start_connection(self, server_ip="127.0.0.1", rpc_port="5555", data_port="5556", client_ip="127.0.0.1", client_port="5560"):
-        # If any previous connections are running, don't run this method
-        if ('connected' in globals() and self.connected):
+    def start_connection(self, server_ip="127.0.0.1", rpc_port="5555", data_port="5556", client_ip="127.0.0.1", client_port="5560", stream_forces=False, context=None):
+        # If any previous connections are running, don't run this method.
+        # A remote whose InitConnect failed is still started, see reconnect
+        if getattr(self, 'started', False):
             return
 
-        # Set up ZMQ context and other connection parameters
+        # Set up ZMQ context and other connection parameters. A context passed
+        # in is shared with other clients (see device_manager) and not terminated here
         self.id = 1
-        self.heart_attempts = 0
-        self.context = zmq.Context()
+        self.owns_context = context is None
+        self.context = zmq.Context() if context is None else context
         self.connected = False
         self.started = True
+        self.last_success = None  # time.monotonic() of the last answered RPC
+        self.rpc_lock = RLock()
 
         self.server_ip = server_ip
         self.rpc_port = rpc_port
         self.data_port = data_port
         self.heart_ip = client_ip
         self.heart_port = client_port
+        self.force_buffer = None
+        self.stream_thread = None
+        self.stream_stop = Event()
+        self.sub_poller = None
+        self.decoder = make_decoder(self.FORCE_DECODER, self.FORCE_FIELDS[1:])
+        self.status_cache = StatusCache(self.STATUS_TTL)
+        self.status_refresher = None
         
         # Request socket used for all RPC commands to the server
-        self.req_socket = self.context.socket(zmq.REQ)
-        self.req_socket.setsockopt(zmq.RCVTIMEO, self.DEFAULT_TIMEOUT)
-        self.req_socket.connect("tcp://" + self.server_ip + ":" + rpc_port)
-        # Heartbeat socket used to detect if connection between client and server has terminated
-        #self.heart_socket = self.context.socket(zmq.ROUTER)
-        #self.heart_socket.bind("tcp://" + self.heart_ip + ":" + self.heart_port)
+        self.open_rpc_socket()
+        # The heartbeat socket on heart_ip:heart_port is run by ConnectionSupervisor
         # Subscriber socket used to receive force data from software
         self.sub_socket = self.context.socket(zmq.SUB)
-        self.sub_socket.setsockopt(zmq.CONFLATE, 1)
+        if not stream_forces:
+            # Only the newest sample is kept when forces are read on demand
+            self.sub_socket.setsockopt(zmq.CONFLATE, 1)
         self.sub_socket.connect("tcp://" + self.server_ip + ":" + data_port)
         self.sub_socket.subscribe('')
         # Send initial connection request to see if our connection is good
         init_res = self.send_init_connect(self.heart_ip, self.heart_port)
 
-        # Wait for response with default timeout value. If we don't get a response
-        # back from send_init_connect
-        if (init_res is not None and init_res['code'] == 1):
-            self.sub_poller = zmq.Poller()
-            self.sub_poller.register(self.sub_socket, zmq.POLLIN)
-            #self.sub_poller.register(self.heart_socket, zmq.POLLIN)
-            #self.heart_timer = Timer(1, self.get_heartbeat_resp)
-            # self.heart_timer.start()
-            self.connected = True
-
-            return init_res
-        else:
-            self.stop_connection()
+        # Wait for response with default timeout value. Without an answer the
+        # context and sockets are kept: ZMQ connects them by itself once the
+        # server is up, and reconnect() (or a ConnectionSupervisor) redoes InitConnect
+        self.connected = init_res is not None and init_res['code'] == 1
+        self.sub_poller = zmq.Poller()
+        self.sub_poller.register(self.sub_socket, zmq.POLLIN)
+        if stream_forces:
+            self.start_force_stream()
+
+        if not self.connected:
+            logger.warning("No answer to InitConnect from %s:%s, not connected yet", self.server_ip, self.rpc_port)
+            return None
+        return init_res
+
+    def open_rpc_socket(self):
+        self.req_socket = self.context.socket(zmq.REQ)
+        self.req_socket.setsockopt(zmq.RCVTIMEO, self.DEFAULT_TIMEOUT)
+        self.req_socket.connect("tcp://" + self.server_ip + ":" + self.rpc_port)
 
-        return None
+    def reset_rpc_socket(self):
+        """Replace the RPC socket, e.g. a REQ socket left waiting for a reply that never came."""
+        with self.rpc_lock:
+            self.req_socket.close(linger=0)
+            self.open_rpc_socket()
+
+    def reconnect(self):
+        """Rebuild the RPC socket and redo the InitConnect handshake. Returns True on success.
+
+        The SUB socket is kept: ZMQ reconnects it by itself and a force
+        stream thread may be reading it.
+        """
+        if not getattr(self, 'started', False):
+            return False
+
+        self.reset_rpc_socket()
+        init_res = self.send_init_connect(self.heart_ip, self.heart_port)
+        self.connected = init_res is not None and init_res['code'] == 1
+        return self.connected
+
+    def seconds_since_success(self):
+        """Seconds since the last RPC that got an answer, None if none did yet."""
+        if self.last_success is None:
+            return None
+        return time.monotonic() - self.last_success
 
     def stop_connection(self):
-        if ('started' not in globals() or not self.started):
+        if not getattr(self, 'started', False):
             return
 
         self.started = False
         self.connected = False
+        self.stop_status_refresh()
+        self.stop_force_stream()
 
-        self.req_socket.disconnect("tcp://" + self.server_ip + ":" + self.rpc_port)
-        self.req_socket.close()
-        self.sub_socket.disconnect("tcp://" + self.server_ip + ":" + self.data_port)
-        self.sub_socket.close()
-        #self.heart_socket.unbind("tcp://" + self.heart_ip + ":" + self.heart_port)
-        #self.heart_socket.close()
-
-        # if ('heart_timer' in globals()):
-        #     self.heart_timer.cancel()
-        if ('sub_poller' in globals()):
+        if self.sub_poller is not None:
             self.sub_poller.unregister(self.sub_socket)
-            #self.sub_poller.unregister(self.heart_socket)
+            self.sub_poller = None
+        self.req_socket.close(linger=0)
+        self.sub_socket.close(linger=0)
+        if self.owns_context:
+            self.context.term()
 
 
     def get_json_request_message(self, method, params):
@@ -97,40 +150,74 @@ class RemoteControl:
 
         return json_message
 
-    def get_force_data(self):
-        socks = dict(self.sub_poller.poll(self.DEFAULT_TIMEOUT))
+    def start_force_stream(self, capacity=None):
+        """Drain the SUB socket into a ring buffer from a background thread.
+
+        Once started, the ingestion thread owns ``sub_socket`` and
+        ``get_force_data`` returns the newest buffered sample instead of
+        polling the socket itself.
+        """
+        if self.stream_thread is not None:
+            return self.force_buffer
+
+        self.force_buffer = ForceRingBuffer(capacity or self.STREAM_BUFFER_SIZE, self.FORCE_FIELDS)
+        self.stream_stop.clear()
+        self.stream_thread = Thread(target=self._force_stream_loop, name="force-ingestion", daemon=True)
+        self.stream_thread.start()
+        return self.force_buffer
+
+    def stop_force_stream(self):
+        if self.stream_thread is None:
+            return
+
+        self.stream_stop.set()
+        self.stream_thread.join()
+        self.stream_thread = None
+
+    def _force_stream_loop(self):
+        poller = zmq.Poller()
+        poller.register(self.sub_socket, zmq.POLLIN)
+
+        while not self.stream_stop.is_set():
+            if poller.poll(self.STREAM_POLL_TIMEOUT):
+                self._drain_forces()
+
+        poller.unregister(self.sub_socket)
+
+    def _drain_forces(self):
+        """Push everything queued on the SUB socket into the force buffer, without blocking."""
+        buffer = self.force_buffer
+        values = self.decoder.values
+        clock = time.perf_counter
+        while True:
+            try:
+                frame = self.sub_socket.recv(zmq.NOBLOCK)
+            except zmq.error.Again:
+                return
+            # Only the buffered fields are decoded, without building a dict
+            buffer.push(clock(), values(frame))
+
+    def get_force_data(self, timeout=None):
+        # timeout in ms, defaults to DEFAULT_TIMEOUT
+        if timeout is None:
+            timeout = self.DEFAULT_TIMEOUT
+
+        if self.force_buffer is not None:
+            buffer = self.force_buffer
+            if buffer.count == 0 and not buffer.wait_for(0, timeout / 1000):
+                return None
+            return dict(zip(buffer.fields, buffer.latest().tolist()))
+
+        if self.sub_poller is None:
+            # stop_connection was called
+            return None
+        socks = dict(self.sub_poller.poll(timeout))
         if socks:
             if socks.get(self.sub_socket) == zmq.POLLIN:
-                return self.sub_socket.recv_json(zmq.NOBLOCK)
+                return self.decoder.decode(self.sub_socket.recv(zmq.NOBLOCK))
         else:
             return None
 
-    def get_heartbeat_resp(self):
-        self.heart_attempts += 1
-        socks = dict(self.sub_poller.poll(self.DEFAULT_TIMEOUT))
-        if socks:
-            if socks.get(self.heart_socket) == zmq.POLLIN:
-                self.connected = True
-                res = self.heart_socket.recv()
-                identity = self.heart_socket.recv()
-                self.heart_socket.send(res, zmq.SNDMORE)
-                self.heart_socket.send(identity)
-            else:
-                res = None
-        else:
-            res = None
-
-        if (res is None):
-            if self.heart_attempts >= self.HEARTBEAT_MAX_ATTEMPTS:
-                self.stop_connection()
-        else:
-            self.heart_attempts = 0
-
-        if (self.connected):
-            self.heart_timer.cancel()
-            self.heart_timer = Timer(1, self.get_heartbeat_resp)
-            self.heart_timer.start()
-
     def send_init_connect(self, ip, port):
         params = {
             'ip': ip,
@@ -140,7 +227,7 @@ class RemoteControl:
         res = self.send_json_message(json_msg)
         return res
 
-    def run_treadmill(self, left_vel, left_accel, left_decel, right_vel, right_accel, right_decel):
+    def run_treadmill(self, left_vel, left_accel, left_decel, right_vel, right_accel, right_decel, priority=False):
         def format_bertec(value):
             return str(value).replace('.', ',')  # Convertit 1.5 → '1,5'
 
@@ -154,9 +241,13 @@ class RemoteControl:
         }
 
         json_msg = self.get_json_request_message('RunTreadmill', params)
-        res = self.send_json_message(json_msg)
+        res = self.send_json_message(json_msg, priority)
         return res
 
+    def stop_treadmill(self, decel=0.2):
+        # Emergency/normal stop of both belts, sent on the priority lane when available
+        return self.run_treadmill(0, decel, decel, 0, decel, decel, priority=True)
+
     """ 
     def run_treadmill(self, left_vel, left_accel, left_decel, right_vel, right_accel, right_decel):
         params = {
@@ -181,39 +272,62 @@ class RemoteControl:
         res = self.send_json_message(json_msg)
         return res
 
-    def is_treadmill_moving(self):
-        params = {}
+    # Status queries reuse a reply up to max_age (default STATUS_TTL) seconds
+    # old and share a single RPC between concurrent callers. max_age=0 forces
+    # a new RPC.
+    def is_treadmill_moving(self, max_age=None):
+        return self._status('IsTreadmillMoving', max_age)
 
-        json_msg = self.get_json_request_message('IsTreadmillMoving', params)
-        res = self.send_json_message(json_msg)
-        return res
+    def is_incline_moving(self, max_age=None):
+        return self._status('IsInclineMoving', max_age)
 
-    def is_incline_moving(self):
-        params = {}
+    def is_client_authenticated(self, max_age=None):
+        return self._status('IsClientAuthenticated', max_age)
 
-        json_msg = self.get_json_request_message('IsInclineMoving', params)
-        res = self.send_json_message(json_msg)
-        return res
-    
-    def is_client_authenticated(self):
-        params = {}
+    def _status(self, method, max_age):
+        return self.query_status(method, max_age).result()
 
-        json_msg = self.get_json_request_message('IsClientAuthenticated', params)
-        res = self.send_json_message(json_msg)
-        return res
+    def query_status(self, method, max_age=None):
+        """Future of the reply to the status query ``method``, see status_cache."""
+        return self.status_cache.query(
+            method, lambda: self.send_json_message(self.get_json_request_message(method, {})), max_age)
+
+    def last_status(self, method):
+        """Newest reply to the status query ``method`` and its age, without any RPC."""
+        return self.status_cache.last(method)
+
+    def start_status_refresh(self, interval=1.0):
+        """Refresh every status in the background, so that last_status stays at most ~interval old."""
+        if self.status_refresher is None:
+            self.status_refresher = StatusRefresher(self, interval)
+            self.status_refresher.start()
+
+    def stop_status_refresh(self):
+        if self.status_refresher is not None:
+            self.status_refresher.stop()
+            self.status_refresher = None
         
-    def send_json_message(self, msg):
-        print("Sending message: " + str(msg))
-        try:
-            self.req_socket.send_json(msg, zmq.NOBLOCK)
-            self.id = self.id + 1
-            recv_msg = self.req_socket.recv_json()
-            print("Received message: " + str(recv_msg))
-        except zmq.error.Again as _e:
-            print("Message failed to send : " + _e.strerror)
-            recv_msg = None
-        finally:
-            return recv_msg
+    def send_json_message(self, msg, priority=False):
+        # priority has no effect on the lockstep REQ socket, see AsyncRemoteControl
+        if not self.started:
+            logger.warning("Not sending %s, the connection is stopped", msg['method'])
+            return None
+        logger.debug("Sending message: %s", msg)
+        # The lock keeps the REQ send/receive pairs of different threads apart
+        with self.rpc_lock:
+            try:
+                self.req_socket.send_json(msg, zmq.NOBLOCK)
+                self.id = self.id + 1
+                recv_msg = self.req_socket.recv_json()
+                self.last_success = time.monotonic()
+                logger.debug("Received message: %s", recv_msg)
+            except zmq.error.ZMQError as _e:
+                logger.warning("Message failed to send : %s", _e.strerror)
+                recv_msg = None
+                # A REQ socket that missed its reply refuses to send again until it is replaced
+                self.reset_rpc_socket()
+            finally:
+                return recv_msg
 
     def get_run_treadmill_user_input(self):
         left_vel = input("Input left velocity: ")
@@ -237,4 +351,215 @@ class RemoteControl:
 
         return {
             'inclineAngle': incline_angle
-        }
\ No newline at end of file
+        }
+
+
+class AsyncRemoteControl(RemoteControl):
+    """Pipelined RPC client on a DEALER socket.
+
+    A single I/O thread owns the socket. ``send_json_message`` (and therefore
+    ``run_treadmill``, ``run_incline``, ...) only queues the request and returns
+    a ``concurrent.futures.Future`` right away, so any thread can issue commands
+    and several requests can be in flight. Responses are matched to requests by
+    ``id``. A request that times out fails its future without leaving the socket
+    unusable, unlike a REQ socket. Priority requests (``stop_treadmill``) are
+    sent before any queued normal request.
+    """
+
+    MAX_IN_FLIGHT = 4
+    IO_POLL_TIMEOUT = 100  # ms, upper bound between timeout checks
+
+    def open_rpc_socket(self):
+        if getattr(self, 'id_lock', None) is None:
+            # Queued requests outlive socket resets, only the sent ones are failed
+            self.id_lock = Lock()
+            # Both queues are filled by any thread and drained by the I/O thread
+            self.queue_lock = Lock()
+            self.priority_queue = deque()
+            self.normal_queue = deque()
+        self.pending = {}  # id -> (future, deadline)
+
+        self.req_socket = self.context.socket(zmq.DEALER)
+        self.req_socket.setsockopt(zmq.LINGER, 0)
+        self.req_socket.connect("tcp://" + self.server_ip + ":" + self.rpc_port)
+        self._start_io()
+
+    def _start_io(self):
+        if getattr(self, 'wake_read', None) is None:
+            # Socket pair rather than a pipe so zmq.Poller can watch it on Windows too
+            self.wake_read, self.wake_write = socket.socketpair()
+            self.wake_read.setblocking(False)
+            self.wake_write.setblocking(False)
+        self.io_stop = Event()
+        self.io_thread = Thread(target=self._io_loop, name="rpc-io", daemon=True)
+        self.io_thread.start()
+
+    def reset_rpc_socket(self):
+        self._stop_io()
+        self.req_socket.close(linger=0)
+        self.open_rpc_socket()
+
+    def stop_connection(self):
+        if getattr(self, 'started', False):
+            # Before the I/O thread goes, so that no refresh is left waiting for it
+            self.stop_status_refresh()
+            self._stop_io()
+            with self.queue_lock:
+                queued = list(self.priority_queue) + list(self.normal_queue)
+                self.priority_queue.clear()
+                self.normal_queue.clear()
+            for msg, future in queued:
+                future.cancel()
+            if getattr(self, 'wake_read', None) is not None:
+                self.wake_read.close()
+                self.wake_write.close()
+                self.wake_read = self.wake_write = None
+        super().stop_connection()
+
+    def _stop_io(self):
+        self.io_stop.set()
+        self._wake()
+        self.io_thread.join()
+        self.io_thread = None
+
+    def get_json_request_message(self, method, params):
+        with self.id_lock:
+            json_message = super().get_json_request_message(method, params)
+            self.id += 1
+        return json_message
+
+    def send_init_connect(self, ip, port):
+        # The connection handshake stays blocking
+        try:
+            return super().send_init_connect(ip, port).result(self.DEFAULT_TIMEOUT / 1000)
+        except (FutureTimeoutError, TimeoutError):
+            return None
+
+    def send_json_message(self, msg, priority=False):
+        """Queue a request and return a Future resolved with the JSON response."""
+        future = Future()
+        if not self.started:
+            future.set_exception(ConnectionError("The connection is stopped"))
+            return future
+        with self.queue_lock:
+            if priority:
+                self.priority_queue.append((msg, future))
+            else:
+                self.normal_queue.append((msg, future))
+        self._wake()
+        return future
+
+    def _status(self, method, max_age):
+        # Futures, like every other request of this client
+        return self.query_status(method, max_age)
+
+    def send_json_message_async(self, msg, priority=False):
+        """Same as send_json_message, as an awaitable for the running asyncio loop."""
+        return asyncio.wrap_future(self.send_json_message(msg, priority))
+
+    def _wake(self):
+        wake_write = self.wake_write
+        if wake_write is None:
+            return  # Stopped, the queues were cancelled
+        try:
+            wake_write.send(b'\0')
+        except BlockingIOError:
+            pass  # The pair is full, so a wake-up is already pending
+        except OSError:
+            pass  # Closed by a concurrent stop_connection
+
+    def _io_loop(self):
+        poller = zmq.Poller()
+        poller.register(self.req_socket, zmq.POLLIN)
+        # Plain sockets are reported by file descriptor
+        wake_fd = self.wake_read.fileno()
+        poller.register(wake_fd, zmq.POLLIN)
+
+        while not self.io_stop.is_set():
+            events = dict(poller.poll(self._poll_timeout()))
+            if wake_fd in events:
+                try:
+                    self.wake_read.recv(4096)
+                except BlockingIOError:
+                    pass
+            if self.req_socket in events:
+                self._receive_responses()
+            self._send_queued()
+            self._expire_pending()
+
+        poller.unregister(self.req_socket)
+        poller.unregister(wake_fd)
+        self._fail_pending()
+
+    def _fail_pending(self):
+        for future, _ in self.pending.values():
+            future.set_exception(ConnectionError("Connection closed before a response arrived"))
+        self.pending = {}
+
+    def _poll_timeout(self):
+        if not self.pending:
+            return self.IO_POLL_TIMEOUT
+        deadline = min(deadline for _, deadline in self.pending.values())
+        return max(0, min(self.IO_POLL_TIMEOUT, int((deadline - time.monotonic()) * 1000) + 1))
+
+    def _send_queued(self):
+        # Priority requests always go out first and ignore the in-flight limit.
+        # They also cancel queued normal requests for the same method, so a
+        # speed command queued before a stop cannot restart the belt after it.
+        # Futures are only cancelled or sent outside the lock, their callbacks may queue new requests.
+        with self.queue_lock:
+            urgent = list(self.priority_queue)
+            self.priority_queue.clear()
+            methods = {msg['method'] for msg, _ in urgent}
+            superseded = [entry for entry in self.normal_queue if entry[0]['method'] in methods]
+            for entry in superseded:
+                self.normal_queue.remove(entry)
+        for _, future in superseded:
+            future.cancel()
+        for msg, future in urgent:
+            self._send(msg, future)
+        while len(self.pending) < self.MAX_IN_FLIGHT:
+            with self.queue_lock:
+                if not self.normal_queue:
+                    return
+                msg, future = self.normal_queue.popleft()
+            self._send(msg, future)
+
+    def _send(self, msg, future):
+        if not future.set_running_or_notify_cancel():
+            return
+        self.pending[msg['id']] = (future, time.monotonic() + self.DEFAULT_TIMEOUT / 1000)
+        logger.debug("Sending message: %s", msg)
+        # Empty delimiter frame so the server's REP socket sees a regular request
+        self.req_socket.send_multipart([b'', json.dumps(msg).encode()])
+
+    def _receive_responses(self):
+        while True:
+            try:
+                frames = self.req_socket.recv_multipart(zmq.NOBLOCK)
+            except zmq.error.Again:
+                return
+
+            recv_msg = json.loads(frames[-1])
+            self.last_success = time.monotonic()
+            logger.debug("Received message: %s", recv_msg)
+            if isinstance(recv_msg, dict) and recv_msg.get('id') is not None:
+                entry = self.pending.pop(recv_msg['id'], None)
+                if entry is None:
+                    # Its request already timed out, the reply belongs to no pending future
+                    logger.warning("Dropped the late reply to request %s", recv_msg['id'])
+                    continue
+            elif self.pending:
+                # No id in the reply: REP answers in order, so it is the oldest request
+                entry = self.pending.pop(next(iter(self.pending)))
+            else:
+                continue
+            entry[0].set_result(recv_msg)
+
+    def _expire_pending(self):
+        now = time.monotonic()
+        expired = [msg_id for msg_id, (_, deadline) in self.pending.items() if deadline <= now]
+        for msg_id in expired:
+            future, _ = self.pending.pop(msg_id)
+            logger.warning("No response to request %s within %d ms", msg_id, self.DEFAULT_TIMEOUT)
+            future.set_exception(TimeoutError("No response to request " + str(msg_id)))
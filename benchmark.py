@@ -0,0 +1,413 @@
+"""Latency and throughput benchmarks of the client stack against the local simulator.
+
+Each benchmark reports percentiles in microseconds. The results are written
+as JSON so that runs can be compared between versions:
+
+    python benchmark.py --output bench.json
+    python benchmark.py --only rpc_roundtrip control_tick --duration 2
+
+The simulator binds the RPC and data ports (5555/5556 by default), so do not
+run this next to the real Bertec software.
+"""
+import argparse
+import contextlib
+import datetime
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import numpy as np
+
+import BertecRemoteControl
+from bertec_simulator import BertecSimulator, SyntheticWalker
+from control_loop import ControlLoop
+from controller import StateEstimator, FastStateEstimator, LQGController
+from force_decoder import available_decoders, make_decoder
+from gait_events import GaitEventDetector
+from sample_bus import ForceSample
+from session_archive import CODECS, SessionArchive, write_archive
+from session_recorder import FORCES_SUFFIX, RecordFile
+from stage_profiler import StageProfiler
+
+
+def summarize(durations_ns):
+    """Percentile summary (us) of an array of durations in nanoseconds."""
+    values = np.asarray(durations_ns, dtype=float) / 1e3
+    if len(values) == 0:
+        return {'n': 0}
+    p50, p90, p99, p999 = np.percentile(values, [50, 90, 99, 99.9]).tolist()
+    return {
+        'n': len(values),
+        'mean_us': float(values.mean()),
+        'p50_us': p50,
+        'p90_us': p90,
+        'p99_us': p99,
+        'p999_us': p999,
+        'max_us': float(values.max()),
+    }
+
+
+@contextlib.contextmanager
+def quiet():
+    """Silence the client's console output so that it does not dominate the timings."""
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        yield
+
+
+def bench_rpc_roundtrip(args):
+    """send_json_message round trip on the lockstep REQ client, and pipelined on the DEALER client."""
+    results = {}
+    with BertecSimulator(args.rpc_port, args.data_port, rate=0, latency=args.latency) as simulator, quiet():
+        remote = BertecRemoteControl.RemoteControl()
+        remote.start_connection(rpc_port=str(args.rpc_port), data_port=str(args.data_port))
+        durations = []
+        deadline = time.perf_counter() + args.duration
+        while time.perf_counter() < deadline:
+            message = remote.get_json_request_message('IsTreadmillMoving', {})
+            start = time.perf_counter_ns()
+            remote.send_json_message(message)
+            durations.append(time.perf_counter_ns() - start)
+        results['req'] = summarize(durations)
+
+        pipelined = BertecRemoteControl.AsyncRemoteControl()
+        pipelined.start_connection(rpc_port=str(args.rpc_port), data_port=str(args.data_port))
+        submit, complete = [], []
+        deadline = time.perf_counter() + args.duration
+        while time.perf_counter() < deadline:
+            start = time.perf_counter_ns()
+            # Distinct requests, is_treadmill_moving() would share a single cached RPC
+            futures = [pipelined.send_json_message(pipelined.get_json_request_message('IsTreadmillMoving', {}))
+                       for _ in range(pipelined.MAX_IN_FLIGHT)]
+            submit.append((time.perf_counter_ns() - start) / len(futures))
+            for future in futures:
+                future.result()
+            complete.append((time.perf_counter_ns() - start) / len(futures))
+        results['dealer_submit'] = summarize(submit)
+        results['dealer_pipelined_per_request'] = summarize(complete)
+        results['requests_served'] = simulator.requests
+        pipelined.stop_connection()
+    return results
+
+
+def bench_status_query(args):
+    """Status read cost: cached last_status, TTL-cached query and a forced RPC, with callers polling in parallel."""
+    results = {}
+    with BertecSimulator(args.rpc_port, args.data_port, rate=0, latency=args.latency) as simulator, quiet():
+        remote = BertecRemoteControl.RemoteControl()
+        remote.start_connection(rpc_port=str(args.rpc_port), data_port=str(args.data_port))
+        remote.is_treadmill_moving()
+        clock = time.perf_counter_ns
+        for name, read in (('last_status', lambda: remote.last_status('IsTreadmillMoving')),
+                           ('ttl_cached', remote.is_treadmill_moving),
+                           ('rpc', lambda: remote.is_treadmill_moving(max_age=0))):
+            durations = []
+            deadline = time.perf_counter() + args.duration
+            while time.perf_counter() < deadline:
+                start = clock()
+                read()
+                durations.append(clock() - start)
+            results[name] = summarize(durations)
+
+        # Four threads polling as fast as they can: the RPCs the server actually saw
+        requests = simulator.requests
+        stop = threading.Event()
+
+        def poll():
+            while not stop.is_set():
+                remote.is_treadmill_moving()
+
+        threads = [threading.Thread(target=poll) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        time.sleep(args.duration)
+        stop.set()
+        for thread in threads:
+            thread.join()
+        results['polling_threads_rpc_per_s'] = (simulator.requests - requests) / args.duration
+        results['cache'] = remote.status_cache.stats()
+        remote.stop_connection()
+    return results
+
+
+def bench_force_ingestion(args):
+    """Receive/decode throughput of the force stream at several publish rates."""
+    results = {}
+    for rate in args.rates:
+        with BertecSimulator(args.rpc_port, args.data_port, rate=rate) as simulator, quiet():
+            # Stream mode: the ingestion thread drains every published sample
+            remote = BertecRemoteControl.RemoteControl()
+            try:
+                remote.start_connection(rpc_port=str(args.rpc_port), data_port=str(args.data_port),
+                                        stream_forces=True)
+                time.sleep(0.2)
+                published, received = simulator.published, remote.force_buffer.count
+                time.sleep(args.duration)
+                published = simulator.published - published
+                received = remote.force_buffer.count - received
+            finally:
+                remote.stop_connection()
+
+            # On-demand mode: cost of one get_force_data call on the conflated socket
+            on_demand = BertecRemoteControl.RemoteControl()
+            try:
+                on_demand.start_connection(rpc_port=str(args.rpc_port), data_port=str(args.data_port))
+                durations = []
+                deadline = time.perf_counter() + args.duration
+                while time.perf_counter() < deadline:
+                    start = time.perf_counter_ns()
+                    on_demand.get_force_data()
+                    durations.append(time.perf_counter_ns() - start)
+            finally:
+                on_demand.stop_connection()
+
+        results[f'{int(rate)}hz'] = {
+            'published_per_s': published / args.duration,
+            'received_per_s': received / args.duration,
+            'received_ratio': received / published if published else None,
+            'get_force_data': summarize(durations),
+        }
+    return results
+
+
+def bench_force_decode(args):
+    """Cost per message of each force decoder, on frames as the simulator publishes them."""
+    walker = SyntheticWalker()
+    frames = []
+    for i in range(4096):
+        sample = walker.sample(i / 1000, 1 / 1000, 1.2)
+        sample['timestamp'] = i / 1000
+        frames.append(json.dumps(sample).encode())
+
+    fields = BertecRemoteControl.RemoteControl.FORCE_FIELDS[1:]
+    results = {}
+    for name in available_decoders():
+        decoder = make_decoder(name, fields)
+        for method in ('values', 'decode'):
+            decode = getattr(decoder, method)
+            durations = []
+            deadline = time.perf_counter() + args.duration
+            clock = time.perf_counter_ns
+            while time.perf_counter() < deadline:
+                # Batches, so that the clock reads do not dominate a ~1 us decode
+                start = clock()
+                for frame in frames:
+                    decode(frame)
+                durations.append((clock() - start) / len(frames))
+            results[f'{name}_{method}'] = summarize(durations)
+    return results
+
+
+def bench_control_tick(args):
+    """Per-tick cost of estimator update plus target speed computation."""
+    rng = np.random.default_rng(0)
+    samples = [ForceSample(0.0, float(fz), 0.0, float(cop), 1)
+               for fz, cop in zip(rng.uniform(0, 100, 4096), rng.normal(0.8, 0.05, 4096))]
+
+    results = {}
+    for name, estimator in (('matrix', StateEstimator()), ('scalar', FastStateEstimator()),
+                            ('steady_state', FastStateEstimator(steady_state=True))):
+        controller = LQGController()
+        durations = np.empty(args.iterations, dtype=np.int64)
+        clock = time.perf_counter_ns
+        for i in range(args.iterations):
+            sample = samples[i % len(samples)]
+            start = clock()
+            flag_step, cop_avg, dcom, fz = estimator.update(sample, 0.01)
+            controller.update_treadmill_speed(controller.compute_target_speed(flag_step, cop_avg, dcom, fz))
+            durations[i] = clock() - start
+        results[name] = summarize(durations)
+    return results
+
+
+def bench_gait_events(args):
+    """Gait event detection on a 1 kHz stream fed in control-tick blocks, and as one pass over a recording."""
+    walker = SyntheticWalker()
+    n = 60000
+    t = np.arange(n) / 1000
+    rows = [walker.sample(i / 1000, 1 / 1000, 1.2) for i in range(n)]
+    fz = np.array([row['fz'] for row in rows])
+    cop = np.array([row['copy'] for row in rows])
+
+    detector = GaitEventDetector()
+    block = 10  # Samples per 10 ms tick
+    durations = np.empty(n // block, dtype=np.int64)
+    clock = time.perf_counter_ns
+    for i, start in enumerate(range(0, n, block)):
+        begin = clock()
+        detector.update(t[start:start + block], fz[start:start + block], cop[start:start + block])
+        durations[i] = clock() - begin
+
+    begin = clock()
+    whole = GaitEventDetector().update(t, fz, cop)
+    whole_duration = clock() - begin
+    return {
+        'per_block': summarize(durations),
+        'core_fraction': float(durations.sum() / 1e9 / (n / 1000)),
+        'whole_recording_ms_per_minute': whole_duration / 1e6 / (n / 60000),
+        'steps': detector.step_count,
+        'steps_whole_recording': len(whole),
+        'cadence': detector.cadence,
+    }
+
+
+def bench_stage_profiler(args):
+    """Cost of a StageProfiler lap, and of the guard that skips it when the profiler is disabled."""
+    results = {}
+    for enabled in (False, True):
+        profiler = StageProfiler(enabled)
+        durations = np.empty(args.iterations, dtype=np.int64)
+        clock = time.perf_counter_ns
+        for i in range(args.iterations):
+            start = clock()
+            profiling = profiler.enabled
+            if profiling:
+                lap = profiler.clock()
+                profiler.lap('stage', lap)
+            durations[i] = clock() - start
+        results['enabled' if enabled else 'disabled'] = summarize(durations)
+    return results
+
+
+def bench_session_archive(args):
+    """Size of an hour of 1 kHz forces in a session archive, and the time to pull one minute out of it."""
+    walker = SyntheticWalker()
+    rng = np.random.default_rng(0)
+    # One minute of gait, repeated with fresh sensor noise
+    minute = np.array([[walker.sample(i / 1000, 1 / 1000, 1.2)[name] for name in ('fz', 'copx', 'copy')]
+                       for i in range(60000)])
+    n = args.archive_minutes * 60000
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        base_path = os.path.join(directory, 'session')
+        forces = RecordFile(base_path + FORCES_SUFFIX, [(name, 'f8') for name in BertecRemoteControl.RemoteControl.FORCE_FIELDS])
+        for start in range(0, n, 60000):
+            records = np.zeros(60000, forces.dtype)
+            records['t'] = (start + np.arange(60000)) / 1000 + rng.uniform(0, 2e-4, 60000)
+            records['timestamp'] = (start + np.arange(60000)) / 1000
+            for column, name in enumerate(('fz', 'copx', 'copy')):
+                records[name] = minute[:, column] + rng.normal(0, 0.5 if name == 'fz' else 5e-4, 60000)
+            forces.append(records)
+        forces.close()
+        raw_size = os.path.getsize(base_path + FORCES_SUFFIX)
+
+        for codec in CODECS:
+            begin = time.perf_counter()
+            path = write_archive(base_path, base_path + '.' + codec, codec=codec)
+            write_time = time.perf_counter() - begin
+            durations = []
+            with SessionArchive(path) as archive:
+                for start in rng.uniform(0, n / 1000 - 60, 50):
+                    begin = time.perf_counter_ns()
+                    minute_rows = archive.read('forces', ['t', 'fz', 'copy'], start, start + 60)
+                    durations.append(time.perf_counter_ns() - begin)
+                rows = len(minute_rows['t'])
+                del minute_rows
+            results[codec] = {'size_ratio': os.path.getsize(path) / raw_size, 'write_s': write_time,
+                              'rows_per_minute': rows, 'one_minute_query': summarize(durations)}
+    results['raw_mb'] = raw_size / 1e6
+    return results
+
+
+def bench_sensor_to_command(args):
+    """Per-stage latency of the control loop, from force sample receipt to belt command ack."""
+    with BertecSimulator(args.rpc_port, args.data_port, rate=1000, latency=args.latency) as simulator, quiet():
+        remote = BertecRemoteControl.AsyncRemoteControl()
+        remote.start_connection(rpc_port=str(args.rpc_port), data_port=str(args.data_port), stream_forces=True)
+        controller = LQGController(remote=remote)
+        # The loop that runs behind the GUI, without Qt
+        loop = ControlLoop(remote, FastStateEstimator(), controller)
+
+        loop.start()
+        time.sleep(args.duration)
+        loop.stop()
+        controller.commands.close()
+        remote.stop_connection()
+
+    return {'latency': loop.tracer.snapshot(rolling=False), 'loop_timing': loop.scheduler.stats(),
+            'requests_served': simulator.requests}
+
+
+COLD_START = """
+import time
+start = time.perf_counter()
+from controller import FastStateEstimator, LQGController
+estimator, controller = FastStateEstimator(steady_state=True), LQGController()
+print(time.perf_counter() - start)
+"""
+
+
+def bench_cold_start(args):
+    """Headless controller startup in a fresh interpreter, with an empty and a warm gain cache."""
+    results = {}
+    here = os.path.dirname(os.path.abspath(__file__))
+    with tempfile.TemporaryDirectory() as directory:
+        env = dict(os.environ, TREADMILL_GAIN_CACHE=os.path.join(directory, "gain_cache.json"))
+        for name in ('empty_cache', 'warm_cache'):
+            durations = []
+            for _ in range(1 if name == 'empty_cache' else args.repeats):
+                output = subprocess.run([sys.executable, '-c', COLD_START], capture_output=True, text=True,
+                                        cwd=here, env=env, check=True).stdout
+                durations.append(float(output) * 1e9)
+            results[name] = summarize(durations)
+    return results
+
+
+BENCHMARKS = {
+    'rpc_roundtrip': bench_rpc_roundtrip,
+    'status_query': bench_status_query,
+    'force_ingestion': bench_force_ingestion,
+    'force_decode': bench_force_decode,
+    'control_tick': bench_control_tick,
+    'gait_events': bench_gait_events,
+    'stage_profiler': bench_stage_profiler,
+    'session_archive': bench_session_archive,
+    'sensor_to_command': bench_sensor_to_command,
+    'cold_start': bench_cold_start,
+}
+
+
+def environment():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {
+        'date': datetime.datetime.now().isoformat(timespec='seconds'),
+        'commit': commit,
+        'python': sys.version.split()[0],
+        'platform': platform.platform(),
+        'processor': platform.processor(),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the treadmill client stack against the simulator.")
+    parser.add_argument("--only", nargs='+', choices=list(BENCHMARKS), help="Benchmarks to run (default: all)")
+    parser.add_argument("--duration", type=float, default=3.0, help="Seconds per measurement")
+    parser.add_argument("--iterations", type=int, default=100000, help="Iterations of the control tick benchmark")
+    parser.add_argument("--rates", type=float, nargs='+', default=[1000, 2000, 5000],
+                        help="Force publish rates (Hz)")
+    parser.add_argument("--repeats", type=int, default=10, help="Interpreter launches of the cold start benchmark")
+    parser.add_argument("--archive-minutes", type=int, default=60, help="Length of the archived session")
+    parser.add_argument("--latency", type=float, default=0.0, help="Simulated RPC latency (s)")
+    parser.add_argument("--rpc-port", type=int, default=5555)
+    parser.add_argument("--data-port", type=int, default=5556)
+    parser.add_argument("--output", help="Write the JSON results to this file instead of stdout")
+    args = parser.parse_args()
+
+    report = {'environment': environment(), 'results': {}}
+    for name in args.only or list(BENCHMARKS):
+        report['results'][name] = BENCHMARKS[name](args)
+
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as file:
+            file.write(text + '\n')
+    else:
+        print(text)
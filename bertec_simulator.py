@@ -0,0 +1,293 @@
+"""Local stand-in for the Bertec treadmill software.
+
+Answers the RPC commands used by BertecRemoteControl on a ROUTER socket, so
+both the lockstep REQ client and the pipelined DEALER client can talk to
+it. A PUB socket emits force JSON at a configurable rate. RPC latency,
+jitter and dropped replies can be injected. The belts and the incline
+follow the commanded values with their acceleration limits, and the
+synthetic walker drifts on the belt when the belt speed differs from
+their walking speed, so the simulator closes the loop for the controller.
+Every random draw comes from a seeded generator, so runs are reproducible.
+
+    python bertec_simulator.py --rate 1000 --latency 0.002 --jitter 0.001
+"""
+import argparse
+import heapq
+import json
+import math
+import random
+import threading
+import time
+import zmq
+
+SUCCESS = 1
+PARSE_ERROR = -32700
+METHOD_NOT_FOUND = -32601
+INVALID_PARAMS = -32602
+
+TREADMILL_LENGTH = 1.53  # m, COP y range of the force plate
+
+
+class SyntheticWalker:
+    """Periodic gait producing fz, copx and copy, walking at ``walking_speed``."""
+
+    def __init__(self, walking_speed=1.2, cadence=1.8, weight=700.0, position=0.8, seed=0):
+        self.walking_speed = walking_speed
+        self.cadence = cadence  # steps per second
+        self.weight = weight
+        self.position = position  # antero-posterior position on the belt (m)
+        self.random = random.Random(seed)
+
+    def sample(self, t, dt, belt_speed):
+        # The walker moves forward on the belt when walking faster than it
+        self.position += (self.walking_speed - belt_speed) * dt
+        self.position = min(max(self.position, 0.0), TREADMILL_LENGTH)
+
+        phase, step = math.modf(t * self.cadence)
+        stance = 0.8  # fraction of the step with load on the plate
+        if phase < stance:
+            fz = self.weight * math.sin(math.pi * phase / stance) ** 0.5
+        else:
+            fz = 0.0
+        fz += self.random.gauss(0, 5)
+
+        # The foot travels backwards with the belt during stance
+        copy = self.position + 0.15 * (0.5 - phase)
+        copx = 0.1 if int(step) % 2 else -0.1
+        return {'fz': fz, 'copx': copx + self.random.gauss(0, 0.005), 'copy': copy + self.random.gauss(0, 0.005)}
+
+
+class RecordedWalker:
+    """Replays a recorded force stream (see replay.load_recording), looping at the end."""
+
+    def __init__(self, recording):
+        self.t = (recording.t - recording.t[0]).tolist()
+        self.fz = recording.fz.tolist()
+        self.copy = recording.copy.tolist()
+        self.index = 0
+
+    def sample(self, t, dt, belt_speed):
+        t = t % self.t[-1] if self.t[-1] > 0 else 0.0
+        if t < self.t[self.index]:
+            self.index = 0
+        while self.index + 1 < len(self.t) and self.t[self.index + 1] <= t:
+            self.index += 1
+        return {'fz': self.fz[self.index], 'copx': 0.0, 'copy': self.copy[self.index]}
+
+
+class BertecSimulator:
+    def __init__(self, rpc_port=5555, data_port=5556, ip="127.0.0.1", rate=1000.0, latency=0.0,
+                 jitter=0.0, drop=0.0, walker=None, seed=0, context=None):
+        self.endpoint_rpc = f"tcp://{ip}:{rpc_port}"
+        self.endpoint_data = f"tcp://{ip}:{data_port}"
+        self.rate = rate
+        self.latency = latency  # s added to every reply
+        self.jitter = jitter  # s, standard deviation of the added latency
+        self.drop = drop  # probability of never answering a request
+        self.walker = walker if walker is not None else SyntheticWalker(seed=seed)
+        self.random = random.Random(seed)
+        self.context = context or zmq.Context.instance()
+
+        # Belt and incline state, driven towards their targets
+        self.left = {'vel': 0.0, 'target': 0.0, 'accel': 0.5, 'decel': 0.5}
+        self.right = {'vel': 0.0, 'target': 0.0, 'accel': 0.5, 'decel': 0.5}
+        self.incline = {'angle': 0.0, 'target': 0.0, 'rate': 1.0}  # degrees, degrees/s
+        self.authenticated = False
+
+        self.requests = 0
+        self.dropped = 0
+        self.published = 0
+        self.handlers = {
+            'InitConnect': self.init_connect,
+            'RunTreadmill': self.run_treadmill,
+            'RunIncline': self.run_incline,
+            'IsTreadmillMoving': self.is_treadmill_moving,
+            'IsInclineMoving': self.is_incline_moving,
+            'IsClientAuthenticated': self.is_client_authenticated,
+        }
+
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def start(self):
+        """Bind the sockets and serve from a background thread."""
+        self.rpc_socket = self.context.socket(zmq.ROUTER)
+        self.rpc_socket.setsockopt(zmq.LINGER, 0)
+        self.bind(self.rpc_socket, self.endpoint_rpc)
+        self.pub_socket = self.context.socket(zmq.PUB)
+        self.pub_socket.setsockopt(zmq.LINGER, 0)
+        self.bind(self.pub_socket, self.endpoint_data)
+
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self.serve, name="bertec-simulator", daemon=True)
+        self.thread.start()
+
+    def bind(self, sock, endpoint, attempts=20):
+        # Closing a socket is asynchronous in ZMQ, so a port released by a
+        # previous simulator can take a moment to become available again
+        for attempt in range(attempts):
+            try:
+                sock.bind(endpoint)
+                return
+            except zmq.error.ZMQError as e:
+                if e.errno != zmq.EADDRINUSE or attempt == attempts - 1:
+                    raise
+                time.sleep(0.05)
+
+    def stop(self):
+        if self.thread is None:
+            return
+        self.stop_event.set()
+        self.thread.join()
+        self.thread = None
+        self.rpc_socket.close()
+        self.pub_socket.close()
+
+    def serve(self):
+        poller = zmq.Poller()
+        poller.register(self.rpc_socket, zmq.POLLIN)
+        replies = []  # heap of (due time, sequence, frames)
+        sequence = 0
+
+        period = 1.0 / self.rate if self.rate > 0 else None
+        start = last = time.perf_counter()
+        next_publish = start
+
+        while not self.stop_event.is_set():
+            now = time.perf_counter()
+            due = [next_publish] if period else []
+            if replies:
+                due.append(replies[0][0])
+            timeout = max(0.0, min(due) - now) * 1000 if due else 100
+            if poller.poll(min(timeout, 100)):
+                while True:
+                    try:
+                        frames = self.rpc_socket.recv_multipart(zmq.NOBLOCK)
+                    except zmq.error.Again:
+                        break
+                    reply = self.handle_request(frames)
+                    if reply is not None:
+                        delay = max(0.0, self.random.gauss(self.latency, self.jitter)) if self.jitter else self.latency
+                        heapq.heappush(replies, (time.perf_counter() + delay, sequence, reply))
+                        sequence += 1
+
+            now = time.perf_counter()
+            while replies and replies[0][0] <= now:
+                self.rpc_socket.send_multipart(heapq.heappop(replies)[2])
+
+            self.update_devices(now - last)
+            last = now
+
+            # Publish every sample that is due, catching up after a late wake-up
+            while period and next_publish <= now:
+                sample = self.walker.sample(next_publish - start, period, self.belt_speed())
+                sample['timestamp'] = next_publish - start  # Device clock, seconds since start
+                self.pub_socket.send_string(json.dumps(sample))
+                self.published += 1
+                next_publish += period
+
+    def handle_request(self, frames):
+        """Return the reply frames for one request, or None if it is dropped."""
+        self.requests += 1
+        envelope, body = frames[:-1], frames[-1]
+        try:
+            request = json.loads(body)
+            handler = self.handlers.get(request.get('method'))
+            if handler is None:
+                result = {'code': METHOD_NOT_FOUND, 'message': "Method not found"}
+            else:
+                result = handler(request.get('params') or {})
+        except (ValueError, AttributeError):
+            request, result = {}, {'code': PARSE_ERROR, 'message': "Parse error"}
+
+        if self.drop and self.random.random() < self.drop:
+            self.dropped += 1
+            return None
+
+        result['id'] = request.get('id')
+        return envelope + [json.dumps(result).encode()]
+
+    def belt_speed(self):
+        return (self.left['vel'] + self.right['vel']) / 2
+
+    def update_devices(self, elapsed):
+        for belt in (self.left, self.right):
+            error = belt['target'] - belt['vel']
+            limit = (belt['accel'] if error > 0 else belt['decel']) * elapsed
+            belt['vel'] += max(-limit, min(limit, error))
+
+        error = self.incline['target'] - self.incline['angle']
+        limit = self.incline['rate'] * elapsed
+        self.incline['angle'] += max(-limit, min(limit, error))
+
+    def init_connect(self, params):
+        self.authenticated = True
+        return {'code': SUCCESS, 'message': "Connected"}
+
+    def run_treadmill(self, params):
+        try:
+            # The Bertec software expects decimal commas, accept both
+            values = {key: float(str(value).replace(',', '.')) for key, value in params.items()}
+            for side, belt in (('left', self.left), ('right', self.right)):
+                belt['target'] = values[side + 'Vel']
+                belt['accel'] = values[side + 'Accel'] or belt['accel']
+                belt['decel'] = values[side + 'Decel'] or belt['decel']
+        except (KeyError, ValueError):
+            return {'code': INVALID_PARAMS, 'message': "Invalid params"}
+        return {'code': SUCCESS, 'message': "Success"}
+
+    def run_incline(self, params):
+        try:
+            self.incline['target'] = float(str(params['inclineAngle']).replace(',', '.'))
+        except (KeyError, ValueError):
+            return {'code': INVALID_PARAMS, 'message': "Invalid params"}
+        return {'code': SUCCESS, 'message': "Success"}
+
+    def is_treadmill_moving(self, params):
+        moving = any(abs(belt['vel']) > 1e-3 or belt['vel'] != belt['target'] for belt in (self.left, self.right))
+        return {'code': SUCCESS, 'message': str(moving), 'result': moving}
+
+    def is_incline_moving(self, params):
+        moving = self.incline['angle'] != self.incline['target']
+        return {'code': SUCCESS, 'message': str(moving), 'result': moving}
+
+    def is_client_authenticated(self, params):
+        return {'code': SUCCESS, 'message': str(self.authenticated), 'result': self.authenticated}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Local Bertec treadmill server simulator.")
+    parser.add_argument("--ip", default="127.0.0.1")
+    parser.add_argument("--rpc-port", type=int, default=5555)
+    parser.add_argument("--data-port", type=int, default=5556)
+    parser.add_argument("--rate", type=float, default=1000.0, help="Force samples published per second")
+    parser.add_argument("--latency", type=float, default=0.0, help="RPC reply latency (s)")
+    parser.add_argument("--jitter", type=float, default=0.0, help="Standard deviation of the RPC latency (s)")
+    parser.add_argument("--drop", type=float, default=0.0, help="Probability of dropping a reply")
+    parser.add_argument("--walking-speed", type=float, default=1.2, help="Synthetic walker speed (m/s)")
+    parser.add_argument("--replay", help="Recording to publish instead of the synthetic walker")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    if args.replay:
+        from replay import load_recording
+        walker = RecordedWalker(load_recording(args.replay))
+    else:
+        walker = SyntheticWalker(args.walking_speed, seed=args.seed)
+
+    simulator = BertecSimulator(args.rpc_port, args.data_port, args.ip, args.rate, args.latency, args.jitter,
+                                args.drop, walker, args.seed)
+    simulator.start()
+    print(f"Simulating the Bertec server on {simulator.endpoint_rpc} (RPC) and {simulator.endpoint_data} (data)")
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        simulator.stop()
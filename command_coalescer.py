@@ -0,0 +1,168 @@
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class CommandCoalescer:
+    """Latest-wins buffer between the controller and the treadmill RPCs.
+
+    Only the newest pending setpoint per actuator (left belt, right belt,
+    incline) is kept. A background thread sends it as soon as the channel is
+    idle (the previous command on it has been answered) and at least
+    ``min_interval`` seconds after the previous send. A setpoint is
+    overwritten only by a newer one, so the last value of a burst is always
+    sent. ``stats`` reports how many setpoints were coalesced versus sent.
+
+    A belt setpoint can carry the TickStamp of the tick that produced it. With
+    a LatencyTracer in ``tracer``, the send and acknowledgement times of the
+    RunTreadmill command that carries it are then recorded.
+    """
+
+    def __init__(self, remote, min_interval=0.1, tracer=None):
+        self.remote = remote
+        self.min_interval = min_interval
+        self.tracer = tracer
+
+        self.lock = threading.Lock()
+        self.changed = threading.Condition(self.lock)
+        # Latest requested (vel, accel, decel) per belt, and incline angle
+        self.current = {'left': None, 'right': None, 'incline': None}
+        self.pending = {'treadmill': False, 'incline': False}
+        self.last_send = {'treadmill': 0.0, 'incline': 0.0}
+        self.in_flight = {'treadmill': None, 'incline': None}
+        self.stamp = None  # TickStamp of the latest belt setpoint
+        self.sending = False  # The flush thread is in a send, with the lock released
+
+        self.submitted = 0
+        self.coalesced = 0
+        self.sent = 0
+
+        self.running = True
+        self.thread = threading.Thread(target=self._flush_loop, name="command-coalescer", daemon=True)
+        self.thread.start()
+
+    def set_belts(self, vel, accel, decel, stamp=None):
+        """Request the same speed on both belts."""
+        self.set_treadmill(vel, accel, decel, vel, accel, decel, stamp)
+
+    def set_treadmill(self, left_vel, left_accel, left_decel, right_vel, right_accel, right_decel, stamp=None):
+        with self.lock:
+            self._submit('treadmill')
+            self.current['left'] = (left_vel, left_accel, left_decel)
+            self.current['right'] = (right_vel, right_accel, right_decel)
+            self.stamp = stamp
+            self.changed.notify()
+
+    def set_incline(self, incline_angle):
+        with self.lock:
+            self._submit('incline')
+            self.current['incline'] = incline_angle
+            self.changed.notify()
+
+    def cancel(self):
+        """Drop every pending setpoint, e.g. right before a stop command.
+
+        Also waits for a send already in progress, so that once this returns
+        no setpoint can reach the remote after the caller's stop.
+        """
+        with self.lock:
+            self.pending = {'treadmill': False, 'incline': False}
+            while self.sending:
+                self.changed.wait()
+
+    def close(self):
+        with self.lock:
+            self.running = False
+            self.changed.notify()
+        self.thread.join()
+
+    def stats(self):
+        return {'submitted': self.submitted, 'coalesced': self.coalesced, 'sent': self.sent}
+
+    def _submit(self, channel):
+        self.submitted += 1
+        if self.pending[channel]:
+            self.coalesced += 1
+        self.pending[channel] = True
+
+    def _is_idle(self, channel):
+        request = self.in_flight[channel]
+        # Synchronous remotes return the response itself, asynchronous ones a Future
+        return request is None or not hasattr(request, 'done') or request.done()
+
+    def _next_flush(self, now):
+        """Return (channel, delay) for the next channel to flush, or (None, None)."""
+        best = (None, None)
+        for channel, pending in self.pending.items():
+            if not pending or not self._is_idle(channel):
+                continue
+            delay = max(0.0, self.last_send[channel] + self.min_interval - now)
+            if best[1] is None or delay < best[1]:
+                best = (channel, delay)
+        return best
+
+    def _flush_loop(self):
+        with self.lock:
+            while self.running:
+                channel, delay = self._next_flush(time.monotonic())
+                if channel is None:
+                    # Woken up by a new setpoint or by a command being answered
+                    self.changed.wait()
+                    continue
+                if delay > 0:
+                    self.changed.wait(delay)
+                    continue
+
+                self.pending[channel] = False
+                self.last_send[channel] = time.monotonic()
+                self.sent += 1
+                stamp = None
+                if channel == 'incline':
+                    args = (self.current['incline'],)
+                else:
+                    args = self.current['left'] + self.current['right']
+                    stamp, self.stamp = self.stamp, None
+
+                # Send without holding the lock, a synchronous remote blocks for a round trip
+                self.sending = True
+                self.lock.release()
+                try:
+                    request = self._send(channel, args, stamp)
+                finally:
+                    self.lock.acquire()
+                    self.sending = False
+                    # Wakes a cancel() waiting for this send
+                    self.changed.notify_all()
+                self.in_flight[channel] = request
+
+    def _send(self, channel, args, stamp=None):
+        sent = time.perf_counter()
+        try:
+            if channel == 'incline':
+                request = self.remote.run_incline(*args)
+            else:
+                request = self.remote.run_treadmill(*args)
+        except Exception as e:
+            logger.error("Error while sending %s command: %s", channel, e)
+            return None
+
+        tracer = self.tracer if stamp is not None else None
+        if hasattr(request, 'add_done_callback'):
+            if tracer is not None:
+                request.add_done_callback(lambda done: self._on_acked(done, tracer, stamp, sent))
+            request.add_done_callback(self._on_done)
+        elif tracer is not None and request is not None:
+            tracer.record_command(stamp, sent, time.perf_counter())
+        return request
+
+    def _on_acked(self, request, tracer, stamp, sent):
+        acked = time.perf_counter()
+        # Timed out or failed commands never reached the belts
+        if not request.cancelled() and request.exception() is None:
+            tracer.record_command(stamp, sent, acked)
+
+    def _on_done(self, request):
+        with self.lock:
+            self.changed.notify()
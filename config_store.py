@@ -0,0 +1,147 @@
+"""JSON configuration held in memory, with debounced atomic saves and hot reload.
+
+The file is read once. ``update`` changes the in-memory values and
+(re)starts a debounce timer, so a burst of updates, such as the resize
+events of a window drag, ends in a single write ``debounce`` seconds after
+the last one. A write goes to a temporary file that then replaces the
+config, so a crash never leaves a truncated file behind. ``flush`` writes
+pending changes right away. While the file is not valid JSON, changes stay
+in memory: they are only written once the file reads again, so a typo in a
+hand edit never gets the whole file replaced.
+
+``watch`` polls the file for changes made by someone else, e.g. a hand
+edit of the "controller" section, reloads it and calls the subscribers
+with the new values.
+"""
+import copy
+import json
+import logging
+import os
+import threading
+
+logger = logging.getLogger(__name__)
+
+CONFIG_FILE = "config.json"  # Window/button layout and the optional "controller" parameter section
+
+
+class ConfigStore:
+    def __init__(self, path, debounce=0.5):
+        self.path = path
+        self.debounce = debounce
+        self.lock = threading.RLock()
+        self.timer = None
+        self.dirty = set()  # Keys changed in memory since the last write
+        self.subscribers = []
+        self.watch_stop = threading.Event()
+        self.watch_thread = None
+        self.writes = 0
+        data = self._read()
+        self.readable = data is not None  # False while the file is invalid, nothing is written then
+        self.data = data or {}
+        self.mtime = self._mtime()
+
+    def _read(self):
+        """Contents of the file, {} if there is none, None if it is not valid JSON."""
+        try:
+            with open(self.path, "r") as file:
+                return json.load(file)
+        except FileNotFoundError:
+            return {}
+        except ValueError as exc:
+            logger.error("Ignoring invalid configuration %s: %s", self.path, exc)
+            return None
+
+    def _mtime(self):
+        try:
+            return os.stat(self.path).st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+    def get(self, key, default=None):
+        """Copy of the value of ``key``, so callers cannot change the store behind its back."""
+        with self.lock:
+            return copy.deepcopy(self.data.get(key, default))
+
+    def update(self, **values):
+        """Change values in memory and schedule a save."""
+        with self.lock:
+            if all(self.data.get(key) == value for key, value in values.items()):
+                return
+            self.data.update(values)
+            self.dirty.update(values)
+            if self.timer is not None:
+                self.timer.cancel()
+            self.timer = threading.Timer(self.debounce, self.flush)
+            self.timer.daemon = True
+            self.timer.start()
+
+    def flush(self):
+        """Write pending changes now."""
+        with self.lock:
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+            if not self.dirty:
+                return
+            if not self.readable and self.reload() is None:
+                logger.warning("Not saving %s while it is invalid, keeping %s in memory", self.path,
+                               ', '.join(sorted(self.dirty)))
+                return
+            self.dirty.clear()
+            temporary = self.path + ".tmp"
+            with open(temporary, "w") as file:
+                json.dump(self.data, file)
+                file.flush()
+                os.fsync(file.fileno())
+            os.replace(temporary, self.path)
+            # Our own write is not a change to reload
+            self.mtime = self._mtime()
+            self.writes += 1
+
+    def subscribe(self, callback):
+        """Call ``callback(data)`` from the watch thread whenever the file is changed by someone else."""
+        self.subscribers.append(callback)
+
+    def watch(self, interval=1.0):
+        if self.watch_thread is None:
+            self.watch_stop.clear()
+            self.watch_thread = threading.Thread(target=self._watch_loop, args=(interval,), name="config-watch",
+                                                 daemon=True)
+            self.watch_thread.start()
+
+    def close(self):
+        self.watch_stop.set()
+        if self.watch_thread is not None:
+            self.watch_thread.join()
+            self.watch_thread = None
+        self.flush()
+
+    def reload(self):
+        """Re-read the file, values changed in memory but not written yet win.
+
+        Returns the new values, or None if the file is not valid JSON (e.g.
+        half-saved by an editor), in which case the current values are kept.
+        """
+        with self.lock:
+            data = self._read()
+            self.mtime = self._mtime()
+            self.readable = data is not None
+            if data is None:
+                return None
+            data.update({key: self.data[key] for key in self.dirty})
+            self.data = data
+            return copy.deepcopy(self.data)
+
+    def _watch_loop(self, interval):
+        while not self.watch_stop.wait(interval):
+            if self._mtime() == self.mtime:
+                continue
+            data = self.reload()
+            if data is None:
+                continue
+            logger.info("Configuration %s reloaded", self.path)
+            for callback in self.subscribers:
+                try:
+                    callback(data)
+                except Exception:
+                    logger.exception("Configuration subscriber failed")
@@ -0,0 +1,145 @@
+import logging
+import threading
+import time
+import zmq
+
+logger = logging.getLogger(__name__)
+
+CONNECTED = 'connected'
+RECONNECTING = 'reconnecting'
+STOPPED = 'stopped'
+
+
+class ConnectionSupervisor:
+    """Watches the link to the Bertec server from one thread and rebuilds it when it is lost.
+
+    The thread runs a single zmq.Poller on the heartbeat ROUTER socket, bound
+    on the client ip/port announced in InitConnect, and echoes every
+    heartbeat the server sends. Any answered RPC also counts as a sign of
+    life. After ``interval`` s without one, an IsClientAuthenticated probe is
+    sent. After ``timeout`` s the connection is declared lost, the RPC socket
+    is rebuilt and InitConnect redone, retrying with exponential backoff from
+    ``min_backoff`` to ``max_backoff`` s.
+
+    Loss is detected within ``timeout`` s with AsyncRemoteControl. A lockstep
+    RemoteControl probe blocks the supervisor (never the control loop) for
+    up to DEFAULT_TIMEOUT. While reconnecting, AsyncRemoteControl keeps the
+    queued requests for the new socket and fails the ones in flight.
+
+    Stop the supervisor before ``stop_connection``. Otherwise it exits at
+    its next poll, when the remote's ZMQ context is terminated.
+    """
+
+    def __init__(self, remote, interval=1.0, timeout=3.0, min_backoff=0.5, max_backoff=10.0):
+        self.remote = remote
+        self.interval = interval
+        self.timeout = timeout
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+
+        self.state = CONNECTED if getattr(remote, 'connected', False) else RECONNECTING
+        self.last_heartbeat = None
+        self.reconnects = 0
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def start(self):
+        if self.thread is not None:
+            return
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self._run, name="connection-supervisor", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        if self.thread is None:
+            return
+        self.stop_event.set()
+        self.thread.join()
+        self.thread = None
+
+    def status(self):
+        """Connection state and seconds since the last sign of life from the server."""
+        since_heartbeat = None
+        if self.last_heartbeat is not None:
+            since_heartbeat = time.monotonic() - self.last_heartbeat
+        return {'state': self.state, 'since_last_rpc': self.remote.seconds_since_success(),
+                'since_last_heartbeat': since_heartbeat, 'reconnects': self.reconnects}
+
+    def _open_heart_socket(self):
+        endpoint = "tcp://" + self.remote.heart_ip + ":" + self.remote.heart_port
+        heart_socket = self.remote.context.socket(zmq.ROUTER)
+        heart_socket.setsockopt(zmq.LINGER, 0)
+        try:
+            heart_socket.bind(endpoint)
+        except zmq.error.ZMQError as e:
+            logger.warning("No heartbeat socket on %s (%s), relying on probes only", endpoint, e)
+            heart_socket.close()
+            return None
+        return heart_socket
+
+    def _echo_heartbeats(self, heart_socket):
+        while True:
+            try:
+                frames = heart_socket.recv_multipart(zmq.NOBLOCK)
+            except zmq.error.Again:
+                return
+            # ROUTER frames start with the server's identity, so this answers it
+            heart_socket.send_multipart(frames)
+            self.last_heartbeat = time.monotonic()
+
+    def _last_alive(self, since):
+        times = [since, self.remote.last_success, self.last_heartbeat]
+        return max(t for t in times if t is not None)
+
+    def _run(self):
+        poll_timeout = self.interval / 4
+        poller = zmq.Poller()
+        heart_socket = None
+        probe, probe_sent = None, 0.0
+        backoff, next_attempt = self.min_backoff, 0.0
+        since = time.monotonic()
+
+        try:
+            heart_socket = self._open_heart_socket()
+            if heart_socket is not None:
+                poller.register(heart_socket, zmq.POLLIN)
+
+            while not self.stop_event.is_set() and self.remote.started:
+                if heart_socket is None:
+                    self.stop_event.wait(poll_timeout)
+                elif poller.poll(poll_timeout * 1000):
+                    self._echo_heartbeats(heart_socket)
+
+                now = time.monotonic()
+                if probe is not None and (not hasattr(probe, 'done') or probe.done()
+                                          or now - probe_sent > self.timeout):
+                    probe = None
+
+                if self.state == CONNECTED:
+                    idle = now - self._last_alive(since)
+                    if idle > self.timeout:
+                        logger.warning("No answer from the server for %.1f s, reconnecting", idle)
+                        self.state = RECONNECTING
+                        self.remote.connected = False
+                        backoff, next_attempt = self.min_backoff, now
+                    elif idle >= self.interval and probe is None:
+                        probe, probe_sent = self.remote.is_client_authenticated(max_age=0), now
+
+                if self.state == RECONNECTING and now >= next_attempt:
+                    if self.remote.reconnect():
+                        logger.info("Reconnected to the server")
+                        self.state = CONNECTED
+                        self.reconnects += 1
+                        probe, since = None, time.monotonic()
+                    else:
+                        next_attempt = time.monotonic() + backoff
+                        backoff = min(2 * backoff, self.max_backoff)
+        except zmq.error.ZMQError as e:
+            # Expected once stop_connection has terminated the context under the supervisor
+            if getattr(self.remote, 'started', False):
+                logger.error("Connection supervisor stopped: %s", e)
+        finally:
+            if heart_socket is not None:
+                poller.unregister(heart_socket)
+                heart_socket.close()
+            self.state = STOPPED
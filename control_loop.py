@@ -0,0 +1,201 @@
+import logging
+import threading
+import time
+from collections import deque
+from dataclasses import replace
+import BertecRemoteControl
+from connection_supervisor import ConnectionSupervisor
+from sample_bus import SampleBus
+from scheduler import FixedRateScheduler
+from controller import ControllerParams, steady_state_kalman_gain
+from gait_events import GaitEventDetector
+from latency_trace import LatencyTracer
+from stage_profiler import StageProfiler
+
+logger = logging.getLogger(__name__)
+
+SAMPLE_TIMEOUT = 0.008  # Maximum wait for force data within one tick (s)
+SPIN_TIME = 0.0003  # Busy-wait before each deadline to absorb sleep() oversleep (s)
+
+
+def connect(stream_forces=True, **connection):
+    """Connect to the treadmill and supervise the connection. Returns (remote, supervisor).
+
+    ``connection`` is passed on to ``start_connection`` (server_ip, rpc_port, ...).
+    """
+    remote = BertecRemoteControl.AsyncRemoteControl()
+    remote.start_connection(stream_forces=stream_forces, **connection)
+    # Heartbeat and automatic reconnection, off the control thread
+    supervisor = ConnectionSupervisor(remote)
+    supervisor.start()
+    return remote, supervisor
+
+
+class ControlLoop:
+    """Fixed-rate control thread: force sample -> estimator -> controller -> speed command.
+
+    It has no GUI dependency. Every tick is handed to ``sink``, any object
+    with the ``log_data`` and ``publish_state`` methods of
+    interface.TreadmillInterface, so the same loop runs behind the GUI and
+    headless.
+    """
+
+    def __init__(self, remote, estimator, controller, sink=None, period=None, sample_timeout=SAMPLE_TIMEOUT,
+                 spin=SPIN_TIME, profiler=None):
+        self.remote = remote
+        self.estimator = estimator
+        self.controller = controller
+        self.sink = sink
+        self.running = False
+        self.thread = None
+        self.step_counter = 0
+        self.sample_bus = SampleBus(remote, sample_timeout, controller.params.center_cop)
+        # Ticks every params.dt by default, the period is fixed once the loop is built
+        self.scheduler = FixedRateScheduler(period if period is not None else controller.params.dt, spin)
+        # Steps are detected on the raw stream, not on the one averaged sample per tick
+        self.gait = GaitEventDetector(controller.params)
+        # New (params, steady-state gain) waiting for the next tick, see apply_params
+        self.pending_params = deque(maxlen=1)
+        # Sensor-to-belt latency of the speed commands, see latency_trace
+        self.tracer = LatencyTracer()
+        if controller.commands is not None:
+            controller.commands.tracer = self.tracer
+        if controller.predictor is not None:
+            # The prediction horizon follows the measured latency
+            controller.predictor.tracer = self.tracer
+        # Per-stage tick timings, disabled unless a profiler is passed in
+        self.profiler = profiler if profiler is not None else StageProfiler()
+        self.profile_path = None  # Base path the profile is dumped to when the loop stops
+
+    def start(self):
+        self.running = True
+        self.sample_bus.reset()
+        self.gait.reset()
+        self.scheduler.start()
+        self.thread = threading.Thread(target=self.run, name="control-loop", daemon=True)
+        self.thread.start()
+        self.profiler.start_sampling(self.thread.ident)
+
+    def stop(self):
+        self.running = False
+        if self.thread is not None:
+            # Let the current tick finish so it cannot queue a speed after the stop
+            self.thread.join(1.0)
+            self.thread = None
+        self.profiler.stop_sampling()
+        if self.controller.commands is not None:
+            self.controller.commands.cancel()
+        self.remote.stop_treadmill(0.2)
+        logger.info("Control loop timing: %s", self.scheduler.stats())
+        if self.controller.commands is not None:
+            logger.info("Speed commands: %s", self.controller.commands.stats())
+        logger.info("Steps: %d, cadence %s steps/min", self.gait.step_count, self.gait.cadence)
+        logger.info("Latency over the last %.0f s: %s", self.tracer.window, self.tracer.snapshot())
+        if self.profiler.enabled:
+            logger.info("Tick stages (us):\n%s", self.profiler.table())
+            if self.profile_path is not None:
+                self.profiler.dump(self.profile_path)
+
+    def run(self):
+        clock = time.perf_counter
+        sink = self.sink
+        profiler = self.profiler
+        while self.running:
+            tick_dt = self.scheduler.wait()
+            # Read once per tick: a disabled profiler costs one boolean test per stage
+            profiling = profiler.enabled
+            if profiling:
+                tick_start = lap = profiler.clock()
+            if self.pending_params:
+                self._swap_params(*self.pending_params.pop())
+
+            # One sample per tick, shared by the estimator, the display and the log
+            sample = self.sample_bus.acquire()
+            if profiling:
+                lap = profiler.lap('force_read', lap)
+            compute_start = clock()
+            self.detect_steps(sample)
+            if profiling:
+                lap = profiler.lap('gait', lap)
+            _, cop_avg, dcom, fz = self.estimator.update(sample, tick_dt)
+            if profiling:
+                lap = profiler.lap('kalman', lap)
+
+            # Keep showing the last sample while the force stream is silent
+            shown = sample if sample is not None else self.sample_bus.last_sample
+            copx, copy = (shown.copx, shown.copy) if shown is not None else (0.0, 0.0)
+
+            v_tm_tgt = self.controller.compute_target_speed(self.gait.in_stance, cop_avg, dcom, fz)
+            if profiling:
+                lap = profiler.lap('target', lap)
+            stamp = self.tracer.stamp(sample, compute_start, clock())
+            self.controller.update_treadmill_speed(v_tm_tgt, stamp)
+            if profiling:
+                lap = profiler.lap('command', lap)
+
+            treadmill_acceleration = (v_tm_tgt - self.controller.v_tm) / tick_dt
+            self.step_counter = self.gait.step_count
+
+            if sink is not None:
+                t = sample.t if sample is not None else None
+                sink.log_data(self.step_counter, self.controller.v_tm, treadmill_acceleration, copy, cop_avg, fz, t)
+                if profiling:
+                    lap = profiler.lap('log', lap)
+                # The GUI reads this on its own timer, no Qt call from this thread
+                sink.publish_state(self.controller.v_tm, copx, copy)
+                if profiling:
+                    lap = profiler.lap('publish', lap)
+            if profiling:
+                profiler.lap('tick', tick_start)
+
+    def apply_params(self, params):
+        """Switch to new ControllerParams between two ticks, from any thread.
+
+        The gains that depend on the parameters are computed here, on the
+        caller's thread. The control thread only swaps in the results.
+        ``dt`` cannot change, it is the period of the scheduler: a new one
+        is logged and ignored until the loop is rebuilt.
+        """
+        current_dt = self.controller.params.dt
+        if params.dt != current_dt:
+            logger.warning("dt cannot change while the loop runs, keeping %s s instead of %s s", current_dt, params.dt)
+            params = replace(params, dt=current_dt)
+        gain = None
+        if getattr(self.estimator, 'steady_state', False):
+            gain = steady_state_kalman_gain(params)
+        self.pending_params.append((params, gain))
+        if not self.running:
+            self._swap_params(*self.pending_params.pop())
+
+    def follow_config(self, config, base=None, section='controller'):
+        """Apply ``section`` of a ConfigStore, over ``base``, whenever the file changes.
+
+        Start ``config.watch()`` separately.
+        """
+        def reload(data):
+            try:
+                params = ControllerParams.from_dict(data.get(section), base)
+            except ValueError as e:
+                logger.error("Controller parameters not reloaded: %s", e)
+                return
+            if params != self.controller.params:
+                self.apply_params(params)
+        config.subscribe(reload)
+
+    def _swap_params(self, params, gain):
+        self.estimator.set_params(params, gain)
+        self.controller.set_params(params)
+        if self.controller.predictor is not None:
+            self.controller.predictor.tracer = self.tracer
+        self.gait.set_params(params)
+        self.sample_bus.center_cop = params.center_cop
+        logger.info("Controller parameters updated: %s", params)
+
+    def detect_steps(self, sample):
+        """Feed the gait detector with every sample received since the previous tick."""
+        buffer = self.remote.force_buffer
+        if buffer is not None:
+            return self.gait.follow(buffer)
+        if sample is not None:
+            return self.gait.update((sample.t,), (sample.fz,), (sample.copy,))
+        return []
@@ -0,0 +1,216 @@
+"""Control loop in its own process, so the GUI never shares a GIL with it.
+
+The child process owns the treadmill connection, the estimator, the
+controller and, while recording, the SessionRecorder. Every tick it writes
+its state into a SharedState block. The GUI reads that block whenever it
+redraws. Nothing is pickled or sent per tick. Start/stop/record requests
+go over a multiprocessing Pipe. The child stops the belts and exits as soon
+as that pipe breaks or the GUI process is gone, however the GUI died.
+"""
+import logging
+import multiprocessing
+import signal
+import sys
+import time
+from collections import namedtuple
+from multiprocessing import shared_memory
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+STATE_FIELDS = ('t', 'speed', 'acceleration', 'cop_x', 'cop_measured', 'cop_filtered', 'fz', 'step')
+ControlState = namedtuple('ControlState', STATE_FIELDS)
+
+PARENT_CHECK_INTERVAL = 0.1  # s between checks that the GUI process is still alive
+REQUEST_TIMEOUT = 10.0  # s, covers the child's initial connection
+
+
+class SharedState:
+    """Latest control state in shared memory, guarded by a seqlock.
+
+    The single writer makes the sequence number odd, writes the values in
+    place and makes it even again. A reader retries until it gets the same
+    even sequence number before and after copying the values, so it never
+    sees a half-written state and never blocks the writer. This relies on
+    the stores becoming visible in program order, as on x86.
+    """
+
+    def __init__(self, name=None):
+        size = 8 * (1 + len(STATE_FIELDS))
+        self.owner = name is None
+        self.memory = shared_memory.SharedMemory(name, create=self.owner, size=size)
+        self.name = self.memory.name
+        self.seq = np.ndarray(1, np.int64, self.memory.buf)
+        self.values = np.ndarray(len(STATE_FIELDS), np.float64, self.memory.buf, 8)
+        if self.owner:
+            self.seq[0] = 0
+            self.values[:] = np.nan
+
+    def write(self, values):
+        self.seq[0] += 1
+        self.values[:] = values
+        self.seq[0] += 1
+
+    def read(self):
+        """(number of writes so far, ControlState), None as state before the first write."""
+        while True:
+            before = int(self.seq[0])
+            if before & 1:
+                continue  # Write in progress
+            values = self.values.tolist()
+            if int(self.seq[0]) == before:
+                return before // 2, (ControlState(*values) if before else None)
+
+    def close(self):
+        # numpy views must be released before the block can be closed
+        self.seq = self.values = None
+        self.memory.close()
+        if self.owner:
+            self.memory.unlink()
+
+
+class SharedStateSink:
+    """ControlLoop sink writing every tick to a SharedState, and to a SessionRecorder while recording."""
+
+    def __init__(self, state):
+        self.state = state
+        self.recorder = None
+        self.tick = None
+
+    def log_data(self, step, treadmill_speed, treadmill_acceleration, cop_measured, cop_estimated, fz=0.0, t=None):
+        # Ticks without a force sample still get a time, the recorded time column has no NaN
+        t = time.perf_counter() if t is None else t
+        self.tick = (t, treadmill_speed, treadmill_acceleration, cop_measured, cop_estimated, fz, step)
+        recorder = self.recorder
+        if recorder is not None:
+            recorder.record_tick(t, step, treadmill_speed, treadmill_acceleration, cop_measured, cop_estimated, fz)
+
+    def publish_state(self, speed, cop_x, cop_y):
+        t, speed, acceleration, cop_measured, cop_filtered, fz, step = self.tick
+        self.state.write((t, speed, acceleration, cop_x, cop_measured, cop_filtered, fz, step))
+
+
+def _run_control_process(conn, state_name, connection, steady_state, config_path):
+    # Imported here, so that only the child pays for them
+    from config_store import ConfigStore
+    from control_loop import ControlLoop, connect
+    from controller import ControllerParams, FastStateEstimator, LQGController
+    from logging_setup import setup_logging
+    from session_recorder import SessionRecorder
+
+    # Ctrl+C reaches the whole process group, the GUI decides when to stop
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    setup_logging(logging.INFO)
+
+    state = SharedState(state_name)
+    sink = SharedStateSink(state)
+    remote, supervisor = connect(**connection)
+    # Read only here, the GUI owns the file
+    config = ConfigStore(config_path) if config_path is not None else None
+    params = ControllerParams.from_dict(config.get('controller') if config is not None else None)
+    controller = LQGController(params, remote=remote)
+    loop = ControlLoop(remote, FastStateEstimator(params, steady_state=steady_state), controller, sink=sink)
+    if config is not None:
+        loop.follow_config(config)
+        config.watch()
+    parent = multiprocessing.parent_process()
+
+    try:
+        while parent is None or parent.is_alive():
+            if not conn.poll(PARENT_CHECK_INTERVAL):
+                continue
+            try:
+                command, *args = conn.recv()
+            except EOFError:
+                break  # The GUI process is gone
+
+            result = None
+            if command == 'start':
+                if not loop.running:
+                    loop.start()
+            elif command == 'stop':
+                if loop.running:
+                    loop.stop()
+                result = {'timing': loop.scheduler.stats(), 'commands': controller.commands.stats(),
+                          'connection': supervisor.status(),
+                          'steps': loop.gait.step_count, 'cadence': loop.gait.cadence}
+            elif command == 'start_recording':
+                sink.recorder = SessionRecorder(args[0], remote.force_buffer, tracer=loop.tracer,
+                                                gait=loop.gait)
+            elif command == 'stop_recording':
+                recorder, sink.recorder = sink.recorder, None
+                if recorder is not None:
+                    recorder.close()
+                    result = recorder.base_path
+            elif command == 'shutdown':
+                conn.send(None)
+                break
+            conn.send(result)
+    finally:
+        # Whatever ended the process, the belts are stopped
+        loop.stop()
+        if config is not None:
+            config.close()
+        if sink.recorder is not None:
+            sink.recorder.close()
+        controller.commands.close()
+        supervisor.stop()
+        remote.stop_connection()
+        state.close()
+
+
+class ControlProcess:
+    """GUI-side handle of the control process.
+
+    ``connection`` is passed on to ``start_connection`` in the child
+    (server_ip, rpc_port, ...). With ``config_path``, the child takes its
+    ControllerParams from the "controller" section of that file and follows
+    its changes.
+    """
+
+    def __init__(self, steady_state=False, config_path=None, **connection):
+        self.state = SharedState()
+        # spawn rather than fork: forking a process that runs Qt is not safe
+        context = multiprocessing.get_context('spawn')
+        self.conn, child_conn = context.Pipe()
+        self.process = context.Process(target=_run_control_process, name="control-process", daemon=True,
+                                       args=(child_conn, self.state.name, connection, steady_state, config_path))
+        self.process.start()
+        child_conn.close()
+
+    def request(self, command, *args, timeout=REQUEST_TIMEOUT):
+        self.conn.send((command,) + args)
+        if not self.conn.poll(timeout):
+            raise TimeoutError(f"No answer from the control process to {command!r}")
+        return self.conn.recv()
+
+    def start(self):
+        self.request('start')
+
+    def stop(self):
+        """Stop the loop and the belts, returns the loop, command and connection statistics."""
+        return self.request('stop')
+
+    def start_recording(self, base_path):
+        self.request('start_recording', base_path)
+
+    def stop_recording(self):
+        """Close the recording, returns its base path."""
+        return self.request('stop_recording')
+
+    def snapshot(self):
+        """(tick count, latest ControlState or None), without any call to the child."""
+        return self.state.read()
+
+    def close(self):
+        if self.process.is_alive():
+            try:
+                self.request('shutdown')
+            except (OSError, EOFError, TimeoutError):
+                pass
+            self.process.join(5)
+            if self.process.is_alive():
+                self.process.terminate()
+        self.conn.close()
+        self.state.close()
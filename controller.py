@@ -0,0 +1,427 @@
+import hashlib
+import json
+import logging
+import math
+import os
+import numpy as np
+from collections import deque
+from dataclasses import dataclass, fields, replace
+from command_coalescer import CommandCoalescer
+
+logger = logging.getLogger(__name__)
+
+# Solved LQR/Kalman gains, so that SciPy is only imported when a model or
+# weight matrix changes. TREADMILL_GAIN_CACHE overrides the location.
+GAIN_CACHE = os.environ.get('TREADMILL_GAIN_CACHE',
+                            os.path.join(os.path.dirname(os.path.abspath(__file__)), "gain_cache.json"))
+
+CENTER_COP = 0.8  # Treadmill center position on the y-axis (usually ~0.7-0.8)
+dt = 0.01  # Time step (10 ms)
+COMMAND_DELAY = 0.1  # Minimum delay between speed commands sent to the treadmill
+DECELERATION_SMOOTHING = 0.25  # Smoothing factor when decelerating
+
+# System model for COP
+A = np.array([[1, dt],
+              [0, 1]])
+B = np.array([[0],
+              [1]])
+C = np.array([[1, 0]])
+
+# LQR weights, the gain K is computed on first use (see __getattr__)
+Q = np.diag([30, 10])
+R = np.array([[0.05]])
+
+# Kalman filter parameters
+Q_kalman = np.diag([0.01, 0.01])
+R_kalman = np.array([[0.05]])
+P_k = np.eye(2)
+
+_gain_cache = None
+
+
+def cached_gain(kind, matrices, solve):
+    """Return ``solve(*matrices)``, read from the on-disk gain cache when possible.
+
+    The key is a hash of ``kind`` and the shape and exact values of every
+    matrix, so any change to the model or the weights is a cache miss.
+    """
+    global _gain_cache
+    arrays = [np.asarray(matrix, dtype=float) for matrix in matrices]
+    digest = hashlib.sha256(kind.encode())
+    for array in arrays:
+        digest.update(str(array.shape).encode())
+        digest.update(array.tobytes())
+    key = digest.hexdigest()
+
+    if _gain_cache is None:
+        try:
+            with open(GAIN_CACHE) as file:
+                _gain_cache = json.load(file)
+        except (OSError, ValueError):
+            _gain_cache = {}
+    if key in _gain_cache:
+        return np.array(_gain_cache[key])
+
+    gain = np.asarray(solve(*arrays), dtype=float)
+    _gain_cache[key] = gain.tolist()
+    try:
+        with open(GAIN_CACHE + ".tmp", "w") as file:
+            json.dump(_gain_cache, file)
+        os.replace(GAIN_CACHE + ".tmp", GAIN_CACHE)
+    except OSError as e:
+        logger.debug("Could not write the gain cache %s: %s", GAIN_CACHE, e)
+    return gain
+
+
+def _solve_lqr(A, B, Q, R):
+    import scipy.linalg  # Only needed on a cache miss
+    P = scipy.linalg.solve_discrete_are(A, B, Q, R)
+    return np.linalg.inv(B.T @ P @ B + R) @ (B.T @ P @ A)
+
+
+def _solve_steady_state_kalman(A, C, Q, R):
+    import scipy.linalg  # Only needed on a cache miss
+    # A priori covariance of the converged filter, from the dual Riccati equation
+    P_ss = scipy.linalg.solve_discrete_are(A.T, C.T, Q, R)
+    S_ss = P_ss[0, 0] + R[0, 0]
+    return [P_ss[0, 0] / S_ss, P_ss[1, 0] / S_ss]
+
+
+def lqr_gain(A=A, B=B, Q=Q, R=R):
+    """Discrete LQR state feedback gain for the COP model."""
+    return cached_gain('lqr', (A, B, Q, R), _solve_lqr)
+
+
+def __getattr__(name):
+    # K used to be solved at import time, it is now only computed when accessed
+    if name == 'K':
+        return lqr_gain()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+@dataclass
+class ControllerParams:
+    """Tunable estimator/controller parameters, defaulting to the constants above."""
+    center_cop: float = CENTER_COP
+    dt: float = dt
+    command_delay: float = COMMAND_DELAY
+    deceleration_smoothing: float = DECELERATION_SMOOTHING
+    q_kalman: tuple = (0.01, 0.01)  # Process noise on (COP, COP velocity)
+    r_kalman: float = 0.05  # COP measurement noise
+    fz_threshold: float = 20  # fz above which the foot is considered on the plate
+    fz_release: float = 10  # fz below which it is considered off again, see gait_events
+    min_stance: float = 0.15  # s, shorter stances are not counted as steps
+    fz_high: float = 50  # fz above which the speed target is raised
+    fz_low: float = 25  # fz below which the speed target is lowered
+    min_v: float = 0.4
+    max_v: float = 2.0
+    predict_latency: bool = False  # Smith predictor stage before compute_target_speed, see SmithPredictor
+    command_latency: float = 0.05  # s, sensor-to-belt latency assumed by the predictor until measured
+    belt_response_time: float = 0.2  # s, added to the latency for the ramp of the belts to a new speed
+
+    @classmethod
+    def from_dict(cls, values, base=None):
+        """Parameters from a {field: value} dict, e.g. the "controller" section of config.json.
+
+        Missing fields keep the value of ``base`` (default: the defaults),
+        unknown ones are logged and ignored. Values are converted to the type
+        of their field ("2.0" -> 2.0). If any of them cannot be, ValueError
+        names every bad field and no parameter is changed.
+        """
+        base = base if base is not None else cls()
+        known = {field.name: field.type for field in fields(cls)}
+        changes, errors = {}, []
+        for name, value in (values or {}).items():
+            if name not in known:
+                logger.warning("Unknown controller parameter %r ignored", name)
+                continue
+            try:
+                changes[name] = _convert(value, known[name], getattr(base, name))
+            except (TypeError, ValueError) as e:
+                errors.append(f"{name}={value!r}: {e}")
+        if errors:
+            raise ValueError("Invalid controller parameters: " + "; ".join(errors))
+        return replace(base, **changes)
+
+
+def _convert(value, kind, current):
+    """``value`` as the declared type ``kind`` of a ControllerParams field whose value is ``current``."""
+    if kind is bool:
+        if isinstance(value, str) and value.lower() in ('true', 'false'):
+            return value.lower() == 'true'
+        if isinstance(value, (bool, int)) and value in (0, 1):
+            return bool(value)
+        raise ValueError("expected true or false")
+    if isinstance(value, bool):
+        # float(True) would silently be 1.0
+        raise ValueError(f"expected a number, got {value}")
+    if kind is tuple:
+        if isinstance(value, str) or len(value) != len(current):
+            raise ValueError(f"expected {len(current)} numbers")
+        return tuple(_convert(item, float, None) for item in value)
+    number = float(value)
+    if not math.isfinite(number):
+        raise ValueError("expected a finite number")
+    return number
+
+
+class StateEstimator:
+    def __init__(self, params=None):
+        self.set_params(params if params is not None else ControllerParams())
+        self.X_k = np.array([[self.params.center_cop], [0]])
+        self.P_k = P_k
+
+    def set_params(self, params, gain=None):
+        """Use new parameters from the next update on, keeping the filter state."""
+        self.params = params
+        self.A = np.array([[1, params.dt], [0, 1]])
+        self.Q_kalman = np.diag(params.q_kalman)
+        self.R_kalman = np.array([[params.r_kalman]])
+        self.fz_threshold = params.fz_threshold
+
+    def read_forces(self, sample):
+        """Extract fz and the antero-posterior COP from this tick's sample."""
+        if sample is None:
+            logger.warning("No force data received. Check the connection.")
+            return 0, self.params.center_cop
+
+        return sample.fz, sample.copy
+
+    def kalman_update(self, cop_measured, dt_k=None):
+        """Kalman filter update step, over the real elapsed dt_k if given."""
+        A_k = self.A if dt_k is None else np.array([[1, dt_k], [0, 1]])
+        X_k_pred = A_k @ self.X_k
+        P_k_pred = A_k @ self.P_k @ A_k.T + self.Q_kalman
+
+        S_k = C @ P_k_pred @ C.T + self.R_kalman
+        K_kalman = P_k_pred @ C.T @ np.linalg.inv(S_k)
+        self.X_k = X_k_pred + K_kalman @ (cop_measured - C @ X_k_pred)
+        self.P_k = (np.eye(2) - K_kalman @ C) @ P_k_pred
+
+        return self.X_k
+
+    def update(self, sample, dt_k=None):
+        fz, cop_measured = self.read_forces(sample)
+        X_k = self.kalman_update(cop_measured, dt_k)
+
+        flag_step = fz > self.fz_threshold
+        cop_avg = X_k[0, 0]
+        dcom = X_k[1, 0]
+
+        return flag_step, cop_avg, dcom, fz
+
+
+class FastStateEstimator(StateEstimator):
+    """Allocation-free version of StateEstimator.
+
+    The 2x2 covariance recursion is written out in scalar arithmetic, which
+    gives the same estimates as the matrix reference without any per-tick
+    NumPy call. With steady_state=True the covariance is not propagated at
+    all: the converged Kalman gain for the nominal dt is precomputed once.
+    """
+
+    def __init__(self, params=None, steady_state=False):
+        self.steady_state = steady_state
+        super().__init__(params)
+        self.x = float(self.params.center_cop)
+        self.v = 0.0
+        self.p00, self.p01, self.p11 = (float(value) for value in (P_k[0, 0], P_k[0, 1], P_k[1, 1]))
+
+    def set_params(self, params, gain=None):
+        """Same as StateEstimator.set_params. ``gain`` is the steady-state gain for ``params``, if precomputed."""
+        super().set_params(params)
+        self.q0, self.q1 = (float(value) for value in params.q_kalman)
+        self.r = float(params.r_kalman)
+        self.dt = float(params.dt)
+        if self.steady_state:
+            self.k0, self.k1 = gain if gain is not None else steady_state_kalman_gain(params)
+
+    def kalman_update(self, cop_measured, dt_k=None):
+        """Kalman filter update step on scalars, returns (cop, dcop)."""
+        if dt_k is None:
+            dt_k = self.dt
+
+        x_pred = self.x + dt_k * self.v
+        innovation = cop_measured - x_pred
+
+        if self.steady_state:
+            k0, k1 = self.k0, self.k1
+        else:
+            p00, p01, p11 = self.p00, self.p01, self.p11
+            p00_pred = p00 + dt_k * (2 * p01 + dt_k * p11) + self.q0
+            p01_pred = p01 + dt_k * p11
+            p11_pred = p11 + self.q1
+
+            s_k = p00_pred + self.r
+            k0 = p00_pred / s_k
+            k1 = p01_pred / s_k
+
+            self.p00 = (1 - k0) * p00_pred
+            self.p01 = (1 - k0) * p01_pred
+            self.p11 = p11_pred - k1 * p01_pred
+
+        self.x = x_pred + k0 * innovation
+        self.v = self.v + k1 * innovation
+        return self.x, self.v
+
+    def update(self, sample, dt_k=None):
+        fz, cop_measured = self.read_forces(sample)
+        cop_avg, dcom = self.kalman_update(cop_measured, dt_k)
+
+        return fz > self.fz_threshold, cop_avg, dcom, fz
+
+
+def steady_state_kalman_gain(params):
+    """Converged Kalman gain (k0, k1) for the nominal dt of ``params``."""
+    A_nominal = np.array([[1, params.dt], [0, 1]])
+    k0, k1 = cached_gain('steady_state_kalman', (A_nominal, C, np.diag(params.q_kalman), [[params.r_kalman]]),
+                         _solve_steady_state_kalman)
+    return float(k0), float(k1)
+
+
+class SmithPredictor:
+    """Predicts the COP state at the time the next speed command takes effect.
+
+    The estimated state is already old when a command computed from it
+    reaches the belts: the sample waited for the tick, the command waits
+    for the rate limit and the RPC, and the belts then ramp at the commanded
+    acceleration. The horizon is that latency plus ``belt_response_time``.
+    The state is propagated over it with the COP model
+    (cop += horizon * dcom). The belt speed changes commanded within the
+    horizon are not yet visible in the measured COP. Their effect is
+    subtracted through a model of the belt response: the belts follow the
+    commanded speed at ``deceleration_smoothing`` m/s^2, the acceleration
+    sent with every command, and a faster belt carries the subject
+    backwards.
+
+    The latency is the measured sensor-to-actuation p50 of ``tracer``
+    (refreshed every LATENCY_REFRESH ticks) once commands have been
+    acknowledged, ``command_latency`` until then.
+    """
+
+    LATENCY_REFRESH = 100  # ticks
+    MAX_HORIZON = 1.0  # s
+
+    def __init__(self, params=None, tracer=None):
+        self.params = params if params is not None else ControllerParams()
+        self.tracer = tracer
+        self.latency = self.params.command_latency
+        self.commanded = self.belt = None
+        # Modelled belt speed of the last MAX_HORIZON seconds, newest last
+        self.history = deque(maxlen=int(round(self.MAX_HORIZON / self.params.dt)) + 1)
+        self.ticks = 0
+
+    @property
+    def horizon(self):
+        return min(self.latency + self.params.belt_response_time, self.MAX_HORIZON)
+
+    def command(self, speed):
+        """A new speed was handed to the command stage."""
+        self.commanded = speed
+        if self.belt is None:
+            self.belt = speed
+
+    def advance(self):
+        """Move the belt model by one tick, call once per tick."""
+        self.ticks += 1
+        if self.tracer is not None and self.ticks % self.LATENCY_REFRESH == 0:
+            measured = self.tracer.percentile('sensor_to_actuation', 50)
+            if measured is not None:
+                self.latency = measured
+
+        if self.belt is None:
+            return
+        step = self.params.deceleration_smoothing * self.params.dt
+        self.belt += max(-step, min(step, self.commanded - self.belt))
+        self.history.append(self.belt)
+
+    def predict(self, cop, dcom):
+        """(cop, dcom) expected ``horizon`` seconds from now."""
+        horizon = self.horizon
+        n = min(int(round(horizon / self.params.dt)), len(self.history) - 1)
+        if n <= 0:
+            return cop + horizon * dcom, dcom
+        # The measured COP reflects the belt as it was one horizon ago
+        seen = self.history[-1 - n]
+        history = self.history
+        unseen = 0.0
+        for i in range(len(history) - n, len(history)):
+            unseen += history[i] - seen
+        return cop + horizon * dcom - unseen * self.params.dt, dcom - (history[-1] - seen)
+
+
+class LQGController:
+    def __init__(self, params=None, remote=None, commands=None, predictor=None):
+        self.params = params if params is not None else ControllerParams()
+        self.min_v = self.params.min_v
+        self.max_v = self.params.max_v
+        self.v_tm = self.min_v
+        # Latest-wins command stage, rate limited to command_delay. Without a
+        # remote or a command sink the controller only tracks v_tm.
+        if commands is None and remote is not None:
+            commands = CommandCoalescer(remote, self.params.command_delay)
+        self.commands = commands
+        if predictor is None and self.params.predict_latency:
+            predictor = SmithPredictor(self.params)
+        self.predictor = predictor
+
+    def set_params(self, params):
+        """Use new parameters from the next tick on."""
+        self.params = params
+        self.min_v = params.min_v
+        self.max_v = params.max_v
+        if self.commands is not None and hasattr(self.commands, 'min_interval'):
+            self.commands.min_interval = params.command_delay
+        if params.predict_latency and self.predictor is None:
+            self.predictor = SmithPredictor(params)
+        elif not params.predict_latency:
+            self.predictor = None
+        if self.predictor is not None:
+            self.predictor.params = params
+
+    def compute_target_speed(self, flag_step, cop_avg, dcom, fz):
+        """Compute treadmill speed from estimated COP.
+
+        The target is only updated while ``flag_step`` is set, i.e. while a
+        foot is in stance (see gait_events). With a predictor, the target is
+        computed from the state predicted for when the command takes effect.
+        """
+        predictor = self.predictor
+        if predictor is not None:
+            predictor.advance()
+        if not flag_step:
+            return self.v_tm
+
+        params = self.params
+        if predictor is not None:
+            cop_avg, dcom = predictor.predict(cop_avg, dcom)
+        v_target = 1.0 + 1.5 * (cop_avg - params.center_cop) + params.center_cop * dcom
+
+        if fz > params.fz_high:
+            v_target += 0.15
+        elif fz < params.fz_low:
+            v_target -= 0.1
+
+        v_target = min(max(v_target, self.min_v), self.max_v)
+
+        # Apply smoothing when decelerating
+        if v_target < self.v_tm:
+            smoothing = params.deceleration_smoothing
+            v_target = self.v_tm * (1 - smoothing) + v_target * smoothing
+
+        return v_target
+
+    def update_treadmill_speed(self, v_tm_tgt, stamp=None):
+        """Hand the new speed to the command coalescer, which rate limits the sends.
+
+        ``stamp`` is the TickStamp of the tick that computed it, see latency_trace.
+        """
+        if abs(v_tm_tgt - self.v_tm) < 0.01:
+            return
+
+        self.v_tm = v_tm_tgt
+        if self.predictor is not None:
+            self.predictor.command(v_tm_tgt)
+        if self.commands is not None:
+            smoothing = f"{self.params.deceleration_smoothing:.2f}"
+            self.commands.set_belts(f"{self.v_tm:.2f}", smoothing, smoothing, stamp)
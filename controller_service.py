@@ -0,0 +1,104 @@
+"""Headless controller service.
+
+Runs the estimator, the LQG controller and the treadmill connection without
+any GUI, and broadcasts the state with a StatePublisher. GUIs, loggers and
+dashboards attach as subscribers, e.g. ``python treadmill_remote.py --attach
+tcp://host:5570``, so the Bertec server sees a single client however many
+viewers there are. The loop starts immediately. Ctrl+C stops the belts and
+exits.
+
+    python controller_service.py --publish tcp://*:5570 --rate 50
+    python controller_service.py --watch tcp://127.0.0.1:5570
+"""
+import argparse
+import logging
+import signal
+import threading
+
+from config_store import ConfigStore, CONFIG_FILE
+from control_loop import ControlLoop, connect
+from controller import ControllerParams, FastStateEstimator, LQGController
+from logging_setup import setup_logging
+from stage_profiler import StageProfiler
+from state_publisher import DEFAULT_ENDPOINT, StatePublisher, StateSubscriber
+
+logger = logging.getLogger(__name__)
+
+
+def serve(args):
+    remote, supervisor = connect(server_ip=args.server_ip, rpc_port=str(args.rpc_port),
+                                 data_port=str(args.data_port))
+    config = ConfigStore(args.config)
+    base = ControllerParams(predict_latency=args.predict_latency)
+    params = ControllerParams.from_dict(config.get('controller'), base)
+    controller = LQGController(params, remote=remote)
+    profiler = StageProfiler(True, args.profile_samples) if args.profile else None
+    loop = ControlLoop(remote, FastStateEstimator(params, steady_state=args.steady_state), controller,
+                       profiler=profiler)
+    loop.profile_path = args.profile
+    # Edits of the "controller" section are applied between two ticks
+    loop.follow_config(config, base)
+    config.watch()
+    publisher = StatePublisher(args.publish, args.rate, loop.tracer)
+    loop.sink = publisher
+
+    stop = threading.Event()
+    signal.signal(signal.SIGINT, lambda *_: stop.set())
+    signal.signal(signal.SIGTERM, lambda *_: stop.set())
+    if args.profile and hasattr(signal, 'SIGUSR1'):
+        # kill -USR1 <pid> dumps the profile so far
+        signal.signal(signal.SIGUSR1, lambda *_: profiler.dump(args.profile))
+
+    publisher.start()
+    loop.start()
+    logger.info("Controller running, state published on %s at %g Hz", args.publish, args.rate)
+    while not stop.wait(1.0):
+        pass
+
+    loop.stop()
+    config.close()
+    publisher.stop()
+    controller.commands.close()
+    supervisor.stop()
+    remote.stop_connection()
+
+
+def watch(args):
+    subscriber = StateSubscriber(args.watch)
+    try:
+        while True:
+            state = subscriber.receive()
+            if state is not None:
+                print(f"step {state.step:6d}  speed {state.speed:5.2f} m/s  COP {state.cop_filtered:5.3f} m  "
+                      f"fz {state.fz:7.1f} N  latency p50 {state.latency_p50_ms:6.2f} ms "
+                      f"p99 {state.latency_p99_ms:6.2f} ms")
+    except KeyboardInterrupt:
+        subscriber.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Headless treadmill controller with a state publisher.")
+    parser.add_argument("--publish", default=DEFAULT_ENDPOINT, help="Endpoint the state is published on")
+    parser.add_argument("--rate", type=float, default=50.0, help="State messages per second")
+    parser.add_argument("--server-ip", default="127.0.0.1", help="Bertec server address")
+    parser.add_argument("--rpc-port", type=int, default=5555)
+    parser.add_argument("--data-port", type=int, default=5556)
+    parser.add_argument("--steady-state", action="store_true", help="Use the precomputed steady-state Kalman gain")
+    parser.add_argument("--config", default=CONFIG_FILE,
+                        help="JSON file whose \"controller\" section overrides the controller parameters")
+    parser.add_argument("--predict-latency", action="store_true",
+                        help="Compensate the command latency with the Smith predictor")
+    parser.add_argument("--profile", metavar="BASE_PATH",
+                        help="Time every stage of the control tick and write the percentiles to "
+                             "BASE_PATH.stages.txt on exit or on SIGUSR1")
+    parser.add_argument("--profile-samples", type=float, metavar="INTERVAL",
+                        help="With --profile, also sample the control thread stack every INTERVAL seconds "
+                             "into BASE_PATH.collapsed, for flame graphs")
+    parser.add_argument("--watch", metavar="ENDPOINT", help="Print the state published by a running service instead")
+    args = parser.parse_args()
+
+    if args.watch:
+        watch(args)
+    else:
+        setup_logging(logging.INFO)
+        serve(args)
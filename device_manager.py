@@ -0,0 +1,257 @@
+"""Several treadmills (or force plates) driven from one process.
+
+Every AsyncRemoteControl normally has its own ZMQ context, an RPC I/O
+thread and a force ingestion thread, so N devices cost 2N I/O threads.
+DeviceManager puts all devices on one shared context and a single
+SharedIOLoop thread. That thread multiplexes every DEALER (RPC) and SUB
+(force) socket through one zmq.Poller. Each device still gets its own
+ControlLoop, with its own estimator and controller, and a
+ConnectionSupervisor if asked for:
+
+    manager = DeviceManager()
+    manager.add('left', server_ip='10.0.0.2')
+    manager.add('right', server_ip='10.0.0.3')
+    manager.start()
+    ...
+    manager.close()
+
+A ManagedRemoteControl is used like an AsyncRemoteControl. Its requests
+return Futures. Only the shared thread touches its sockets while they are
+registered. Registration changes are handed to that thread with
+``SharedIOLoop.call``.
+"""
+import logging
+import socket
+import threading
+from collections import deque, namedtuple
+from concurrent.futures import Future
+import zmq
+
+import BertecRemoteControl
+from connection_supervisor import ConnectionSupervisor
+from control_loop import ControlLoop
+from controller import ControllerParams, FastStateEstimator, LQGController
+from force_buffer import ForceRingBuffer
+
+logger = logging.getLogger(__name__)
+
+Device = namedtuple('Device', ['name', 'remote', 'loop', 'supervisor'])
+
+HEARTBEAT_PORT = 5560  # Client port of the first device, the next ones count up from it
+
+
+class SharedIOLoop:
+    """One thread and one zmq.Poller serving the sockets of many ManagedRemoteControl."""
+
+    IO_POLL_TIMEOUT = 100  # ms, upper bound between timeout checks
+
+    def __init__(self, context=None):
+        self.owns_context = context is None
+        self.context = zmq.Context() if context is None else context
+        self.poller = zmq.Poller()
+        self.handlers = {}  # socket -> called on the I/O thread when the socket is readable
+        self.devices = []  # Devices with an RPC socket, their queues are served after every poll
+        self.calls = deque()  # (function, future) to run on the I/O thread
+        self.wake_read, self.wake_write = socket.socketpair()
+        self.wake_read.setblocking(False)
+        self.wake_write.setblocking(False)
+        self.poller.register(self.wake_read.fileno(), zmq.POLLIN)
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def start(self):
+        if self.thread is not None:
+            return
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self.run, name="shared-io", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """Stop the thread. Close the devices first."""
+        if self.thread is None:
+            return
+        self.stop_event.set()
+        self.wake()
+        self.thread.join()
+        self.thread = None
+        # Calls queued while the thread was exiting
+        self._run_calls()
+
+    def close(self):
+        self.stop()
+        self.poller.unregister(self.wake_read.fileno())
+        self.wake_read.close()
+        self.wake_write.close()
+        if self.owns_context:
+            self.context.term()
+
+    def wake(self):
+        try:
+            self.wake_write.send(b'\0')
+        except BlockingIOError:
+            pass  # The pair is full, so a wake-up is already pending
+
+    def call(self, function):
+        """Run ``function`` on the I/O thread and return its result.
+
+        Called from the I/O thread itself, or while it is not running,
+        ``function`` runs right away.
+        """
+        if self.thread is None or threading.current_thread() is self.thread:
+            return function()
+        future = Future()
+        self.calls.append((function, future))
+        self.wake()
+        return future.result()
+
+    def register(self, sock, handler):
+        """Call ``handler()`` on the I/O thread whenever ``sock`` is readable."""
+        def add():
+            self.poller.register(sock, zmq.POLLIN)
+            self.handlers[sock] = handler
+        self.call(add)
+
+    def unregister(self, sock):
+        def remove():
+            if self.handlers.pop(sock, None) is not None:
+                self.poller.unregister(sock)
+        self.call(remove)
+
+    def add_rpc(self, device):
+        def add():
+            self.poller.register(device.req_socket, zmq.POLLIN)
+            self.handlers[device.req_socket] = device._receive_responses
+            self.devices.append(device)
+        self.call(add)
+
+    def remove_rpc(self, device):
+        def remove():
+            if device in self.devices:
+                self.devices.remove(device)
+                self.poller.unregister(device.req_socket)
+                del self.handlers[device.req_socket]
+            device._fail_pending()
+        self.call(remove)
+
+    def run(self):
+        wake_fd = self.wake_read.fileno()
+        while not self.stop_event.is_set():
+            events = dict(self.poller.poll(self._poll_timeout()))
+            if wake_fd in events:
+                try:
+                    self.wake_read.recv(4096)
+                except BlockingIOError:
+                    pass
+            self._run_calls()
+            for sock in events:
+                handler = self.handlers.get(sock)
+                if handler is not None:
+                    self._guarded(handler)
+            for device in self.devices:
+                self._guarded(device._send_queued)
+                self._guarded(device._expire_pending)
+
+    def _guarded(self, function):
+        # One broken device must not stop the I/O of the others
+        try:
+            function()
+        except Exception:
+            logger.exception("Shared I/O handler failed")
+
+    def _run_calls(self):
+        while self.calls:
+            function, future = self.calls.popleft()
+            try:
+                future.set_result(function())
+            except Exception as exc:
+                future.set_exception(exc)
+
+    def _poll_timeout(self):
+        return min([self.IO_POLL_TIMEOUT] + [device._poll_timeout() for device in self.devices])
+
+
+class ManagedRemoteControl(BertecRemoteControl.AsyncRemoteControl):
+    """AsyncRemoteControl whose sockets live on the context and thread of a SharedIOLoop."""
+
+    def __init__(self, io):
+        self.io = io
+
+    def start_connection(self, *args, **kwargs):
+        kwargs['context'] = self.io.context
+        return super().start_connection(*args, **kwargs)
+
+    def _start_io(self):
+        self.io.add_rpc(self)
+
+    def _stop_io(self):
+        self.io.remove_rpc(self)
+
+    def _wake(self):
+        self.io.wake()
+
+    def start_force_stream(self, capacity=None):
+        if self.force_buffer is not None:
+            return self.force_buffer
+        self.force_buffer = ForceRingBuffer(capacity or self.STREAM_BUFFER_SIZE, self.FORCE_FIELDS)
+        self.io.register(self.sub_socket, self._drain_forces)
+        return self.force_buffer
+
+    def stop_force_stream(self):
+        if self.force_buffer is not None:
+            self.io.unregister(self.sub_socket)
+
+
+class DeviceManager:
+    """Devices on one SharedIOLoop, each with its own estimator, controller and ControlLoop."""
+
+    def __init__(self, context=None):
+        self.io = SharedIOLoop(context)
+        self.io.start()
+        self.devices = {}
+
+    def add(self, name, params=None, steady_state=False, sink=None, supervise=True, **connection):
+        """Connect device ``name`` and build its control loop. Returns its Device.
+
+        ``connection`` is passed on to ``start_connection`` (server_ip,
+        rpc_port, data_port, ...). Without a ``client_port``, every device
+        gets its own heartbeat port counting up from HEARTBEAT_PORT.
+        """
+        if name in self.devices:
+            raise ValueError(f"Device {name!r} already exists")
+        connection.setdefault('client_port', str(HEARTBEAT_PORT + len(self.devices)))
+        remote = ManagedRemoteControl(self.io)
+        remote.start_connection(stream_forces=True, **connection)
+        supervisor = None
+        if supervise:
+            supervisor = ConnectionSupervisor(remote)
+            supervisor.start()
+        params = params if params is not None else ControllerParams()
+        controller = LQGController(params, remote=remote)
+        loop = ControlLoop(remote, FastStateEstimator(params, steady_state=steady_state), controller, sink=sink)
+        device = self.devices[name] = Device(name, remote, loop, supervisor)
+        logger.info("Device %s added on %s:%s", name, remote.server_ip, remote.rpc_port)
+        return device
+
+    def start(self):
+        for device in self.devices.values():
+            device.loop.start()
+
+    def stop(self):
+        """Stop every control loop, which stops the belts."""
+        for device in self.devices.values():
+            device.loop.stop()
+
+    def remove(self, name):
+        device = self.devices.pop(name)
+        if device.loop.running:
+            device.loop.stop()
+        if device.loop.controller.commands is not None:
+            device.loop.controller.commands.close()
+        if device.supervisor is not None:
+            device.supervisor.stop()
+        device.remote.stop_connection()
+
+    def close(self):
+        for name in list(self.devices):
+            self.remove(name)
+        self.io.close()
@@ -0,0 +1,91 @@
+import threading
+import numpy as np
+
+
+class ForceRingBuffer:
+    """Fixed-size ring buffer of timestamped force samples.
+
+    Every sample is written twice, at ``i`` and ``i + capacity``, so the last
+    ``n`` samples always form one contiguous slice of the backing array and
+    ``latest``/``window``/``since`` can return views instead of copies.
+    A view stays valid until ``capacity - n`` newer samples have been pushed;
+    copy it if it has to outlive that.
+    """
+
+    FIELDS = ('t', 'fz', 'copx', 'copy')
+
+    def __init__(self, capacity=8192, fields=FIELDS):
+        if fields[0] != 't':
+            raise ValueError("The first field must be the timestamp 't'")
+
+        self.capacity = int(capacity)
+        self.fields = tuple(fields)
+        self.columns = {name: index for index, name in enumerate(self.fields)}
+        self._data = np.zeros((2 * self.capacity, len(self.fields)))
+        self._count = 0  # Total number of samples ever pushed
+        self._write_lock = threading.Lock()
+        self._new_sample = threading.Condition(self._write_lock)
+
+    def __len__(self):
+        return min(self._count, self.capacity)
+
+    @property
+    def count(self):
+        """Total number of samples pushed since creation (monotonic)."""
+        return self._count
+
+    def push(self, t, values):
+        """Append one sample. ``values`` follows ``fields[1:]``."""
+        with self._write_lock:
+            index = self._count % self.capacity
+            row = self._data[index]
+            row[0] = t
+            row[1:] = values
+            self._data[index + self.capacity] = row
+            self._count += 1
+            self._new_sample.notify_all()
+
+    def wait_for(self, count, timeout):
+        """Wait up to ``timeout`` seconds for the total count to exceed ``count``."""
+        with self._new_sample:
+            return self._new_sample.wait_for(lambda: self._count > count, timeout)
+
+    def _end(self):
+        # Row index one past the newest sample, always in the upper half
+        return (self._count - 1) % self.capacity + self.capacity + 1
+
+    def latest(self):
+        """View of the newest sample row, or None if nothing was received."""
+        if self._count == 0:
+            return None
+        return self._data[self._end() - 1]
+
+    def window(self, n):
+        """View of the last ``n`` samples (fewer if the buffer is not full yet)."""
+        n = min(int(n), len(self))
+        if n <= 0:
+            return self._data[:0]
+        end = self._end()
+        return self._data[end - n:end]
+
+    def range(self, start, stop):
+        """View of samples ``start`` to ``stop - 1`` counted since creation.
+
+        Samples that have already been overwritten are left out.
+        """
+        stop = min(stop, self._count)
+        start = max(start, stop - self.capacity, 0)
+        if stop <= start:
+            return self._data[:0]
+        end = (stop - 1) % self.capacity + self.capacity + 1
+        return self._data[end - (stop - start):end]
+
+    def since(self, t):
+        """View of all buffered samples with a timestamp strictly after ``t``."""
+        samples = self.window(self.capacity)
+        start = np.searchsorted(samples[:, 0], t, side='right')
+        return samples[start:]
+
+    def column(self, samples, name):
+        """Select one named column from a view returned by this buffer."""
+        return samples[..., self.columns[name]]
@@ -0,0 +1,120 @@
+"""Decoders for the JSON force messages of the Bertec data stream.
+
+Each decoder has ``decode(frame)``, which returns the message as a dict,
+and ``values(frame)``, which returns only ``fields``, in order, as floats
+(NaN when absent). The ingestion thread pushes those values straight into
+the ForceRingBuffer. Backends:
+
+- ``orjson``: orjson, if installed. The default then, it is the fastest.
+- ``projecting``: pure Python, about twice as fast as stdlib json, and the
+  default without orjson. The key layout of the first message is compiled
+  into one regular expression whose groups capture the wanted numbers, so
+  no dict is built. Messages that do not fit that layout are decoded with
+  stdlib json, and the layout is learned again. A layout that cannot be
+  compiled (a non-numeric value) leaves the decoder on stdlib json.
+- ``json``: stdlib json.
+
+``python benchmark.py --only force_decode`` reports the cost per message of
+each backend.
+"""
+import json
+import re
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+NAN = float('nan')
+# A JSON number, or the non-standard NaN/Infinity that json.dumps emits by default.
+# Loose on purpose, float() rejects what is not a number and is faster at it.
+NUMBER = rb'([-+.0-9eE]+|NaN|-?Infinity)'
+
+
+class JsonDecoder:
+    name = 'json'
+    loads = staticmethod(json.loads)
+
+    def __init__(self, fields):
+        self.fields = tuple(fields)
+
+    def decode(self, frame):
+        return self.loads(frame)
+
+    def values(self, frame):
+        message = self.loads(frame)
+        return [message.get(name, NAN) for name in self.fields]
+
+
+class OrjsonDecoder(JsonDecoder):
+    name = 'orjson'
+    loads = staticmethod(orjson.loads) if orjson is not None else None
+
+
+class ProjectingDecoder:
+    name = 'projecting'
+
+    def __init__(self, fields, fallback=None):
+        self.fields = tuple(fields)
+        self.fallback = fallback if fallback is not None else JsonDecoder(fields)
+        self.pattern = None
+        self.order = None  # Group number of each field, 0 if the layout does not have it
+        self.relearned = 0
+        self.templated = True  # False once a layout failed to compile, then the fallback decodes everything
+
+    def decode(self, frame):
+        return self.fallback.decode(frame)
+
+    def values(self, frame):
+        if not self.templated:
+            return self.fallback.values(frame)
+        match = self.pattern.fullmatch(frame) if self.pattern is not None else None
+        if match is None:
+            return self._relearn(frame)
+        groups = match.groups()
+        try:
+            return [float(groups[index - 1]) if index else NAN for index in self.order]
+        except ValueError:
+            return self._relearn(frame)
+
+    def _relearn(self, frame):
+        message = self.fallback.decode(frame)
+        self.pattern, self.order = self._compile(message)
+        self.templated = self.pattern is not None
+        self.relearned += 1
+        return [message.get(name, NAN) for name in self.fields]
+
+    def _compile(self, message):
+        """Regex matching messages with the same keys in the same order, or None if it cannot be templated."""
+        if not isinstance(message, dict):
+            return None, None
+        parts, order, group = [], {}, 0
+        for key, value in message.items():
+            if isinstance(value, bool) or not isinstance(value, (int, float)):
+                return None, None
+            key_pattern = re.escape(json.dumps(key).encode()) + rb'\s*:\s*'
+            if key in self.fields:
+                group += 1
+                order[key] = group
+                parts.append(key_pattern + NUMBER)
+            else:
+                parts.append(key_pattern + NUMBER.replace(b'(', b'(?:', 1))
+        pattern = rb'\s*\{\s*' + rb'\s*,\s*'.join(parts) + rb'\s*\}\s*'
+        return re.compile(pattern), [order.get(name, 0) for name in self.fields]
+
+
+# Fastest first
+DECODERS = {'orjson': OrjsonDecoder, 'projecting': ProjectingDecoder, 'json': JsonDecoder}
+
+
+def available_decoders():
+    return [name for name, decoder in DECODERS.items() if name != 'orjson' or orjson is not None]
+
+
+def make_decoder(name, fields):
+    """Decoder ``name`` for ``fields``. None picks the fastest available one."""
+    if name is None:
+        name = available_decoders()[0]
+    if name not in available_decoders():
+        raise ValueError(f"Force decoder {name!r} is not available, choose from {available_decoders()}")
+    return DECODERS[name](fields)
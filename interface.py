@@ -1,27 +1,47 @@
 import sys
-import json
-import csv
+import os
 import datetime
+import time
+import threading
 from PyQt5.QtWidgets import QApplication, QWidget, QPushButton, QLabel, QVBoxLayout, QHBoxLayout, QMessageBox, QFileDialog
-from PyQt5.QtGui import QPainter, QPen, QColor
-from PyQt5.QtCore import Qt, QTimer
+from PyQt5.QtGui import QPainter, QPen, QColor, QPixmap
+from PyQt5.QtCore import Qt, QTimer, QRect
+from collections import namedtuple
+from config_store import ConfigStore, CONFIG_FILE
+from session_recorder import SessionRecorder, export_csv
+from session_archive import write_archive
 
-CONFIG_FILE = "config.json"  # File to store saved window/button configuration
+RECORDINGS_DIR = "recordings"  # Binary session recordings, exported to CSV on demand
+DEFAULT_DISPLAY_RATE = 60  # Hz, used when the screen refresh rate is unknown
+
+# State shown by the GUI, published by the control loop
+DisplayState = namedtuple('DisplayState', ['speed', 'cop_x', 'cop_y'])
 
 class TreadmillInterface(QWidget):
-    def __init__(self):
+    def __init__(self, config=None):
         super().__init__()
 
-        # Load configuration if available
+        # Load configuration if available. Saves are debounced, see config_store
+        self.config = config if config is not None else ConfigStore(CONFIG_FILE)
         self.load_config()
 
         # COP position
         self.cop_x = 0  # X axis center (-0.5 to +0.5)
         self.cop_y = 0  # Y axis center (0 to 1.53)
 
+        # Display state published by the control thread and its cached background
+        self.display_state = None
+        self.shown_state = None
+        self.background = None
+
         # Recording management
         self.is_recording = False
-        self.data_log = []
+        self.recorder = None
+        self.last_recording = None
+        self.force_buffer = None  # Raw force stream recorded alongside the ticks, if available
+        self.tracer = None  # LatencyTracer whose histograms are saved with the recording, if any
+        self.gait = None  # GaitEventDetector whose steps are saved with the recording, if any
+        self.profiler = None  # StageProfiler timing the display update and dumped with the recording, if any
 
         # Buttons
         self.record_button = QPushButton("Record")
@@ -95,13 +115,29 @@ class TreadmillInterface(QWidget):
         self.restore_positions()
         self.record_button.clicked.connect(self.toggle_recording)
 
+        # Pull the published state at the display refresh rate
+        screen = QApplication.primaryScreen()
+        display_rate = screen.refreshRate() if screen is not None and screen.refreshRate() > 0 else DEFAULT_DISPLAY_RATE
+        self.display_timer = QTimer(self)
+        self.display_timer.timeout.connect(self.refresh_display)
+        self.display_timer.start(int(1000 / display_rate))
+
         self.show()
 
     def paintEvent(self, event):
-        """Draws the treadmill, lines, and COP with optimal and limit zones."""
+        """Draws the cached treadmill background and the COP on top of it."""
+        if self.background is None or self.background.size() != self.size():
+            self.render_background()
+
         painter = QPainter(self)
+        painter.drawPixmap(0, 0, self.background)
+
         painter.setRenderHint(QPainter.Antialiasing)
+        painter.setBrush(QColor(0, 0, 0))
+        painter.drawEllipse(self.cop_rect())
 
+    def treadmill_geometry(self):
+        """Pixel geometry of the treadmill drawing for the current window size."""
         width = self.width()
         height = self.height()
 
@@ -109,6 +145,16 @@ class TreadmillInterface(QWidget):
         treadmill_bottom = int(height * 0.75)
         treadmill_left = int(width * 0.2)
         treadmill_right = int(width * 0.8)
+        return treadmill_top, treadmill_bottom, treadmill_left, treadmill_right
+
+    def render_background(self):
+        """Draws the treadmill, lines, and optimal and limit zones into a cached pixmap."""
+        self.background = QPixmap(self.size())
+        self.background.fill(self.palette().color(self.backgroundRole()))
+        painter = QPainter(self.background)
+        painter.setRenderHint(QPainter.Antialiasing)
+
+        treadmill_top, treadmill_bottom, treadmill_left, treadmill_right = self.treadmill_geometry()
         treadmill_center_x = (treadmill_left + treadmill_right) // 2
         treadmill_height = treadmill_bottom - treadmill_top
 
@@ -144,54 +190,81 @@ class TreadmillInterface(QWidget):
         pen_black = QPen(Qt.black, 2, Qt.SolidLine)
         painter.setPen(pen_black)
         painter.drawLine(treadmill_center_x, treadmill_top, treadmill_center_x, treadmill_bottom)
+        painter.end()
+
+    def cop_rect(self):
+        """Bounding box of the COP marker in widget coordinates."""
+        treadmill_top, treadmill_bottom, treadmill_left, treadmill_right = self.treadmill_geometry()
+        treadmill_center_x = (treadmill_left + treadmill_right) // 2
+        treadmill_height = treadmill_bottom - treadmill_top
 
-        # Draw COP
         x_pos = treadmill_center_x + int(self.cop_x * (treadmill_right - treadmill_left) / 2)
         y_pos = treadmill_top + treadmill_height - int(self.cop_y * treadmill_height / 1.53)
-
-        painter.setBrush(QColor(0, 0, 0))
-        painter.drawEllipse(x_pos - 5, y_pos - 5, 10, 10)
+        return QRect(x_pos - 5, y_pos - 5, 10, 10)
 
     def update_cop(self, cop_x, cop_y):
-        """Update COP position and refresh display."""
+        """Update COP position and repaint only the old and new marker areas."""
+        old_rect = self.cop_rect()
         self.cop_x = max(-0.5, min(0.5, cop_x))
         self.cop_y = max(0, min(1.53, cop_y))
-        self.update()
+        self.update(old_rect.adjusted(-2, -2, 2, 2))
+        self.update(self.cop_rect().adjusted(-2, -2, 2, 2))
 
         self.cop_x_label.setText(f"COP X: {self.cop_x:.2f} m")
         self.cop_y_label.setText(f"COP Y: {self.cop_y:.2f} m")
 
-    def log_data(self, step, treadmill_speed, treadmill_acceleration, cop_measured, cop_estimated):
+    def publish_state(self, speed, cop_x, cop_y):
+        """Publish the latest state from any thread; the GUI picks it up on its display timer."""
+        # Replacing a reference to an immutable tuple is atomic, no lock is needed
+        self.display_state = DisplayState(speed, cop_x, cop_y)
+
+    def refresh_display(self):
+        """Show the latest published state, called by the display timer on the GUI thread."""
+        state = self.display_state
+        if state is None or state is self.shown_state:
+            return
+        self.shown_state = state
+
+        profiler = self.profiler
+        profiling = profiler is not None and profiler.enabled
+        if profiling:
+            start = profiler.clock()
+        self.update_cop(state.cop_x, state.cop_y)
+        self.speed_label.setText(f'Current speed: {state.speed:.2f} m/s')
+        if profiling:
+            profiler.lap('display', start)
+
+    def log_data(self, step, treadmill_speed, treadmill_acceleration, cop_measured, cop_estimated, fz=0.0, t=None):
         """Log one row of data."""
-        if self.is_recording:
-            self.data_log.append([step, treadmill_speed, treadmill_acceleration, cop_measured, cop_estimated])
+        recorder = self.recorder
+        if recorder is not None:
+            recorder.record_tick(time.perf_counter() if t is None else t, step, treadmill_speed,
+                                 treadmill_acceleration, cop_measured, cop_estimated, fz)
 
     def closeEvent(self, event):
         """Save configuration before closing."""
         self.save_config()
+        self.config.flush()
         event.accept()
 
     def load_config(self):
         """Load configuration if it exists."""
-        try:
-            with open(CONFIG_FILE, "r") as file:
-                config = json.load(file)
-                self.resize(*config["window_size"])
-                self.button_positions = config
-        except FileNotFoundError:
+        window_size = self.config.get("window_size")
+        if window_size:
+            self.resize(*window_size)
+            self.button_positions = {name: self.config.get(name)
+                                     for name in ("record_button", "start_button", "stop_button")}
+        else:
             self.button_positions = None
 
     def save_config(self):
-        """Save current window size and button positions."""
-        config = {
-            "window_size": [self.width(), self.height()],
-            "record_button": [self.record_button.x(), self.record_button.y()],
-            "start_button": [self.start_button.x(), self.start_button.y()],
-            "stop_button": [self.stop_button.x(), self.stop_button.y()]
-        }
-
-        with open(CONFIG_FILE, "w") as file:
-            json.dump(config, file)
+        """Save current window size and button positions, written once the changes stop."""
+        self.config.update(
+            window_size=[self.width(), self.height()],
+            record_button=[self.record_button.x(), self.record_button.y()],
+            start_button=[self.start_button.x(), self.start_button.y()],
+            stop_button=[self.stop_button.x(), self.stop_button.y()],
+        )
 
     def restore_positions(self):
         """Restore button positions from config if available."""
@@ -204,31 +277,51 @@ class TreadmillInterface(QWidget):
         """Toggle data recording."""
         self.is_recording = not self.is_recording
         if not self.is_recording:
+            self.last_recording = self.stop_recording()
+            self.archive_recording()
             self.auto_export_csv()
 
         if self.is_recording:
             self.record_button.setStyleSheet("background-color: red; font-size: 14px; padding: 5px;")
             self.record_button.setText("Recording...")
-            self.data_log = []
+            timestamp = datetime.datetime.now().strftime("%Y_%m_%d_%H%M%S")
+            self.start_recording(os.path.join(RECORDINGS_DIR, f"session_{timestamp}"))
         else:
             self.record_button.setStyleSheet("background-color: lightgray; font-size: 14px; padding: 5px;")
             self.record_button.setText("Record")
 
+    def start_recording(self, base_path):
+        """Record the ticks passed to log_data, and the raw force stream if available."""
+        self.recorder = SessionRecorder(base_path, self.force_buffer, tracer=self.tracer, gait=self.gait)
+
+    def stop_recording(self):
+        """Close the recording and return its base path."""
+        recorder, self.recorder = self.recorder, None
+        recorder.close()
+        if self.profiler is not None and self.profiler.enabled:
+            self.profiler.dump(recorder.base_path)
+        return recorder.base_path
+
+    def archive_recording(self):
+        """Write the time-indexed archive of the last recording, see session_archive."""
+        if self.last_recording is None:
+            return
+        # Not a daemon: closing the window waits for the archive instead of leaving it unwritten
+        threading.Thread(target=write_archive, args=(self.last_recording,), name="session-archive").start()
+
     def auto_export_csv(self):
         """Automatically export data to CSV after recording ends."""
-        if not self.data_log:
+        if self.last_recording is None:
             return
 
-        timestamp = datetime.datetime.now().strftime("%Y_%m_%d")
-        default_filename = f"acquisition_{timestamp}.csv"
+        # Named after the session, so that a second session of the day does not overwrite the first
+        session_name = os.path.basename(self.last_recording)
+        default_filename = session_name.replace("session_", "acquisition_", 1) + ".csv"
 
         file_path, _ = QFileDialog.getSaveFileName(self, "Save CSV", default_filename, "CSV Files (*.csv)")
 
         if file_path:
-            with open(file_path, "w", newline="") as file:
-                writer = csv.writer(file)
-                writer.writerow(["Treadmill_speed", "Treadmill_acceleration", "COP_measured", "COP_filtered"])
-                writer.writerows([row[1:] for row in self.data_log])
+            export_csv(self.last_recording, file_path)
 
             # Visual confirmation: Record button turns green for 3s
             self.record_button.setStyleSheet("background-color: green; font-size: 14px; padding: 5px;")
@@ -236,7 +329,8 @@ class TreadmillInterface(QWidget):
                 "background-color: lightgray; font-size: 14px; padding: 5px;"))
 
     def resizeEvent(self, event):
-        """Save window size when resized."""
+        """Save window size and redraw the cached background when resized."""
+        self.render_background()
         self.save_config()
         super().resizeEvent(event)
 
@@ -0,0 +1,205 @@
+"""Sensor-to-belt latency tracing.
+
+Each control tick that hands a speed to the command stage carries a
+TickStamp. It holds the receive time of the newest force sample used, the
+Bertec-side timestamp if the payload has one, and when the estimator and
+controller started and finished. The CommandCoalescer adds the send and
+acknowledgement times of the RunTreadmill RPC that carries the setpoint.
+LatencyTracer records every stage into fixed-size, log-linear histograms,
+in the style of HdrHistogram. Each record is O(1) and allocation-free, and
+histograms can be merged. All times are time.perf_counter() seconds.
+
+Stages:
+    sample_age           tick start - sample receive time
+    compute              estimator + controller time
+    command_queue        RPC send - end of compute (rate limiting, busy channel)
+    rpc                  RunTreadmill acknowledgement - send
+    sensor_to_actuation  RunTreadmill acknowledgement - sample receive time
+"""
+import threading
+import time
+from collections import namedtuple
+import numpy as np
+
+TickStamp = namedtuple('TickStamp', ['sample_t', 'device_t', 'compute_start', 'compute_end'])
+
+STAGES = ('sample_age', 'compute', 'command_queue', 'rpc', 'sensor_to_actuation')
+
+
+class LatencyHistogram:
+    """Histogram of durations in nanoseconds with a bounded relative error.
+
+    Values below 2 * ``2 ** (precision - 1)`` ns get one bucket each. Above
+    that, every power of two is split into ``2 ** (precision - 1)`` buckets,
+    so a value is known to within ``2 ** -(precision - 1)`` of itself (1.6 %
+    with the default precision). Values above ``max_value`` are clamped into
+    the last bucket but still counted in ``max``.
+    """
+
+    def __init__(self, precision=7, max_value=100_000_000_000):
+        self.precision = precision
+        self.half = 1 << (precision - 1)
+        self.size = self._index(max_value) + 1
+        self.counts = [0] * self.size  # A list: incrementing a NumPy element is ~10x slower
+
+        # Lowest value and width of every bucket, for percentiles
+        indexes = np.arange(self.size)
+        shifts = np.maximum(indexes // self.half - 1, 0)
+        self.lower = (indexes - shifts * self.half) << shifts
+        self.width = np.left_shift(1, shifts)
+        self.reset()
+
+    def _index(self, value):
+        shift = value.bit_length() - self.precision
+        if shift <= 0:
+            return value
+        return shift * self.half + (value >> shift)
+
+    def reset(self):
+        self.counts = [0] * self.size
+        self.total = 0
+        self.sum = 0
+        self.max = 0
+
+    def record(self, value_ns):
+        value = max(int(value_ns), 0)
+        self.counts[min(self._index(value), self.size - 1)] += 1
+        self.total += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def merge(self, other):
+        self.counts = [a + b for a, b in zip(self.counts, other.counts)]
+        self.total += other.total
+        self.sum += other.sum
+        self.max = max(self.max, other.max)
+
+    def percentile(self, q):
+        """Value (ns) below which ``q`` percent of the records fall."""
+        if self.total == 0:
+            return None
+        rank = max(1, int(np.ceil(q / 100 * self.total)))
+        index = int(np.searchsorted(np.cumsum(self.counts), rank))
+        # Middle of the bucket, but never above the largest recorded value
+        return min(float(self.lower[index] + self.width[index] / 2), float(self.max))
+
+    def summary(self):
+        """Percentiles in microseconds, with the same keys as benchmark.summarize."""
+        if self.total == 0:
+            return {'n': 0}
+        return {
+            'n': self.total,
+            'mean_us': self.sum / self.total / 1e3,
+            'p50_us': self.percentile(50) / 1e3,
+            'p90_us': self.percentile(90) / 1e3,
+            'p99_us': self.percentile(99) / 1e3,
+            'p999_us': self.percentile(99.9) / 1e3,
+            'max_us': self.max / 1e3,
+        }
+
+    def to_dict(self):
+        """Non-empty buckets and totals, compact enough to store next to a recording."""
+        buckets = [index for index, count in enumerate(self.counts) if count]
+        return {'precision': self.precision, 'total': self.total, 'sum': self.sum, 'max': self.max,
+                'buckets': buckets, 'counts': [self.counts[index] for index in buckets]}
+
+    @classmethod
+    def from_dict(cls, data):
+        histogram = cls(data['precision'])
+        for index, count in zip(data['buckets'], data['counts']):
+            histogram.counts[index] = count
+        histogram.total, histogram.sum, histogram.max = data['total'], data['sum'], data['max']
+        return histogram
+
+
+class RollingHistogram:
+    """LatencyHistogram over the last ``window`` seconds, kept as ``slots`` rotating sub-histograms."""
+
+    def __init__(self, window=10.0, slots=5, precision=7):
+        self.slot_length = window / slots
+        self.slots = [LatencyHistogram(precision) for _ in range(slots)]
+        self.current = 0
+        self.rotate_at = time.monotonic() + self.slot_length
+
+    def _rotate(self, now):
+        # Clear every slot that has fully left the window since the last record
+        elapsed = int((now - self.rotate_at) // self.slot_length) + 1
+        for _ in range(min(elapsed, len(self.slots))):
+            self.current = (self.current + 1) % len(self.slots)
+            self.slots[self.current].reset()
+        self.rotate_at += elapsed * self.slot_length
+
+    def record(self, value_ns):
+        now = time.monotonic()
+        if now >= self.rotate_at:
+            self._rotate(now)
+        self.slots[self.current].record(value_ns)
+
+    def merged(self):
+        now = time.monotonic()
+        if now >= self.rotate_at:
+            self._rotate(now)
+        histogram = LatencyHistogram(self.slots[0].precision)
+        for slot in self.slots:
+            histogram.merge(slot)
+        return histogram
+
+
+class LatencyTracer:
+    """Per-stage latency histograms, over the whole run and over a rolling window.
+
+    Recording is thread-safe: the control thread records sample_age and
+    compute, the command stage records the RPC stages when a command is
+    acknowledged.
+    """
+
+    def __init__(self, window=10.0):
+        self.lock = threading.Lock()
+        self.window = window
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.total = {stage: LatencyHistogram() for stage in STAGES}
+            self.rolling = {stage: RollingHistogram(self.window) for stage in STAGES}
+
+    def _record(self, stage, seconds):
+        value = seconds * 1e9
+        self.total[stage].record(value)
+        self.rolling[stage].record(value)
+
+    def stamp(self, sample, compute_start, compute_end):
+        """Record the tick's sample age and compute time, and return its TickStamp."""
+        if sample is None:
+            return None
+        with self.lock:
+            self._record('sample_age', compute_start - sample.t)
+            self._record('compute', compute_end - compute_start)
+        return TickStamp(sample.t, sample.device_t, compute_start, compute_end)
+
+    def record_command(self, stamp, sent, acked):
+        """Record the RPC stages of the command that carried the setpoint of ``stamp``."""
+        with self.lock:
+            self._record('command_queue', sent - stamp.compute_end)
+            self._record('rpc', acked - sent)
+            self._record('sensor_to_actuation', acked - stamp.sample_t)
+
+    def snapshot(self, rolling=True):
+        """Summary (us) of every stage, over the rolling window or the whole run."""
+        with self.lock:
+            if rolling:
+                return {stage: histogram.merged().summary() for stage, histogram in self.rolling.items()}
+            return {stage: histogram.summary() for stage, histogram in self.total.items()}
+
+    def percentile(self, stage, q, rolling=True):
+        """q-th percentile of ``stage`` in seconds, None if nothing was recorded."""
+        with self.lock:
+            histogram = self.rolling[stage].merged() if rolling else self.total[stage]
+            value = histogram.percentile(q)
+        return None if value is None else value / 1e9
+
+    def to_dict(self):
+        """Whole-run histograms of every stage, see LatencyHistogram.to_dict."""
+        with self.lock:
+            return {stage: histogram.to_dict() for stage, histogram in self.total.items()}
@@ -0,0 +1,120 @@
+"""Logging for the control and RPC paths.
+
+Modules log through ``logging.getLogger(__name__)`` with %-style arguments,
+so a disabled level costs one integer comparison and nothing is formatted.
+``setup_logging`` installs a handler that only puts records on a bounded
+queue. A QueueListener thread formats them and writes to the console and,
+optionally, to a file, so the control loop never waits on terminal or disk
+I/O. If the queue is full, records are dropped rather than blocking. On the
+console, repeated messages from the same call site are rate limited, e.g. the
+missing force data warning that would otherwise be emitted every tick. Errors
+are never rate limited, and the log file gets every record.
+"""
+import atexit
+import logging
+import logging.handlers
+import queue
+import threading
+import time
+
+LOG_FORMAT = "%(asctime)s %(levelname)s %(name)s: %(message)s"
+# %(suppressed)s is set by RateLimitFilter
+CONSOLE_FORMAT = LOG_FORMAT + "%(suppressed)s"
+
+
+class RateLimitFilter(logging.Filter):
+    """Let through at most one record below ERROR per ``interval`` seconds per call site.
+
+    The next record let through from that call site reports how many were
+    suppressed in between, in its ``suppressed`` attribute. The record itself
+    is left untouched for the other handlers.
+    """
+
+    def __init__(self, interval=1.0):
+        super().__init__()
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.last_emit = {}
+        self.suppressed = {}
+
+    def filter(self, record):
+        record.suppressed = ""
+        if record.levelno >= logging.ERROR or record.exc_info:
+            return True
+        key = (record.pathname, record.lineno)
+        now = time.monotonic()
+        with self.lock:
+            if now - self.last_emit.get(key, -self.interval) < self.interval:
+                self.suppressed[key] = self.suppressed.get(key, 0) + 1
+                return False
+            self.last_emit[key] = now
+            suppressed = self.suppressed.pop(key, 0)
+        if suppressed:
+            record.suppressed = f" ({suppressed} similar messages suppressed)"
+        return True
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler that drops records when the queue is full and defers formatting to the listener."""
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        # The listener lives in the same process, so the record does not need
+        # to be formatted or made picklable here
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+_listener = None
+
+
+def setup_logging(level=logging.INFO, log_file=None, rate_limit=1.0, queue_size=10000):
+    """Route all logging through a background queue listener. Returns the queue handler.
+
+    ``rate_limit`` is the RateLimitFilter interval of the console, None or 0 to show every record.
+    """
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+
+    console = logging.StreamHandler()
+    if rate_limit:
+        console.addFilter(RateLimitFilter(rate_limit))
+        console.setFormatter(logging.Formatter(CONSOLE_FORMAT))
+    else:
+        console.setFormatter(logging.Formatter(LOG_FORMAT))
+    handlers = [console]
+    if log_file:
+        file_handler = logging.FileHandler(log_file)
+        file_handler.setFormatter(logging.Formatter(LOG_FORMAT))
+        handlers.append(file_handler)
+
+    log_queue = queue.Queue(queue_size)
+    queue_handler = DroppingQueueHandler(log_queue)
+
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(queue_handler)
+    root.setLevel(level)
+
+    _listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+    _listener.start()
+    return queue_handler
+
+
+@atexit.register
+def stop_logging():
+    """Flush the queued records and stop the listener thread."""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
@@ -1,4 +1,6 @@
+import logging
 import BertecRemoteControl
+from logging_setup import setup_logging
 from time import sleep
 
 # This is a demo script to use as an example of how to start a connection to the Bertec
@@ -6,6 +8,7 @@ from time import sleep
 
 # Set up RemoteControl object, then use the start_connection method to set up the
 # network parameters and then call init_connect on the server
+setup_logging(logging.DEBUG, rate_limit=None)  # Show every RPC message sent and received
 remote = BertecRemoteControl.RemoteControl()
 res = remote.start_connection()
 print(res)
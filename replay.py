@@ -0,0 +1,329 @@
+"""Offline replay of recorded force streams through the estimator and controller.
+
+A recording holds the raw force stream as columns ``t`` (s), ``fz`` and
+``copy``. It can also hold the belt ``speed`` that was commanded while it
+was recorded, either in a .npz file or in a CSV file with a header row.
+A session written by SessionRecorder can be given by its base path; its
+raw force stream is replayed with the recorded speed.
+The stream is averaged onto the control grid the same way SampleBus does
+it live. It then goes through FastStateEstimator and LQGController, with a
+simulated latest-wins command stage instead of the treadmill.
+
+Without a speed column the replay is open loop: the recorded COP does not
+react to the replayed belt speed. The estimator then runs as one vectorized
+steady-state filter pass over the whole recording. Such a recording cannot
+be swept, its COP error only depends on ``center_cop``. With a speed column the
+COP is corrected for the drift caused by the difference between the
+replayed and the recorded belt speed, which closes the loop tick by tick.
+Replayed commands reach the belts after the RPC latency recorded with the
+session (or ``--latency``), and the belts ramp at the commanded
+acceleration. Sweeping ``predict_latency`` shows what the Smith predictor
+of controller.py gains on a recording, in COP error and reaction time:
+
+    python replay.py session --grid '{"predict_latency": [false, true]}'
+
+    python replay.py session.npz
+    python replay.py session --grid '{"max_v": [1.5, 2.0], "deceleration_smoothing": [0.1, 0.25]}'
+"""
+import argparse
+import dataclasses
+import itertools
+import json
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from controller import ControllerParams, FastStateEstimator, LQGController, steady_state_kalman_gain
+from gait_events import GaitEventDetector, stance_mask
+from session_recorder import read_records, TICKS_SUFFIX, FORCES_SUFFIX, LATENCY_SUFFIX
+
+DEFAULT_LATENCY = 0.005  # s, RPC latency of recordings that do not carry one
+MAX_REACTION_TIME = 2.0  # s, longest lag searched for the reaction time
+
+
+class Recording:
+    def __init__(self, t, fz, copy, speed=None, command_latency=DEFAULT_LATENCY):
+        self.command_latency = command_latency
+        self.t = np.asarray(t, dtype=float)
+        self.fz = np.asarray(fz, dtype=float)
+        self.copy = np.asarray(copy, dtype=float)
+        self.speed = None if speed is None else np.asarray(speed, dtype=float)
+
+    @property
+    def duration(self):
+        return float(self.t[-1] - self.t[0]) if len(self.t) else 0.0
+
+
+def load_recording(path):
+    """Load a recording from a .npz file, a CSV file with a header row or a recorded session."""
+    path = str(path)
+    for suffix in (TICKS_SUFFIX, FORCES_SUFFIX):
+        if path.endswith(suffix):
+            path = path[:-len(suffix)]
+    if os.path.exists(path + FORCES_SUFFIX):
+        forces, _ = read_records(path + FORCES_SUFFIX)
+        ticks, _ = read_records(path + TICKS_SUFFIX)
+        speed = np.interp(forces['t'], ticks['t'], ticks['speed']) if len(ticks) else None
+        latency = DEFAULT_LATENCY
+        if os.path.exists(path + LATENCY_SUFFIX):
+            with open(path + LATENCY_SUFFIX) as file:
+                rpc = json.load(file)['summary']['rpc']
+            if rpc.get('n'):
+                latency = rpc['p50_us'] / 1e6
+        return Recording(forces['t'], forces['fz'], forces['copy'], speed, latency)
+
+    if path.endswith('.npz'):
+        with np.load(path) as data:
+            columns = {name: data[name] for name in data.files}
+    else:
+        table = np.genfromtxt(path, delimiter=',', names=True)
+        columns = {name: table[name] for name in table.dtype.names}
+
+    return Recording(columns['t'], columns['fz'], columns['copy'], columns.get('speed'))
+
+
+class ReplayCommands:
+    """Replay stand-in for CommandCoalescer: latest wins, at most one send per command_delay.
+
+    A sent speed becomes the belt target ``latency`` seconds later. The belt
+    then ramps towards it at the acceleration sent with the command.
+    """
+
+    def __init__(self, command_delay, latency=0.0):
+        self.command_delay = command_delay
+        self.latency = latency
+        self.pending = None
+        self.acceleration = None
+        self.in_flight = deque()
+        self.last_send = -np.inf
+        self.target = None
+        self.belt_acceleration = None
+        self.belt_speed = None
+        self.submitted = 0
+        self.coalesced = 0
+        self.sent = 0
+
+    def set_belts(self, vel, accel, decel, stamp=None):
+        self.submitted += 1
+        if self.pending is not None:
+            self.coalesced += 1
+        self.pending = float(vel)
+        self.acceleration = float(accel)
+
+    def advance(self, now, dt, belt_speed=None):
+        """Send what is due and move the belt by ``dt``, starting from ``belt_speed`` before the first command."""
+        if self.pending is not None and now - self.last_send >= self.command_delay:
+            self.in_flight.append((now + self.latency, self.pending, self.acceleration))
+            self.pending = None
+            self.last_send = now
+            self.sent += 1
+
+        while self.in_flight and self.in_flight[0][0] <= now:
+            _, self.target, self.belt_acceleration = self.in_flight.popleft()
+        if self.target is None:
+            return
+        if self.belt_speed is None:
+            self.belt_speed = belt_speed if belt_speed is not None else self.target
+        step = self.belt_acceleration * dt if self.belt_acceleration else np.inf
+        self.belt_speed += max(-step, min(step, self.target - self.belt_speed))
+
+
+def ticks_from_stream(recording, dt):
+    """Average the raw stream over each control tick, like SampleBus does live.
+
+    Returns (t, fz, copy, speed) with one entry per tick that received a
+    COP, ``t`` being the time of the newest sample in the tick. NaN (a field
+    missing from a frame) is left out of the averages.
+    """
+    t = recording.t
+    bins = np.floor((t - t[0]) / dt).astype(np.int64)
+    starts = np.concatenate(([0], np.flatnonzero(np.diff(bins)) + 1))
+    counts = np.diff(np.append(starts, len(t)))
+    ends = starts + counts - 1
+
+    def average(values):
+        present = ~np.isnan(values)
+        with np.errstate(invalid='ignore'):
+            sums = np.add.reduceat(np.where(present, values, 0), starts)
+            return sums / np.add.reduceat(present.astype(np.int64), starts)
+
+    copy = average(recording.copy)
+    ticks = ~np.isnan(copy)
+    speed = None if recording.speed is None else recording.speed[ends][ticks]
+    return t[ends][ticks], average(recording.fz)[ticks], copy[ticks], speed
+
+
+def steady_state_filter(cop, params):
+    """Steady-state Kalman filter over a whole COP array as one linear filter pass.
+
+    Returns (cop_avg, dcom) arrays matching FastStateEstimator(steady_state=True).
+    """
+    k0, k1 = steady_state_kalman_gain(params)
+    gain = np.array([[k0], [k1]])
+    A_nominal = np.array([[1, params.dt], [0, 1]])
+    transition = (np.eye(2) - gain @ np.array([[1, 0]])) @ A_nominal
+
+    # x_k = transition x_{k-1} + gain z_k, written as a state space with s_k = x_{k-1}
+    import scipy.signal  # Deferred, it is slow to import and only needed here
+    numerators, denominator = scipy.signal.ss2tf(transition, gain, transition, gain)
+    # The filter starts at rest on center_cop, which is a fixed point of the model
+    centered = cop - params.center_cop
+    cop_avg = scipy.signal.lfilter(numerators[0], denominator, centered) + params.center_cop
+    dcom = scipy.signal.lfilter(numerators[1], denominator, centered)
+    return cop_avg, dcom
+
+
+def reaction_time(cop, belt, dt):
+    """Lag (s) at which the belt speed correlates best with the COP, None if the belt did not move."""
+    cop = cop - cop.mean()
+    belt = belt - belt.mean()
+    lags = range(min(int(MAX_REACTION_TIME / dt), len(cop) - 1))
+    correlations = [float(np.dot(cop[:len(cop) - lag], belt[lag:])) for lag in lags]
+    if not correlations or max(correlations) <= 0:
+        return None
+    return int(np.argmax(correlations)) * dt
+
+
+def replay(recording, params=None, traces=False):
+    """Replay one recording with one parameter set and return its metrics."""
+    params = params if params is not None else ControllerParams()
+    t, fz, cop_recorded, speed_recorded = ticks_from_stream(recording, params.dt)
+    n = len(t)
+    # Stance and steps on the raw stream, as the live ControlLoop sees them
+    steps = GaitEventDetector(params).update(recording.t, recording.fz, recording.copy)
+    stance = stance_mask(recording.fz, params.fz_threshold, params.fz_release)
+    stance_list = stance[np.searchsorted(recording.t, t, side='right') - 1].tolist()
+
+    commands = ReplayCommands(params.command_delay, recording.command_latency)
+    controller = LQGController(params, commands=commands)
+    if controller.predictor is not None:
+        # Replayed commands take the rate limit, then the RPC latency, to reach the belts
+        controller.predictor.latency = params.command_delay / 2 + recording.command_latency
+    closed_loop = speed_recorded is not None
+
+    cop_fed = np.empty(n)
+    cop_filtered = np.empty(n)
+    speed = np.empty(n)
+    belt_speed = np.empty(n)
+    tick_dt = np.diff(t, prepend=t[0] - params.dt)
+
+    if not closed_loop:
+        cop_filtered[:], dcom_all = steady_state_filter(cop_recorded, params)
+        cop_fed[:] = cop_recorded
+        dcom_list = dcom_all.tolist()
+    else:
+        estimator = FastStateEstimator(params)
+        recorded_list = speed_recorded.tolist()
+        drift = 0.0
+
+    fz_list, cop_list, t_list, dt_list = fz.tolist(), cop_recorded.tolist(), t.tolist(), tick_dt.tolist()
+    for k in range(n):
+        if closed_loop:
+            # A belt running faster than during the recording carries the subject backwards
+            belt = commands.belt_speed if commands.belt_speed is not None else recorded_list[k]
+            belt_speed[k] = belt
+            drift += (belt - recorded_list[k]) * dt_list[k]
+            cop = cop_list[k] - drift
+            cop_avg, dcom = estimator.kalman_update(cop, dt_list[k])
+            cop_fed[k] = cop
+            cop_filtered[k] = cop_avg
+        else:
+            cop_avg, dcom = cop_filtered[k], dcom_list[k]
+            belt_speed[k] = commands.belt_speed if commands.belt_speed is not None else controller.v_tm
+
+        v_tm_tgt = controller.compute_target_speed(stance_list[k], cop_avg, dcom, fz_list[k])
+        controller.update_treadmill_speed(v_tm_tgt)
+        commands.advance(t_list[k], dt_list[k], recorded_list[k] if closed_loop else controller.v_tm)
+        speed[k] = controller.v_tm
+
+    step_times = [step.step_time for step in steps]
+    result = {
+        'ticks': n,
+        'duration': recording.duration,
+        'closed_loop': closed_loop,
+        'cop_rmse': float(np.sqrt(np.mean((cop_fed - params.center_cop) ** 2))),
+        'cop_filtered_rmse': float(np.sqrt(np.mean((cop_filtered - params.center_cop) ** 2))),
+        'commands_sent': commands.sent,
+        'commands_coalesced': commands.coalesced,
+        'speed_mean': float(speed.mean()),
+        'speed_std': float(speed.std()),
+        'reaction_time': reaction_time(cop_fed, belt_speed, params.dt),
+        'command_latency': recording.command_latency,
+        'steps': len(steps),
+        'cadence': 60.0 / float(np.nanmean(step_times)) if len(steps) > 1 else None,
+        'stance_time_mean': float(np.mean([step.stance_time for step in steps])) if steps else None,
+    }
+    if traces:
+        result['traces'] = {'t': t, 'cop': cop_fed, 'cop_filtered': cop_filtered, 'speed': speed,
+                            'belt_speed': belt_speed}
+    return result
+
+
+# Each worker process loads the recording once instead of unpickling it per task
+_worker_recording = None
+
+
+def _init_worker(path, latency):
+    global _worker_recording
+    _worker_recording = load_recording(path)
+    if latency is not None:
+        _worker_recording.command_latency = latency
+
+
+def _replay_worker(params):
+    result = replay(_worker_recording, params)
+    result['params'] = dataclasses.asdict(params)
+    return result
+
+
+def expand_grid(grid, base_params=None):
+    """All ControllerParams combinations of a {field: [values]} grid."""
+    base_params = base_params if base_params is not None else ControllerParams()
+    names = list(grid)
+    combinations = itertools.product(*(grid[name] for name in names))
+    return [dataclasses.replace(base_params, **{name: tuple(value) if isinstance(value, list) else value
+                                                for name, value in zip(names, combination)})
+            for combination in combinations]
+
+
+def sweep(path, grid, base_params=None, processes=None, latency=None):
+    """Replay ``path`` for every parameter combination over a process pool.
+
+    Results are ranked by COP tracking error, then by number of commands sent.
+    The recording needs a speed column: replayed open loop, its COP does not
+    react to the controller, so the error could not rank the parameters.
+    """
+    if load_recording(path).speed is None:
+        raise ValueError(f"{path} has no speed column, so it replays open loop and its COP error only depends "
+                         "on center_cop. Sweep a recorded session instead")
+    param_sets = expand_grid(grid, base_params)
+    chunksize = max(1, len(param_sets) // (4 * (processes or 8)))
+    with ProcessPoolExecutor(processes, initializer=_init_worker, initargs=(path, latency)) as pool:
+        results = list(pool.map(_replay_worker, param_sets, chunksize=chunksize))
+
+    return sorted(results, key=lambda result: (result['cop_rmse'], result['commands_sent']))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Replay a recorded force stream through the controller.")
+    parser.add_argument("recording", help=".npz or .csv file with t, fz, copy and optionally speed columns")
+    parser.add_argument("--grid", help='JSON object of parameter lists to sweep, e.g. {"center_cop": [0.7, 0.8]}')
+    parser.add_argument("--processes", type=int, default=None)
+    parser.add_argument("--top", type=int, default=10, help="Number of ranked sweep results to print")
+    parser.add_argument("--latency", type=float, help="RPC latency of the replayed commands (s), "
+                                                      "instead of the one recorded with the session")
+    args = parser.parse_args()
+
+    if args.grid:
+        try:
+            ranked = sweep(args.recording, json.loads(args.grid), processes=args.processes, latency=args.latency)
+        except ValueError as e:
+            parser.error(str(e))
+        print(json.dumps(ranked[:args.top], indent=2))
+    else:
+        recording = load_recording(args.recording)
+        if args.latency is not None:
+            recording.command_latency = args.latency
+        print(json.dumps(replay(recording), indent=2))
@@ -0,0 +1,83 @@
+import time
+from collections import namedtuple
+import numpy as np
+
+from controller import CENTER_COP
+
+# One force measurement per control tick, shared by the estimator, GUI and logger.
+# When the full-rate stream is buffered, fz/copx/copy are averaged over the
+# n samples received since the previous tick (ignoring frames without that
+# field) and t is the newest receive time.
+# device_t is the Bertec-side timestamp of that newest sample, if it has one.
+ForceSample = namedtuple('ForceSample', ['t', 'fz', 'copx', 'copy', 'n', 'device_t'], defaults=(None,))
+
+
+class SampleBus:
+    """Hands out exactly one ForceSample per control tick.
+
+    ``acquire`` waits at most ``timeout`` seconds for new data, so a silent
+    force plate costs a bounded slice of the tick instead of the 5 s
+    ``DEFAULT_TIMEOUT`` of ``RemoteControl.get_force_data``. A tick whose
+    frames carry no COP gets no sample either. ``center_cop`` stands in for
+    the COP of a polled message without one.
+    """
+
+    def __init__(self, remote, timeout=0.008, center_cop=CENTER_COP):
+        self.remote = remote
+        self.timeout = timeout
+        self.center_cop = center_cop
+        self.last_count = None
+        self.last_sample = None
+
+    def reset(self):
+        """Forget the backlog so the next tick only sees fresh samples."""
+        self.last_count = None
+
+    def acquire(self):
+        """Return the sample for this tick, or None if nothing new arrived in time."""
+        buffer = self.remote.force_buffer
+        if buffer is not None:
+            sample = self._acquire_buffered(buffer)
+        else:
+            sample = self._acquire_polled()
+
+        if sample is not None:
+            self.last_sample = sample
+        return sample
+
+    def _acquire_buffered(self, buffer):
+        if self.last_count is None:
+            # First tick after a reset: start from the newest sample only
+            self.last_count = max(buffer.count - 1, 0)
+
+        if buffer.count == self.last_count and not buffer.wait_for(self.last_count, self.timeout):
+            return None
+
+        count = buffer.count
+        samples = buffer.range(self.last_count, count)
+        self.last_count = count
+
+        if np.isnan(samples).any():
+            # Fields missing from a frame are stored as NaN, average the frames that have them
+            with np.errstate(invalid='ignore'):
+                means = (np.nansum(samples, axis=0) / np.count_nonzero(~np.isnan(samples), axis=0)).tolist()
+        else:
+            means = samples.mean(axis=0).tolist()
+        columns = buffer.columns
+        if means[columns['copy']] != means[columns['copy']]:
+            return None  # No frame of this tick had a COP
+        device_t = None
+        if 'timestamp' in columns:
+            device_t = float(samples[-1, columns['timestamp']])
+            if device_t != device_t:  # NaN, the payload had no timestamp
+                device_t = None
+        return ForceSample(float(samples[-1, 0]), means[columns['fz']], means[columns['copx']],
+                           means[columns['copy']], len(samples), device_t)
+
+    def _acquire_polled(self):
+        force_data = self.remote.get_force_data(int(self.timeout * 1000))
+        if force_data is None:
+            return None
+
+        return ForceSample(time.perf_counter(), force_data.get('fz', 0), force_data.get('copx', 0),
+                           force_data.get('copy', self.center_cop), 1, force_data.get('timestamp'))
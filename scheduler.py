@@ -0,0 +1,91 @@
+import time
+import numpy as np
+
+
+class FixedRateScheduler:
+    """Runs a loop on absolute deadlines derived from ``time.perf_counter_ns``.
+
+    Each call to ``wait`` sleeps until the next deadline instead of sleeping a
+    fixed amount after the work, so the period does not drift with the work
+    duration. The last ``spin`` seconds before a deadline are busy-waited,
+    since ``time.sleep`` usually oversleeps by a few hundred microseconds.
+    A tick that starts after its deadline counts as an overrun, its lateness
+    goes into ``max_overrun_ns``. Only the deadlines passed entirely while
+    late, whose tick never runs, count as missed.
+    """
+
+    HISTORY = 4096  # Number of ticks kept for the jitter percentiles
+
+    def __init__(self, period=0.01, spin=0.0):
+        self.period_ns = int(period * 1e9)
+        self.spin_ns = int(spin * 1e9)
+        self._jitter = np.zeros(self.HISTORY, dtype=np.int64)
+        self._periods = np.zeros(self.HISTORY, dtype=np.int64)
+        self.start()
+
+    def start(self):
+        """Reset the deadline grid and the statistics."""
+        now = time.perf_counter_ns()
+        self.next_deadline = now + self.period_ns
+        self.last_wake = now
+        self.ticks = 0
+        self.overruns = 0
+        self.missed = 0
+        self.max_overrun_ns = 0
+
+    def wait(self):
+        """Block until the next deadline and return the real elapsed dt in seconds."""
+        clock = time.perf_counter_ns
+        deadline = self.next_deadline
+        now = clock()
+
+        if now >= deadline:
+            late = now - deadline
+            skipped = late // self.period_ns
+            self.overruns += 1
+            self.missed += skipped
+            self.max_overrun_ns = max(self.max_overrun_ns, late)
+            # Run right away, for the latest deadline passed, and stay on the original grid
+            deadline += skipped * self.period_ns
+            woke = now
+        else:
+            remaining = deadline - now
+            if remaining > self.spin_ns:
+                time.sleep((remaining - self.spin_ns) / 1e9)
+            if self.spin_ns:
+                while clock() < deadline:
+                    pass
+            woke = clock()
+
+        index = self.ticks % self.HISTORY
+        self._jitter[index] = woke - deadline
+        self._periods[index] = woke - self.last_wake
+        self.ticks += 1
+
+        self.next_deadline = deadline + self.period_ns
+        tick_dt = (woke - self.last_wake) / 1e9
+        self.last_wake = woke
+        return tick_dt
+
+    def stats(self):
+        """Jitter and overrun statistics over the last ``HISTORY`` ticks (times in us)."""
+        n = min(self.ticks, self.HISTORY)
+        if n == 0:
+            return {'ticks': 0, 'overruns': 0, 'missed': 0}
+
+        jitter = self._jitter[:n] / 1e3
+        periods = self._periods[:n] / 1e3
+        p50, p99, p999 = np.percentile(jitter, [50, 99, 99.9]).tolist()
+        return {
+            'ticks': self.ticks,
+            'overruns': self.overruns,
+            'missed': self.missed,
+            'rate_hz': float(1e6 / periods.mean()),
+            'period_mean_us': float(periods.mean()),
+            'period_std_us': float(periods.std()),
+            'jitter_p50_us': p50,
+            'jitter_p99_us': p99,
+            'jitter_p999_us': p999,
+            'jitter_max_us': float(jitter.max()),
+            'max_overrun_us': self.max_overrun_ns / 1e3,
+        }
@@ -0,0 +1,253 @@
+"""Chunked, compressed, time-indexed archive of a recorded session.
+
+``write_archive`` packs the record files of a SessionRecorder session
+(ticks, raw forces, steps) into one ``<base_path>.archive`` file. Every
+table is cut into chunks of ``chunk_rows`` rows, and every column of a chunk
+is stored as its own block. The blocks are byte-shuffled (the bytes of
+equal significance of all values stored together) and zlib-compressed, or
+stored raw with ``codec='none'``. A JSON footer holds, per chunk, the
+offset of every block and the min/max of every column, NaN left out. The
+min/max of the time column form the sparse time index. Rows whose time is
+NaN belong to no time range.
+
+SessionArchive memory-maps the file. ``read`` binary-searches the time
+index, decodes only the blocks of the chunks and columns asked for, and
+returns NumPy arrays. Raw blocks are returned as read-only views of the
+mapping, without any copy. Pulling one minute out of an hour of 1 kHz
+forces decodes at most five chunks per column, a few milliseconds, see
+``python benchmark.py --only session_archive``.
+
+Times are the perf_counter seconds of the recording. Add
+``metadata['clock_offset']`` for wall-clock time.
+
+    python session_archive.py recordings/session_2024_05_02_101500
+"""
+import argparse
+import json
+import mmap
+import os
+import struct
+import zlib
+import numpy as np
+
+from session_recorder import read_records, TICKS_SUFFIX, FORCES_SUFFIX, STEPS_SUFFIX
+
+ARCHIVE_SUFFIX = ".archive"
+CHUNK_ROWS = 16384  # 16 s of forces at 1 kHz
+ALIGNMENT = 64  # Blocks start on cache line boundaries, so raw blocks map as aligned arrays
+CODECS = ('zlib', 'none')
+# Layout: MAGIC, the blocks, the JSON footer, then this trailer: the offset of the footer and MAGIC again
+MAGIC = b'TRDARC01'
+TRAILER = struct.Struct('<Q8s')
+
+# Table name -> (record file suffix, time column)
+TABLES = {
+    'ticks': (TICKS_SUFFIX, 't'),
+    'forces': (FORCES_SUFFIX, 't'),
+    'steps': (STEPS_SUFFIX, 'heel_strike'),
+}
+
+
+def _encode(values, codec, level):
+    if codec == 'none':
+        return values.tobytes()
+    # Byte shuffle: the slowly varying high bytes of consecutive values end up next to each other
+    return zlib.compress(values.view(np.uint8).reshape(-1, values.itemsize).T.tobytes(), level)
+
+
+def _decode(block, dtype, rows, codec):
+    if codec == 'none':
+        return np.frombuffer(block, dtype, rows)
+    shuffled = np.frombuffer(zlib.decompress(block), np.uint8).reshape(dtype.itemsize, rows)
+    return shuffled.T.copy().view(dtype).reshape(-1)
+
+
+def _statistics(values):
+    """min, max and NaN count of ``values``. JSON has no NaN, an all-NaN column has no min/max."""
+    nans = 0
+    if values.dtype.kind == 'f':
+        present = ~np.isnan(values)
+        nans = len(values) - int(np.count_nonzero(present))
+        if nans:
+            values = values[present]
+    if not len(values):
+        return {'min': None, 'max': None, 'nans': nans}
+    return {'min': values.min().item(), 'max': values.max().item(), 'nans': nans}
+
+
+def write_archive(base_path, path=None, chunk_rows=CHUNK_ROWS, codec='zlib', level=1):
+    """Archive the record files of session ``base_path``. Returns the archive path.
+
+    Tables whose record file is missing are skipped. The archive is written
+    to a temporary file first, so an interrupted run never leaves a
+    truncated archive behind.
+    """
+    if codec not in CODECS:
+        raise ValueError(f"Unknown codec {codec!r}, choose from {CODECS}")
+    path = path if path is not None else base_path + ARCHIVE_SUFFIX
+    footer = {'codec': codec, 'metadata': {}, 'tables': {}}
+    temporary = path + ".tmp"
+    with open(temporary, 'wb') as file:
+        file.write(MAGIC)
+        for table, (suffix, time_column) in TABLES.items():
+            if not os.path.exists(base_path + suffix):
+                continue
+            records, metadata = read_records(base_path + suffix)
+            footer['metadata'] = footer['metadata'] or metadata
+            chunks = []
+            # One chunk at a time, so multi-hour sessions are never fully loaded in memory
+            for start in range(0, len(records), chunk_rows):
+                block = records[start:start + chunk_rows]
+                columns = {}
+                for name in records.dtype.names:
+                    values = np.ascontiguousarray(block[name])
+                    data = _encode(values, codec, level)
+                    file.write(b'\0' * (-file.tell() % ALIGNMENT))
+                    columns[name] = {'offset': file.tell(), 'length': len(data), **_statistics(values)}
+                    file.write(data)
+                chunks.append({'start': start, 'rows': len(block), 'columns': columns})
+            footer['tables'][table] = {'dtype': records.dtype.descr, 'time_column': time_column,
+                                       'rows': len(records), 'chunks': chunks}
+            del records
+
+        footer_offset = file.tell()
+        file.write(json.dumps(footer).encode())
+        file.write(TRAILER.pack(footer_offset, MAGIC))
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(temporary, path)
+    return path
+
+
+class SessionArchive:
+    """Read-only access to an archive written by ``write_archive``."""
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as file:
+            self.map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        trailer = self.map[-TRAILER.size:]
+        footer_offset, magic = TRAILER.unpack(trailer)
+        if self.map[:8] != MAGIC or magic != MAGIC:
+            self.map.close()
+            raise ValueError(path + " is not a session archive")
+        footer = json.loads(self.map[footer_offset:-TRAILER.size])
+        self.codec = footer['codec']
+        self.metadata = footer['metadata']
+        self.tables = footer['tables']
+        for info in self.tables.values():
+            info['dtype'] = np.dtype([tuple(field) for field in info['dtype']])
+            # The sparse time index: time range of every chunk. A chunk without any time gets
+            # the end of the previous chunk and the start of the next one, so both stay sorted
+            time_column = info['time_column']
+            t_min = np.array([_nan_if_none(chunk['columns'][time_column]['min'])
+                              for chunk in info['chunks']], dtype=float)
+            t_max = np.array([_nan_if_none(chunk['columns'][time_column]['max'])
+                              for chunk in info['chunks']], dtype=float)
+            info['t_min'] = np.nan_to_num(np.fmin.accumulate(t_min[::-1])[::-1], nan=np.inf)
+            info['t_max'] = np.nan_to_num(np.fmax.accumulate(t_max), nan=-np.inf)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        """Arrays read from a raw ('none') archive are views of the mapping, drop them first."""
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+
+    def columns(self, table):
+        return self.tables[table]['dtype'].names
+
+    def time_range(self, table):
+        """(first, last) time of ``table``, None if it has no time."""
+        info = self.tables[table]
+        if not info['rows'] or not np.isfinite(info['t_min'][0]):
+            return None
+        return float(info['t_min'][0]), float(info['t_max'][-1])
+
+    def statistics(self, table, column):
+        """(min, max) of ``column`` in every chunk, without decoding any block."""
+        return [(chunk['columns'][column]['min'], chunk['columns'][column]['max'])
+                for chunk in self.tables[table]['chunks']]
+
+    def read(self, table, columns=None, start=None, stop=None):
+        """Columns of the rows of ``table`` with ``start <= time < stop``, as a dict of arrays.
+
+        ``columns`` defaults to all of them. Only the chunks that overlap
+        the range are decoded. Rows whose time is NaN are never returned.
+        """
+        info = self.tables[table]
+        columns = list(columns) if columns is not None else list(info['dtype'].names)
+        time_column = info['time_column']
+        first = int(np.searchsorted(info['t_max'], start, 'left')) if start is not None else 0
+        last = int(np.searchsorted(info['t_min'], stop, 'left')) if stop is not None else len(info['chunks'])
+
+        parts = {name: [] for name in columns}
+        for index in range(first, last):
+            chunk = info['chunks'][index]
+            decoded = {}
+            rows = slice(0, chunk['rows'])
+            if chunk['columns'][time_column].get('nans'):
+                # Not sorted with NaN in it, so no binary search: keep the rows one by one
+                times = decoded[time_column] = self._block(info, chunk, time_column)
+                keep = ~np.isnan(times)
+                if start is not None:
+                    keep &= times >= start
+                if stop is not None:
+                    keep &= times < stop
+                rows = np.flatnonzero(keep)
+                if not len(rows):
+                    continue
+            # Only chunks at the edges of the range need their time column to find the rows
+            elif ((start is not None and info['t_min'][index] < start)
+                    or (stop is not None and info['t_max'][index] >= stop)):
+                times = decoded[time_column] = self._block(info, chunk, time_column)
+                begin, end = 0, chunk['rows']
+                if start is not None:
+                    begin = int(np.searchsorted(times, start, 'left'))
+                if stop is not None:
+                    end = int(np.searchsorted(times, stop, 'left'))
+                if begin >= end:
+                    continue
+                rows = slice(begin, end)
+            for name in columns:
+                values = decoded[name] if name in decoded else self._block(info, chunk, name)
+                parts[name].append(values[rows])
+
+        result = {}
+        for name in columns:
+            if not parts[name]:
+                result[name] = np.zeros(0, info['dtype'][name])
+            elif len(parts[name]) == 1:
+                result[name] = parts[name][0]
+            else:
+                result[name] = np.concatenate(parts[name])
+        return result
+
+    def _block(self, info, chunk, name):
+        block = chunk['columns'][name]
+        data = memoryview(self.map)[block['offset']:block['offset'] + block['length']]
+        return _decode(data, info['dtype'][name], chunk['rows'], self.codec)
+
+
+def _nan_if_none(value):
+    return float('nan') if value is None else value
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Archive recorded sessions into chunked, time-indexed files.")
+    parser.add_argument("sessions", nargs='+', help="Base paths of SessionRecorder sessions")
+    parser.add_argument("--codec", choices=CODECS, default='zlib')
+    parser.add_argument("--chunk-rows", type=int, default=CHUNK_ROWS, help="Rows per chunk")
+    args = parser.parse_args()
+
+    for base_path in args.sessions:
+        path = write_archive(base_path, chunk_rows=args.chunk_rows, codec=args.codec)
+        with SessionArchive(path) as archive:
+            for table, info in archive.tables.items():
+                print(f"{path} {table}: {info['rows']} rows in {len(info['chunks'])} chunks, "
+                      f"time range {archive.time_range(table)}")
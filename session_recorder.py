@@ -0,0 +1,240 @@
+import csv
+import json
+import mmap
+import os
+import queue
+import struct
+import threading
+import time
+import numpy as np
+from gait_events import StepEvent
+
+# One control tick, as logged by TreadmillInterface.log_data
+TICK_DTYPE = np.dtype([
+    ('t', 'f8'),
+    ('step', 'i8'),
+    ('speed', 'f8'),
+    ('acceleration', 'f8'),
+    ('cop_measured', 'f8'),
+    ('cop_filtered', 'f8'),
+    ('fz', 'f8'),
+])
+
+# One completed step, as detected by gait_events
+STEP_DTYPE = np.dtype([(name, 'f8') for name in StepEvent._fields])
+
+TICKS_SUFFIX = ".ticks.bin"
+STEPS_SUFFIX = ".steps.bin"
+FORCES_SUFFIX = ".forces.bin"
+LATENCY_SUFFIX = ".latency.json"
+
+
+class RecordFile:
+    """Append-only, memory-mapped file of fixed-layout records.
+
+    Layout: an 8 byte magic, the uint64 number of committed records, the
+    length of a JSON header (dtype and metadata), the header itself padded to
+    HEADER_SIZE, then the records. The file grows in chunks of ``grow``
+    records. The record count is only updated once the records it covers
+    have been written, so after a crash the file still reads back up to the
+    last committed batch.
+    """
+
+    MAGIC = b'TRDREC01'
+    HEADER_SIZE = 4096
+    COUNT_OFFSET = 8
+
+    def __init__(self, path, dtype, metadata=None, grow=65536):
+        self.path = path
+        self.dtype = np.dtype(dtype)
+        self.grow = grow
+        self.count = 0
+        self.capacity = 0
+
+        header = json.dumps({'dtype': self.dtype.descr, 'metadata': metadata or {}}).encode()
+        if 20 + len(header) > self.HEADER_SIZE:
+            raise ValueError("Record file header is too large")
+
+        self.file = open(path, 'w+b')
+        self.file.write(self.MAGIC + struct.pack('<QI', 0, len(header)) + header)
+        self.map = None
+        self.records = None
+        self._resize(grow)
+
+    def _resize(self, capacity):
+        # numpy views must be released before the mapping can be closed
+        self.records = None
+        if self.map is not None:
+            self.map.close()
+        self.file.truncate(self.HEADER_SIZE + capacity * self.dtype.itemsize)
+        self.map = mmap.mmap(self.file.fileno(), 0)
+        self.records = np.frombuffer(self.map, self.dtype, capacity, self.HEADER_SIZE)
+        self.capacity = capacity
+
+    def append(self, records):
+        n = len(records)
+        if self.count + n > self.capacity:
+            needed = self.count + n - self.capacity
+            self._resize(self.capacity + self.grow * (needed // self.grow + 1))
+        self.records[self.count:self.count + n] = records
+        self.count += n
+
+    def commit(self, sync=False):
+        """Publish the appended records in the header, optionally fsync-ing to disk."""
+        struct.pack_into('<Q', self.map, self.COUNT_OFFSET, self.count)
+        if sync:
+            self.map.flush()
+
+    def close(self):
+        if self.map is None:
+            return
+        self.commit(sync=True)
+        self.records = None
+        self.map.close()
+        self.map = None
+        # Drop the unused preallocated tail
+        self.file.truncate(self.HEADER_SIZE + self.count * self.dtype.itemsize)
+        self.file.close()
+
+
+def read_records(path):
+    """Read-only memory map of the committed records of a RecordFile, plus its metadata."""
+    with open(path, 'rb') as file:
+        prefix = file.read(20)
+        if prefix[:8] != RecordFile.MAGIC:
+            raise ValueError(path + " is not a session record file")
+        count, header_length = struct.unpack('<QI', prefix[8:])
+        header = json.loads(file.read(header_length))
+
+    dtype = np.dtype([tuple(field) for field in header['dtype']])
+    if count == 0:
+        return np.zeros(0, dtype), header['metadata']
+    records = np.memmap(path, dtype, 'r', RecordFile.HEADER_SIZE, (count,))
+    return records, header['metadata']
+
+
+class SessionRecorder:
+    """Streams a session to disk from a background writer thread.
+
+    ``record_tick`` only puts a tuple on a bounded queue, so the control loop
+    never waits on disk I/O. When the queue is full the tick is dropped and
+    counted in ``dropped``. The writer thread also copies the raw samples out
+    of the ForceRingBuffer, if one is given, so the full-rate stream is
+    recorded without passing through the control loop. Memory use stays
+    constant whatever the session length. With a GaitEventDetector, the
+    steps it completes are copied the same way. With a LatencyTracer, its
+    histograms are saved next to the records at every fsync.
+    """
+
+    QUEUE_SIZE = 4096
+    WRITE_INTERVAL = 0.05  # s between writer passes
+    FSYNC_INTERVAL = 1.0  # s between fsyncs of both files
+
+    def __init__(self, base_path, force_buffer=None, metadata=None, tracer=None, gait=None):
+        self.base_path = base_path
+        self.force_buffer = force_buffer
+        self.gait = gait
+        self.tracer = tracer
+        self.metadata = dict(metadata or {}, created=time.time(), clock_offset=time.time() - time.perf_counter())
+
+        directory = os.path.dirname(base_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        self.ticks = RecordFile(base_path + TICKS_SUFFIX, TICK_DTYPE, self.metadata)
+        self.forces = None
+        if force_buffer is not None:
+            # Raw samples keep the column layout of the ring buffer
+            self.force_dtype = np.dtype([(name, 'f8') for name in force_buffer.fields])
+            self.forces = RecordFile(base_path + FORCES_SUFFIX, self.force_dtype, self.metadata)
+            self.force_count = force_buffer.count
+        self.steps = None
+        if gait is not None:
+            self.steps = RecordFile(base_path + STEPS_SUFFIX, STEP_DTYPE, self.metadata, grow=1024)
+            self.step_count = gait.step_count
+        self.dropped = 0
+        self.forces_lost = 0
+
+        self.queue = queue.Queue(self.QUEUE_SIZE)
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self._write_loop, name="session-recorder", daemon=True)
+        self.thread.start()
+
+    def record_tick(self, t, step, speed, acceleration, cop_measured, cop_filtered, fz):
+        try:
+            self.queue.put_nowait((t, step, speed, acceleration, cop_measured, cop_filtered, fz))
+        except queue.Full:
+            self.dropped += 1
+
+    def close(self):
+        """Write everything still queued, fsync and close both files."""
+        self.stop_event.set()
+        self.thread.join()
+        self.ticks.close()
+        if self.forces is not None:
+            self.forces.close()
+        if self.steps is not None:
+            self.steps.close()
+
+    def _write_loop(self):
+        last_sync = time.monotonic()
+        while True:
+            stopping = self.stop_event.wait(self.WRITE_INTERVAL)
+            self._write_pending()
+
+            now = time.monotonic()
+            sync = stopping or now - last_sync >= self.FSYNC_INTERVAL
+            self.ticks.commit(sync)
+            if self.forces is not None:
+                self.forces.commit(sync)
+            if self.steps is not None:
+                self.steps.commit(sync)
+            if sync:
+                last_sync = now
+                if self.tracer is not None:
+                    self._write_latency()
+            if stopping:
+                return
+
+    def _write_latency(self):
+        # Replaced atomically, so a crash leaves the previous snapshot intact
+        path = self.base_path + LATENCY_SUFFIX
+        with open(path + ".tmp", "w") as file:
+            json.dump({'summary': self.tracer.snapshot(rolling=False), 'histograms': self.tracer.to_dict()}, file)
+        os.replace(path + ".tmp", path)
+
+    def _write_pending(self):
+        rows = []
+        while True:
+            try:
+                rows.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+        if rows:
+            self.ticks.append(np.array(rows, TICK_DTYPE))
+
+        if self.forces is not None:
+            buffer = self.force_buffer
+            count = buffer.count
+            samples = buffer.range(self.force_count, count)
+            self.forces_lost += count - self.force_count - len(samples)
+            self.force_count = count
+            if len(samples):
+                self.forces.append(samples.view(self.force_dtype).reshape(-1))
+
+        if self.steps is not None:
+            self.step_count, steps = self.gait.steps_since(self.step_count)
+            if steps:
+                self.steps.append(np.array(steps, STEP_DTYPE))
+
+
+def export_csv(base_path, csv_path):
+    """Write the tick records of a recorded session as CSV."""
+    ticks, _ = read_records(base_path + TICKS_SUFFIX)
+    with open(csv_path, "w", newline="") as file:
+        writer = csv.writer(file)
+        writer.writerow(["Time", "Step", "Treadmill_speed", "Treadmill_acceleration", "COP_measured",
+                         "COP_filtered", "Fz"])
+        # Chunked so that multi-hour sessions are never fully loaded in memory
+        for start in range(0, len(ticks), 65536):
+            writer.writerows(ticks[start:start + 65536].tolist())
@@ -0,0 +1,168 @@
+"""Per-stage timing of the control loop, and stack sampling of the control thread.
+
+StageProfiler records the duration of every stage of a tick (force read,
+gait detection, Kalman update, target computation, command, logging, ...)
+into a LatencyHistogram per stage. Timing is done with
+time.perf_counter_ns():
+
+    start = profiler.clock()
+    ...
+    start = profiler.lap('kalman', start)
+
+The loop reads ``enabled`` once per tick and guards every lap with that
+local boolean, so a disabled profiler is never called. The lap itself
+costs about 1.5 µs, see ``python benchmark.py --only
+stage_profiler``.
+
+With ``sample_interval``, a StackSampler thread also records the Python
+stack of the control thread at that interval. It writes them in the
+collapsed format ("outer;inner;leaf count" per line) that flamegraph.pl,
+speedscope and inferno read. A sample can only be taken while the sampler
+holds the GIL, so a stage that never releases it is under-represented. Use
+the stage timings for the numbers and the flame graph for the breakdown
+within a stage.
+
+``dump(base_path)`` writes ``<base_path>.stages.txt`` (the percentile
+table) and ``<base_path>.collapsed`` at any time. ControlLoop calls it when
+it stops if ``ControlLoop.profile_path`` is set.
+"""
+import collections
+import logging
+import os
+import sys
+import threading
+import time
+
+from latency_trace import LatencyHistogram
+
+logger = logging.getLogger(__name__)
+
+STAGES_SUFFIX = ".stages.txt"
+COLLAPSED_SUFFIX = ".collapsed"
+SAMPLE_INTERVAL = 0.01  # s, the 100 Hz default of py-spy
+
+
+class StackSampler:
+    """Thread counting the stacks of one other thread, sampled every ``interval`` seconds."""
+
+    def __init__(self, interval=SAMPLE_INTERVAL):
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.stacks = collections.Counter()
+        self.samples = 0
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def start(self, thread_id):
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self.run, args=(thread_id,), name="stack-sampler", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def reset(self):
+        with self.lock:
+            self.stacks.clear()
+            self.samples = 0
+
+    def run(self, thread_id):
+        while not self.stop_event.wait(self.interval):
+            frame = sys._current_frames().get(thread_id)
+            if frame is None:
+                continue
+            stack = self.collapse(frame)
+            del frame
+            with self.lock:
+                self.stacks[stack] += 1
+                self.samples += 1
+
+    @staticmethod
+    def collapse(frame):
+        """Frames from the outermost to ``frame``, as "function (file.py:line)" joined with ';', as py-spy does."""
+        names = []
+        while frame is not None:
+            code = frame.f_code
+            names.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+            frame = frame.f_back
+        return ';'.join(reversed(names))
+
+    def write(self, path):
+        with self.lock:
+            stacks = self.stacks.most_common()
+        with open(path, 'w') as file:
+            for stack, count in stacks:
+                file.write(f"{stack} {count}\n")
+
+
+class StageProfiler:
+    """Duration histograms of the stages of a loop.
+
+    Each stage must be recorded by a single thread: the histograms are not
+    locked, so that a lap stays in the microsecond range.
+    """
+
+    clock = staticmethod(time.perf_counter_ns)
+
+    def __init__(self, enabled=False, sample_interval=None):
+        self.enabled = enabled
+        self.histograms = {}  # stage -> LatencyHistogram, in the order the stages were first seen
+        self.sampler = StackSampler(sample_interval) if sample_interval else None
+
+    def lap(self, stage, start):
+        """Record ``stage`` as lasting from ``start`` (a clock() value) to now. Returns now."""
+        now = time.perf_counter_ns()
+        histogram = self.histograms.get(stage)
+        if histogram is None:
+            histogram = self.histograms[stage] = LatencyHistogram()
+        histogram.record(now - start)
+        return now
+
+    def reset(self):
+        for histogram in list(self.histograms.values()):
+            histogram.reset()
+        if self.sampler is not None:
+            self.sampler.reset()
+
+    def start_sampling(self, thread_id):
+        if self.enabled and self.sampler is not None:
+            self.sampler.start(thread_id)
+
+    def stop_sampling(self):
+        if self.sampler is not None:
+            self.sampler.stop()
+
+    def snapshot(self):
+        """Summary (us) of every stage, with the keys of LatencyHistogram.summary."""
+        return {stage: histogram.summary() for stage, histogram in list(self.histograms.items())}
+
+    def table(self):
+        """The snapshot as a fixed-width text table."""
+        columns = ('n', 'mean_us', 'p50_us', 'p90_us', 'p99_us', 'p999_us', 'max_us')
+        # lap() may add a stage from the control thread meanwhile
+        snapshot = self.snapshot()
+        width = max([len(stage) for stage in snapshot] + [len('stage')])
+        lines = [f"{'stage':<{width}}" + ''.join(f"{column:>11}" for column in columns)]
+        for stage, summary in snapshot.items():
+            if summary['n'] == 0:
+                continue
+            lines.append(f"{stage:<{width}}{summary['n']:>11d}" +
+                         ''.join(f"{summary[column]:>11.1f}" for column in columns[1:]))
+        return '\n'.join(lines)
+
+    def dump(self, base_path):
+        """Write the stage table and, when sampling, the collapsed stacks next to ``base_path``."""
+        directory = os.path.dirname(base_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(base_path + STAGES_SUFFIX, 'w') as file:
+            file.write(self.table() + '\n')
+        paths = [base_path + STAGES_SUFFIX]
+        if self.sampler is not None and self.sampler.samples:
+            self.sampler.write(base_path + COLLAPSED_SUFFIX)
+            paths.append(base_path + COLLAPSED_SUFFIX)
+        logger.info("Profile written to %s", ', '.join(paths))
+        return paths
@@ -0,0 +1,137 @@
+"""Broadcast of the controller state to any number of viewers.
+
+StatePublisher is a ControlLoop sink. The control thread only stores the
+latest tick. A publisher thread, the only user of the PUB socket, sends it
+at ``rate`` Hz as one fixed-size binary frame (STATE_STRUCT, little endian,
+52 bytes). Subscribers conflate, so a slow viewer only ever gets the newest
+state and never holds back the others. The Bertec server keeps seeing a
+single client however many viewers attach.
+"""
+import struct
+import threading
+import time
+from collections import namedtuple
+import zmq
+
+STATE_MAGIC = b'TRS1'
+# magic, seq, wall time, speed, acceleration, cop_x, cop_measured, cop_filtered, fz, step,
+# sensor-to-actuation latency p50 and p99 (ms, NaN until a command was acknowledged)
+STATE_STRUCT = struct.Struct('<4sIdffffffIff')
+
+PublishedState = namedtuple('PublishedState', ['seq', 'time', 'speed', 'acceleration', 'cop_x', 'cop_measured',
+                                               'cop_filtered', 'fz', 'step', 'latency_p50_ms',
+                                               'latency_p99_ms'])
+
+DEFAULT_ENDPOINT = "tcp://*:5570"
+
+
+def encode_state(state):
+    return STATE_STRUCT.pack(STATE_MAGIC, *state)
+
+
+def decode_state(frame):
+    """PublishedState from one published frame."""
+    magic, *fields = STATE_STRUCT.unpack(frame)
+    if magic != STATE_MAGIC:
+        raise ValueError("Not a controller state frame")
+    return PublishedState(*fields)
+
+
+class StatePublisher:
+    LATENCY_INTERVAL = 1.0  # s between refreshes of the latency percentiles
+
+    def __init__(self, endpoint=DEFAULT_ENDPOINT, rate=50.0, tracer=None, context=None):
+        self.endpoint = endpoint
+        self.rate = rate
+        self.tracer = tracer
+        self.context = context or zmq.Context.instance()
+        self.latest = None  # (tick values, cop_x), replaced as a whole by the control thread
+        self.tick = None
+        self.ticks = 0
+        self.published = 0
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def log_data(self, step, treadmill_speed, treadmill_acceleration, cop_measured, cop_estimated, fz=0.0, t=None):
+        self.tick = (treadmill_speed, treadmill_acceleration, cop_measured, cop_estimated, fz, step)
+
+    def publish_state(self, speed, cop_x, cop_y):
+        self.latest = (self.tick, cop_x)
+        self.ticks += 1
+
+    def start(self):
+        if self.thread is not None:
+            return
+        # Bound here so that a busy port fails the caller, then handed over to the thread
+        self.pub_socket = self.context.socket(zmq.PUB)
+        self.pub_socket.setsockopt(zmq.LINGER, 0)
+        self.pub_socket.setsockopt(zmq.SNDHWM, 16)
+        try:
+            self.pub_socket.bind(self.endpoint)
+        except zmq.error.ZMQError:
+            self.pub_socket.close()
+            raise
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self._publish_loop, name="state-publisher", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        if self.thread is None:
+            return
+        self.stop_event.set()
+        self.thread.join()
+        self.thread = None
+
+    def _latency(self):
+        summary = self.tracer.snapshot()['sensor_to_actuation'] if self.tracer is not None else {'n': 0}
+        if not summary['n']:
+            return float('nan'), float('nan')
+        return summary['p50_us'] / 1e3, summary['p99_us'] / 1e3
+
+    def _publish_loop(self):
+        pub_socket = self.pub_socket
+        period = 1.0 / self.rate
+        next_publish = time.monotonic()
+        next_latency = next_publish
+        latency = (float('nan'), float('nan'))
+        last_ticks = 0
+        try:
+            while not self.stop_event.wait(max(0.0, next_publish - time.monotonic())):
+                next_publish += period
+                now = time.monotonic()
+                if now >= next_latency:
+                    latency = self._latency()
+                    next_latency = now + self.LATENCY_INTERVAL
+
+                latest, ticks = self.latest, self.ticks
+                if latest is None or latest[0] is None or ticks == last_ticks:
+                    continue  # Nothing new since the last frame
+                last_ticks = ticks
+                (speed, acceleration, cop_measured, cop_filtered, fz, step), cop_x = latest
+                seq = self.published & 0xFFFFFFFF
+                pub_socket.send(encode_state((seq, time.time(), speed, acceleration, cop_x, cop_measured, cop_filtered,
+                                              fz, step) + latency))
+                self.published += 1
+        finally:
+            pub_socket.close()
+
+
+class StateSubscriber:
+    """Receives the newest PublishedState of a StatePublisher."""
+
+    def __init__(self, endpoint="tcp://127.0.0.1:5570", context=None):
+        self.context = context or zmq.Context.instance()
+        self.sub_socket = self.context.socket(zmq.SUB)
+        self.sub_socket.setsockopt(zmq.CONFLATE, 1)
+        self.sub_socket.setsockopt(zmq.LINGER, 0)
+        self.sub_socket.connect(endpoint)
+        self.sub_socket.subscribe(b'')
+
+    def receive(self, timeout=1000):
+        """Newest state, or None if nothing arrived within ``timeout`` ms."""
+        if not self.sub_socket.poll(timeout):
+            return None
+        return decode_state(self.sub_socket.recv())
+
+    def close(self):
+        self.sub_socket.close()
@@ -0,0 +1,128 @@
+"""Cache of the Bertec status queries (IsTreadmillMoving, IsInclineMoving, ...).
+
+Status replies are kept for a TTL. Concurrent identical queries share one
+in-flight RPC. ``last`` returns the newest reply with its age in constant
+time, without any RPC, so UI and safety code can read the status as often
+as they like without taking turns with the speed commands on the RPC
+socket. A StatusRefresher keeps the replies fresh from its own thread at a
+low rate.
+"""
+import logging
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import Future
+
+logger = logging.getLogger(__name__)
+
+# reply is None and age None when no reply was received yet
+CachedStatus = namedtuple('CachedStatus', ['reply', 'age'])
+
+STATUS_METHODS = ('IsTreadmillMoving', 'IsInclineMoving', 'IsClientAuthenticated')
+
+
+class StatusCache:
+    def __init__(self, ttl=0.5):
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.replies = {}  # method -> (reply, time.monotonic() of receipt)
+        self.in_flight = {}  # method -> Future shared by every caller waiting for that method
+        self.hits = 0
+        self.shared = 0
+        self.sent = 0
+
+    def last(self, method):
+        """Newest reply to ``method`` and its age in seconds."""
+        entry = self.replies.get(method)
+        if entry is None:
+            return CachedStatus(None, None)
+        return CachedStatus(entry[0], time.monotonic() - entry[1])
+
+    def query(self, method, send, max_age=None):
+        """Future of a reply to ``method`` at most ``max_age`` (default: the TTL) seconds old.
+
+        ``send()`` issues the RPC and returns the reply or a Future of it.
+        It is only called if no fresh enough reply is cached and no query of
+        ``method`` is in flight.
+        """
+        max_age = self.ttl if max_age is None else max_age
+        with self.lock:
+            entry = self.replies.get(method)
+            if entry is not None and time.monotonic() - entry[1] <= max_age:
+                self.hits += 1
+                future = Future()
+                future.set_result(entry[0])
+                return future
+            future = self.in_flight.get(method)
+            if future is not None:
+                self.shared += 1
+                return future
+            future = Future()
+            future.set_running_or_notify_cancel()
+            self.in_flight[method] = future
+            self.sent += 1
+
+        try:
+            reply = send()
+        except Exception as exc:
+            self._complete(method, future, exception=exc)
+            return future
+        if isinstance(reply, Future):
+            reply.add_done_callback(lambda done: self._complete_from(method, future, done))
+        else:
+            self._complete(method, future, reply)
+        return future
+
+    def _complete_from(self, method, future, done):
+        if done.cancelled():
+            self._complete(method, future, exception=ConnectionError("Status query cancelled"))
+        elif done.exception() is not None:
+            self._complete(method, future, exception=done.exception())
+        else:
+            self._complete(method, future, done.result())
+
+    def _complete(self, method, future, reply=None, exception=None):
+        with self.lock:
+            self.in_flight.pop(method, None)
+            # A failed query (None from the REQ client) keeps the previous reply
+            if exception is None and reply is not None:
+                self.replies[method] = (reply, time.monotonic())
+        if exception is not None:
+            future.set_exception(exception)
+        else:
+            future.set_result(reply)
+
+    def stats(self):
+        return {'hits': self.hits, 'shared': self.shared, 'sent': self.sent}
+
+
+class StatusRefresher:
+    """Thread refreshing every status of ``remote`` once per ``interval`` seconds."""
+
+    def __init__(self, remote, interval=1.0, methods=STATUS_METHODS):
+        self.remote = remote
+        self.interval = interval
+        self.methods = methods
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self.run, name="status-refresh", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def run(self):
+        while not self.stop_event.wait(self.interval):
+            for method in self.methods:
+                future = self.remote.query_status(method, self.interval / 2)
+                try:
+                    # Bounded, so that stop() never waits for a dead server
+                    future.result(self.interval)
+                except Exception as exc:
+                    logger.debug("Status refresh of %s failed: %s", method, exc)
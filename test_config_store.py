@@ -0,0 +1,19 @@
+import json
+
+from config_store import ConfigStore
+
+
+def test_invalid_file_is_not_overwritten(tmp_path):
+    path = tmp_path / 'config.json'
+    invalid = '{"window_size": [800, 600], "controller": {"max_v": 1.5},}'
+    path.write_text(invalid)
+    store = ConfigStore(str(path), debounce=60)
+    store.update(window_size=[801, 600])
+    store.flush()
+    assert path.read_text() == invalid
+
+    # Once the file is fixed, the pending change is merged into it
+    path.write_text(invalid.replace('},}', '}}'))
+    store.flush()
+    assert json.loads(path.read_text()) == {'window_size': [801, 600], 'controller': {'max_v': 1.5}}
+    store.close()
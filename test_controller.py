@@ -0,0 +1,63 @@
+import numpy as np
+import pytest
+
+from controller import ControllerParams, StateEstimator, FastStateEstimator
+from force_buffer import ForceRingBuffer
+from replay import steady_state_filter
+from sample_bus import ForceSample, SampleBus
+
+
+def walking_samples(n, seed=0):
+    rng = np.random.default_rng(seed)
+    t = np.arange(n) * 0.01
+    fz = 400 + 300 * np.sin(2 * np.pi * 0.9 * t) + rng.normal(0, 5, n)
+    cop = 0.8 + 0.05 * np.sin(2 * np.pi * 0.9 * t) + rng.normal(0, 0.01, n)
+    return [ForceSample(float(ti), float(f), 0.0, float(c), 1) for ti, f, c in zip(t, fz, cop)]
+
+
+def test_scalar_estimator_matches_matrix_reference():
+    samples = walking_samples(3000)
+    # Real ticks are never exactly dt apart
+    dts = 0.01 + np.random.default_rng(1).uniform(-0.002, 0.002, len(samples))
+    reference, fast = StateEstimator(), FastStateEstimator()
+    for sample, dt_k in zip(samples, dts.tolist()):
+        expected = reference.update(sample, dt_k)
+        actual = fast.update(sample, dt_k)
+        assert actual[0] == expected[0]
+        assert abs(actual[1] - expected[1]) < 1e-12
+        assert abs(actual[2] - expected[2]) < 1e-12
+        assert actual[3] == expected[3]
+
+
+def test_steady_state_estimator_matches_replay_filter():
+    params = ControllerParams()
+    samples = walking_samples(3000)
+    estimator = FastStateEstimator(params, steady_state=True)
+    estimates = np.array([estimator.update(sample)[1:3] for sample in samples])
+
+    cop_avg, dcom = steady_state_filter(np.array([sample.copy for sample in samples]), params)
+    np.testing.assert_allclose(estimates[:, 0], cop_avg, rtol=0, atol=1e-12)
+    np.testing.assert_allclose(estimates[:, 1], dcom, rtol=0, atol=1e-12)
+
+
+def test_params_from_dict_converts_and_rejects():
+    params = ControllerParams.from_dict({'max_v': "2.5", 'q_kalman': [1, "0.5"], 'predict_latency': "true"})
+    assert params.max_v == 2.5 and params.q_kalman == (1.0, 0.5) and params.predict_latency is True
+    with pytest.raises(ValueError, match="min_v.*q_kalman"):
+        ControllerParams.from_dict({'max_v': 3, 'min_v': "fast", 'q_kalman': [1]})
+
+
+def test_frames_without_cop_do_not_poison_the_estimator():
+    buffer = ForceRingBuffer(16, ('t', 'fz', 'copx', 'copy'))
+    bus = SampleBus(type('Remote', (), {'force_buffer': buffer})(), timeout=0)
+    bus.last_count = 0
+    estimator = FastStateEstimator()
+    buffer.push(0.0, (500, 0.1, 0.75))
+    buffer.push(0.001, (500, 0.1, np.nan))
+    sample = bus.acquire()
+    assert sample.copy == 0.75 and sample.n == 2
+    estimator.update(sample)
+    buffer.push(0.002, (500, 0.1, np.nan))
+    assert bus.acquire() is None  # No COP in this tick, like no sample at all
+    buffer.push(0.003, (500, 0.1, 0.8))
+    assert np.isfinite(estimator.update(bus.acquire())[1])
@@ -0,0 +1,69 @@
+import threading
+import time
+from concurrent.futures import CancelledError
+
+import pytest
+
+from BertecRemoteControl import AsyncRemoteControl
+from bertec_simulator import BertecSimulator
+
+
+def connect(simulator_ports, **simulator_options):
+    rpc_port, data_port = simulator_ports
+    simulator = BertecSimulator(rpc_port, data_port, rate=0, **simulator_options)
+    simulator.start()
+    remote = AsyncRemoteControl()
+    remote.start_connection(rpc_port=str(rpc_port), data_port=str(data_port))
+    return simulator, remote
+
+
+def test_queues_filled_from_several_threads():
+    simulator, remote = connect((25655, 25656))
+    futures, lock = [], threading.Lock()
+
+    def run():
+        for i in range(300):
+            future = remote.run_treadmill(1.0, 0.5, 0.5, 1.0, 0.5, 0.5)
+            with lock:
+                futures.append(future)
+
+    try:
+        threads = [threading.Thread(target=run) for _ in range(3)]
+        for thread in threads:
+            thread.start()
+        stops = [remote.stop_treadmill() for _ in range(300)]
+        for thread in threads:
+            thread.join()
+        # wait() does not see futures cancelled with cancel(), poll done() instead
+        deadline = time.monotonic() + 30
+        while not all(future.done() for future in futures + stops) and time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert all(future.done() for future in futures + stops)
+        assert remote.io_thread.is_alive()
+        # Every stop is sent, the speed commands are either answered or superseded by a stop
+        assert all(future.result()['code'] == 1 for future in stops)
+        for future in futures:
+            try:
+                assert future.result()['code'] == 1
+            except CancelledError:
+                pass
+    finally:
+        remote.stop_connection()
+        simulator.stop()
+
+
+def test_late_reply_does_not_resolve_another_request():
+    simulator, remote = connect((25657, 25658), latency=0.3)
+    try:
+        remote.DEFAULT_TIMEOUT = 200
+        incline_id = remote.id
+        with pytest.raises(TimeoutError):
+            remote.run_incline(1.0).result(2)
+        # Sent before the late reply to RunIncline arrives
+        remote.DEFAULT_TIMEOUT = 2000
+        status_id = remote.id
+        reply = remote.is_treadmill_moving(max_age=0).result(2)
+        assert reply['id'] == status_id != incline_id
+    finally:
+        remote.stop_connection()
+        simulator.stop()
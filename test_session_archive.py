@@ -0,0 +1,32 @@
+import numpy as np
+
+from session_archive import SessionArchive, write_archive
+from session_recorder import RecordFile, TICKS_SUFFIX
+
+
+def test_read_skips_rows_without_time(tmp_path):
+    base_path = str(tmp_path / 'session')
+    ticks = RecordFile(base_path + TICKS_SUFFIX, [('t', 'f8'), ('speed', 'f8')])
+    records = np.zeros(1000, ticks.dtype)
+    records['t'] = np.arange(1000) / 100
+    records['speed'] = np.arange(1000)
+    records['t'][[0, 150, 999]] = np.nan  # Ticks without a time, at the edges and inside a chunk
+    records['t'][200:300] = np.nan  # A whole chunk without any
+    ticks.append(records)
+    ticks.close()
+
+    for codec in ('zlib', 'none'):
+        path = write_archive(base_path, f"{base_path}.{codec}", chunk_rows=100, codec=codec)
+        with SessionArchive(path) as archive:
+            assert archive.time_range('ticks') == (0.01, 9.98)
+            assert np.all(np.diff(archive.tables['ticks']['t_min']) >= 0)
+            for start, stop in ((None, None), (1.0, 2.5), (1.45, 3.05), (0.0, 0.02), (9.9, None)):
+                data = archive.read('ticks', start=start, stop=stop)
+                times = records['t']
+                expected = ~np.isnan(times)
+                if start is not None:
+                    expected &= times >= start
+                if stop is not None:
+                    expected &= times < stop
+                np.testing.assert_array_equal(data['speed'], records['speed'][expected])
+                np.testing.assert_array_equal(data['t'], times[expected])